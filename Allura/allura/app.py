@@ -44,7 +44,7 @@
 from allura import model
 from allura.controllers import BaseController
 from allura.lib.decorators import require_post, memoize
-from allura.lib.utils import permanent_redirect, ConfigProxy
+from allura.lib.utils import permanent_redirect, ConfigProxy, AttachmentCopier
 from allura import model as M
 from allura.tasks import index_tasks
 
@@ -222,6 +222,9 @@ class Application(object):
     :cvar bool searchable: If True, show search box in the left menu of this
         Application. Default is True.
     :cvar bool exportable: Default is False, Application can't be exported to json.
+    :ivar AttachmentCopier attachment_copier: Set while exporting, to copy the
+        attachments given to :meth:`save_attachments` concurrently.  Default
+        is None, attachments are copied right away.
     :cvar list permissions: Named permissions used by instances of this
         Application. Default is [].
     :cvar dict permissions_desc: Descriptions of the named permissions.
@@ -278,6 +281,7 @@ class Application(object):
     max_instances = float("inf")
     searchable = False
     exportable = False
+    attachment_copier = None
     DiscussionClass = model.Discussion
     PostClass = model.Post
     AttachmentClass = model.DiscussionAttachment
@@ -773,14 +777,16 @@ def make_dir_for_attachments(self, path):
                 os.makedirs(path)
 
     def save_attachments(self, path, attachments):
+        """Copy ``attachments`` into the ``path`` directory, with
+        :attr:`attachment_copier` if one is set."""
         self.make_dir_for_attachments(path)
+        copier = self.attachment_copier or AttachmentCopier()
         for attachment in attachments:
             attachment_path = os.path.join(
                 path,
                 os.path.basename(attachment.filename)
             )
-            with open(attachment_path.encode('utf8', 'replace'), 'wb') as fl:
-                fl.write(attachment.rfile().read())
+            copier.copy(attachment, attachment_path.encode('utf8', 'replace'))
 
 
 class AdminControllerMixin(object):
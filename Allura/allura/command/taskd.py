@@ -15,8 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import errno
 import logging
 import os
+import resource
 import time
 import Queue
 from contextlib import contextmanager
@@ -29,7 +31,7 @@
 from setproctitle import setproctitle, getproctitle
 import tg
 from paste.deploy import loadapp
-from paste.deploy.converters import asint
+from paste.deploy.converters import asint, asbool
 from webob import Request
 
 import base
@@ -60,13 +62,41 @@ class TaskdCommand(base.Command):
     parser.add_option('--only', dest='only', type='string', default=None,
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
-                      help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+                      help='Do not capture stdout and redirect it to logging.  '
+                      'Useful for development with pdb.set_trace()')
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+                      help='number of worker processes to run, managed by a supervisor process '
+                      '(default: 1, no supervisor)')
+    parser.add_option('--reserved', dest='reserved', type='int', default=0,
+                      help='number of the workers which only handle --priority-tasks, '
+                      'so they never wait behind slow tasks')
+    parser.add_option('--priority-tasks', dest='priority_tasks', type='string',
+                      default='allura.tasks.notification_tasks.notify,allura.tasks.mail_tasks.sendmail',
+                      help='task names handled by the --reserved workers (comma-separated list)')
+    parser.add_option('--limit', dest='limits', type='string', default=None,
+                      help='max number of tasks of a given name to run at once across all taskd processes, '
+                      'e.g. allura.tasks.repo_tasks.refresh=2 (can be comma-separated list)')
+    parser.add_option('--max-tasks', dest='max_tasks', type='int', default=0,
+                      help='restart a worker after it has handled this many tasks')
+    parser.add_option('--max-memory', dest='max_memory', type='int', default=0,
+                      help='restart a worker after a task once its memory use (max RSS) exceeds this many MB')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='claim and run up to this many ready --batch-tasks of the same name at once '
+                      '(default: 1, no batching)')
+    parser.add_option('--batch-tasks', dest='batch_tasks', type='string',
+                      default='allura.tasks.index_tasks.add_artifacts,allura.tasks.notification_tasks.notify,'
+                      'allura.tasks.mail_tasks.sendsimplemail',
+                      help='names of the small tasks which may be run in batches (comma-separated list)')
+
+    supervised = False
+    task_limits = {}
 
     def command(self):
         setproctitle('taskd')
         self.basic_setup()
         self.keep_running = True
         self.restart_when_done = False
+        self.task_limits = self._parse_limits(self.options.limits)
         base.log.info('Starting taskd, pid %s' % os.getpid())
         signal.signal(signal.SIGHUP, self.graceful_restart)
         signal.signal(signal.SIGTERM, self.graceful_stop)
@@ -77,7 +107,100 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+        if self.options.workers > 1:
+            self.supervisor()
+        else:
+            self.worker()
+
+    def _parse_limits(self, limits):
+        '''Parse --limit values like "a.b.c=2,d.e.f=1" into {task name: limit}'''
+        result = {}
+        for limit in (limits or '').split(','):
+            if not limit.strip():
+                continue
+            task_name, value = limit.rsplit('=', 1)
+            result[task_name.strip()] = int(value)
+        return result
+
+    def supervisor(self):
+        '''
+        Fork --workers worker processes, and start a new one whenever one
+        exits (e.g., after --max-tasks), until stopped.
+
+        SIGTERM and SIGHUP are passed on to the workers, so they finish their
+        current task first.  After SIGHUP the workers are replaced, and since
+        they load the app after being forked, they pick up any code changes.
+        '''
+        setproctitle('taskd supervisor')
+        signal.signal(signal.SIGHUP, self.restart_workers)
+        signal.signal(signal.SIGTERM, self.stop_workers)
+        num_reserved = min(self.options.reserved, self.options.workers)
+        roles = (['priority'] * num_reserved +
+                 ['any'] * (self.options.workers - num_reserved))
+        self.workers = {}  # {pid: (role, start time)}
+        for role in roles:
+            self.spawn_worker(role)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in self.workers:
+                continue
+            role, started = self.workers.pop(pid)
+            base.log.info('taskd worker pid %s exited with status %s', pid, status)
+            if self.keep_running:
+                if time.time() - started < 1:
+                    # don't spin if workers die right away, e.g. bad config
+                    time.sleep(1)
+                self.spawn_worker(role)
+        base.log.info('taskd supervisor pid %s stopping gracefully.' % os.getpid())
+
+    def spawn_worker(self, role):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = (role, time.time())
+            base.log.info('Started taskd worker pid %s (%s tasks)', pid, role)
+            return
+        # in the worker
+        self.supervised = True
+        self.workers = {}
+        signal.signal(signal.SIGHUP, self.graceful_restart)
+        signal.signal(signal.SIGTERM, self.graceful_stop)
+        setproctitle('taskd')
+        status = 0
+        try:
+            if role == 'priority':
+                self.worker(only=self.options.priority_tasks.split(','))
+            else:
+                self.worker()
+        except:
+            base.log.exception('taskd worker pid %s failed' % os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def restart_workers(self, signum, frame):
+        base.log.info(
+            'taskd supervisor pid %s recieved signal %s, restarting workers' %
+            (os.getpid(), signum))
+        self._signal_workers(signal.SIGTERM)
+
+    def stop_workers(self, signum, frame):
+        base.log.info(
+            'taskd supervisor pid %s recieved signal %s, stopping workers' %
+            (os.getpid(), signum))
+        self.keep_running = False
+        self._signal_workers(signal.SIGTERM)
+
+    def _signal_workers(self, signum):
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass  # already exited
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -98,15 +221,18 @@ def log_current_task(self, signum, frame):
         status_log.info(entry)
         base.log.info(entry)
 
-    def worker(self):
+    def worker(self, only=None):
         from allura import model as M
         name = '%s pid %s' % (os.uname()[1], os.getpid())
         wsgi_app = loadapp('config:%s#task' %
                            self.args[0], relative_to=os.getcwd())
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
-        only = self.options.only
-        if only:
-            only = only.split(',')
+        if only is None and self.options.only:
+            only = self.options.only.split(',')
+        limits = self.task_limits
+        batch_size = self.options.batch_size
+        batch_tasks = set(self.options.batch_tasks.split(','))
+        tasks_handled = 0
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -117,15 +243,39 @@ def start_response(status, headers, exc_info=None):
         def waitfunc_noq():
             time.sleep(poll_interval)
 
+        def waitfunc_wakeup():
+            # returns as soon as a task is posted, or after poll_interval
+            wakeup.wait(poll_interval)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
-                    return func()
+                    if index_buffer is not None:
+                        # nothing else to do, so don't hold on to documents
+                        index_buffer.flush()
+                    func()
+                    if limits:
+                        # go back and see which tasks are at their limit now
+                        raise StopIteration
                 else:
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        index_buffer = None
+        if asbool(pylons.config.get('solr.batch', False)):
+            from allura.lib.app_globals import Globals
+            from allura.lib.solr import make_index_buffer_from_config
+            app_globals = Globals()
+            index_buffer = make_index_buffer_from_config(
+                app_globals.solr, release=M.MonQTask.complete_held)
+            app_globals.solr_index_buffer = index_buffer
+
+        if asbool(pylons.config.get('monq.wakeup', False)):
+            from allura.model.monq_model import TaskWakeup
+            wakeup = TaskWakeup(only=only)
+            waitfunc = waitfunc_wakeup
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
         while self.keep_running:
             try:
@@ -133,10 +283,19 @@ def waitfunc_checks_running():
                     self.task = M.MonQTask.get(
                         process=name,
                         waitfunc=waitfunc,
-                        only=only)
+                        only=only,
+                        exclude=self._tasks_at_limit(limits))
+                    if self.task and self._over_limit(self.task, limits):
+                        self.task = None
                     if self.task:
-                        with(proctitle("taskd:{0}:{1}".format(
-                                self.task.task_name, self.task._id))):
+                        tasks = None
+                        if (batch_size > 1 and self.task.task_name in batch_tasks
+                                and self.task.task_name not in limits):
+                            tasks = M.MonQTask.claim_batch(
+                                self.task, name, batch_size)
+                        with(proctitle("taskd:{0}:{1}{2}".format(
+                                self.task.task_name, self.task._id,
+                                ' (+%d)' % (len(tasks) - 1) if tasks else ''))):
                             # Build the (fake) request
                             request_path = '/--%s--/%s/' % (self.task.task_name,
                                                             self.task._id)
@@ -144,10 +303,17 @@ def waitfunc_checks_running():
                                               base_url=tg.config['base_url'].rstrip(
                                                   '/') + request_path,
                                               environ={'task': self.task,
+                                                       'tasks': tasks,
                                                        'nocapture': self.options.nocapture,
                                                        })
                             list(wsgi_app(r.environ, start_response))
                             self.task = None
+                        tasks_handled += len(tasks) if tasks else 1
+                        if index_buffer is not None:
+                            index_buffer.flush_if_due()
+                        if self._should_restart(tasks_handled):
+                            self.keep_running = False
+                            self.restart_when_done = True
             except Exception as e:
                 if self.keep_running:
                     base.log.exception(
@@ -155,12 +321,59 @@ def waitfunc_checks_running():
                     time.sleep(10)
                 else:
                     base.log.exception('taskd error %s' % e)
+        if index_buffer is not None:
+            try:
+                index_buffer.flush()
+            except Exception:
+                base.log.exception('taskd pid %s could not send %s documents to solr',
+                                   os.getpid(), len(index_buffer))
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
-        if self.restart_when_done:
+        # a supervised worker just exits, and the supervisor starts another
+        if self.restart_when_done and not self.supervised:
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
+    def _tasks_at_limit(self, limits):
+        '''Names of the tasks that already have their --limit running'''
+        from allura import model as M
+        return [task_name for task_name, limit in limits.iteritems()
+                if M.MonQTask.query.find(dict(
+                    state='busy', task_name=task_name)).count() >= limit]
+
+    def _over_limit(self, task, limits):
+        '''
+        Check that claiming task didn't take its name over its --limit (when
+        several processes claim one at the same time).  If it did, put it
+        back to be picked up later.
+        '''
+        from allura import model as M
+        limit = limits.get(task.task_name)
+        if limit is None:
+            return False
+        busy = M.MonQTask.query.find(dict(
+            state='busy', task_name=task.task_name)).count()
+        if busy <= limit:
+            return False
+        M.MonQTask.query.update(
+            dict(_id=task._id, state='busy'),
+            {'$set': dict(state='ready', process=None)})
+        return True
+
+    def _should_restart(self, tasks_handled):
+        if self.options.max_tasks and tasks_handled >= self.options.max_tasks:
+            base.log.info('taskd pid %s handled %s tasks, restarting',
+                          os.getpid(), tasks_handled)
+            return True
+        if self.options.max_memory:
+            # ru_maxrss is in KB on linux
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+            if max_rss >= self.options.max_memory:
+                base.log.info('taskd pid %s is using %sMB, restarting',
+                              os.getpid(), max_rss)
+                return True
+        return False
+
 
 class TaskCommand(base.Command):
     summary = 'Task command'
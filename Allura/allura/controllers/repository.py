@@ -17,14 +17,14 @@
 
 import os
 import logging
-import difflib
 from datetime import datetime
 from urllib import quote, unquote
 from collections import defaultdict, OrderedDict
 
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request, response
+from pylons.controllers.util import etag_cache
 from webob import exc
 import tg
 from tg import redirect, expose, flash, validate
@@ -40,6 +40,7 @@
 from allura.lib import utils
 from allura.lib import helpers as h
 from allura.lib import widgets as w
+from allura.lib.commit_graph import timestamp
 from allura.lib.decorators import require_post
 from allura.lib.diff import HtmlSideBySideDiff
 from allura.lib.security import require_access, require_authenticated, has_access
@@ -257,10 +258,15 @@ def commit_browser_data(self, start=None, limit=None, **kw):
         parents = {}
         children = defaultdict(list)
         dates = {}
-        for row, (oid, ci) in enumerate(commits_by_id.iteritems()):
-            parents[oid] = list(ci.parent_ids)
-            dates[oid] = ci.committed.date
-            for p_oid in ci.parent_ids:
+        graph = c.app.repo.commit_graph
+        for oid, ci in commits_by_id.iteritems():
+            if graph is not None and oid in graph:
+                parents[oid] = graph.parents(oid)
+                dates[oid] = graph.timestamp(oid)
+            else:
+                parents[oid] = list(ci.parent_ids)
+                dates[oid] = timestamp(ci.committed.date)
+            for p_oid in parents[oid]:
                 children[p_oid].append(oid)
         result = []
         row = 0
@@ -640,6 +646,9 @@ class CommitBrowser(BaseController):
 
     def __init__(self, revision):
         self._revision = revision
+        if not getattr(c, 'model_cache', None):
+            # share one cache for the whole request, so its stats get logged
+            c.model_cache = M.repository.ModelCache()
         self._commit = c.app.repo.commit(revision)
         c.revision = revision
         if self._commit is None:
@@ -845,6 +854,8 @@ def index(self, **kw):
 
     @expose()
     def raw(self, **kw):
+        # a blob's content never changes, so its id makes a strong etag
+        etag_cache(str(self._blob._id))
         content_type = self._blob.content_type.encode('utf-8')
         filename = self._blob.name.encode('utf-8')
         response.headers['Content-Type'] = ''
@@ -856,7 +867,32 @@ def raw(self, **kw):
         response.headers.add(
             'Content-Disposition',
             'attachment;filename="%s"' % filename)
-        return iter(self._blob)
+        response.headers['Accept-Ranges'] = 'bytes'
+        size = self._blob.size
+        start, stop = 0, size
+        byte_range = self._requested_range()
+        if byte_range is not None:
+            content_range = byte_range.content_range(size)
+            if content_range is None:
+                response.status_int = 416
+                response.headers['Content-Range'] = 'bytes */%d' % size
+                return ''
+            start, stop = content_range.start, content_range.stop
+            response.status_int = 206
+            response.headers['Content-Range'] = str(content_range)
+        response.content_length = stop - start
+        return self._blob.iter_bytes(start, stop)
+
+    def _requested_range(self):
+        '''The single byte range requested, if any (multiple ranges get the
+        whole blob, as does an If-Range for another version)'''
+        byte_range = request.range
+        if byte_range is None or len(byte_range.ranges) != 1:
+            return None
+        if_range = request.headers.get('If-Range')
+        if if_range and if_range != '"%s"' % self._blob._id:
+            return None
+        return byte_range
 
     def diff(self, prev_commit, fmt=None, prev_file=None, **kw):
         '''
@@ -880,8 +916,11 @@ def diff(self, prev_commit, fmt=None, prev_file=None, **kw):
             diff = "Cannot display: file marked as a binary type."
             return dict(a=a, b=b, diff=diff)
 
-        la = list(a)
-        lb = list(b)
+        max_size = asint(tg.config.get('scm.view.diff.max_file_size', 2 * 1024 * 1024))
+        if max(b.size, a.size if a else 0) > max_size:
+            diff = "Cannot display: file is too large to diff."
+            return dict(a=a, b=b, diff=diff)
+
         adesc = (u'a' + h.really_unicode(apath)).encode('utf-8')
         bdesc = (u'b' + h.really_unicode(b.path())).encode('utf-8')
 
@@ -892,9 +931,9 @@ def diff(self, prev_commit, fmt=None, prev_file=None, **kw):
             web_session.save()
         if fmt == 'sidebyside':
             hd = HtmlSideBySideDiff()
-            diff = hd.make_table(la, lb, adesc, bdesc)
+            diff = hd.make_table(list(a), list(b), adesc, bdesc)
         else:
-            diff = ''.join(difflib.unified_diff(la, lb, adesc, bdesc))
+            diff = ''.join(c.app.repo.unified_diff(a or None, b, adesc, bdesc))
         return dict(a=a, b=b, diff=diff)
 
 
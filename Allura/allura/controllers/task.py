@@ -28,6 +28,12 @@ class TaskController(object):
     def __call__(self, environ, start_response):
         task = environ['task']
         nocapture = environ['nocapture']
-        result = task(restore_context=False, nocapture=nocapture)
+        batch = environ.get('tasks')
+        if batch:
+            # several small tasks claimed together, see MonQTask.claim_batch
+            task.run_batch(batch, nocapture=nocapture)
+            result = None
+        else:
+            result = task(restore_context=False, nocapture=nocapture)
         start_response('200 OK', [])
         return [result]
@@ -742,9 +742,11 @@ def export(self, tools=None, with_attachments=False):
             ]).get('result')[0].get('total_size')
         except IndexError:
             total_size = 0
+        export_task = c.project.bulk_export_task()
         return {
             'tools': exportable_tools,
-            'status': c.project.bulk_export_status(),
+            'status': 'busy' if export_task else None,
+            'progress': export_task.progress if export_task else None,
             'total_size': round(total_size, 3)
         }
 
@@ -896,11 +898,18 @@ def export_status(self, **kw):
         """
         Check the status of a bulk export.
 
-        Returns an object containing only one key, `status`, whose value is
-        either `'busy'` or `'ready'`.
+        Returns an object containing a `status` key, whose value is either
+        `'busy'` or `'ready'`.  While an export is running, a `progress` key
+        tells how many of its tools are done, e.g.
+        `{"tools": 3, "finished": 1, "exported": ["wiki"]}`.
         """
-        status = c.project.bulk_export_status()
-        return {'status': status or 'ready'}
+        export_task = c.project.bulk_export_task()
+        if not export_task:
+            return {'status': 'ready'}
+        result = {'status': 'busy'}
+        if export_task.progress:
+            result['progress'] = export_task.progress
+        return result
 
     @expose('json:')
     @require_post()
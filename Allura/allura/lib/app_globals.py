@@ -29,7 +29,9 @@
 from subprocess import Popen, PIPE
 import os
 import time
+import threading
 import traceback
+from multiprocessing.pool import ThreadPool
 
 import activitystream
 import pkg_resources
@@ -41,9 +43,11 @@
 from tg import config
 from pylons import request
 from pylons import tmpl_context as c
+from pylons import app_globals as g
 from paste.deploy.converters import asbool, asint, aslist
 from pypeline.markup import markup as pypeline_markup
 from ming.odm import session
+from ming.orm import ThreadLocalORMSession
 
 import ew as ew_core
 import ew.jinja2_ew as ew
@@ -62,7 +66,7 @@
 from allura.lib import gravatar, plugin, utils
 from allura.lib import helpers as h
 from allura.lib.widgets import analytics
-from allura.lib.security import Credentials
+from allura.lib.security import Credentials, SecurityCache
 from allura.lib.solr import MockSOLR, make_solr_from_config
 from allura.model.session import artifact_orm_session
 
@@ -71,10 +75,112 @@
 log = logging.getLogger(__name__)
 
 
+def _markdown_cache_threshold():
+    threshold = config.get('markdown_cache_threshold')
+    try:
+        return float(threshold) if threshold else None
+    except ValueError:
+        log.warn('Skipping Markdown caching - The value for config param '
+                 '"markdown_cache_threshold" must be a float.')
+        return None
+
+
+class MarkdownRenderCache(object):
+
+    '''
+    Rendered markdown shared by all the requests in a process, in an LRU of up
+    to ``max_entries``, and between processes through memcached when
+    ``shared`` (a ``pylibmc.ThreadMappedPool``) is given.  Set up as
+    ``g.markdown_render_cache`` when ``markdown_render_cache`` is enabled, and
+    used by :meth:`ForgeMarkdown.shared_convert`.
+
+    Entries are kept for ``ttl`` seconds.  Content with ``[[macros]]`` depends
+    on more than its source (other pages, project lists, permissions), so it
+    is kept for ``macro_ttl`` seconds instead.  Content with artifact links
+    isn't kept at all (see :meth:`ForgeMarkdown.shared_convert`).
+    '''
+
+    def __init__(self, max_entries=10000, ttl=3600, macro_ttl=60, shared=None):
+        self.ttl = ttl
+        self.macro_ttl = macro_ttl
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._entries = utils.TTLCache(max_entries)
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _shared_key(self, key):
+        # memcached keys are limited to 250 chars, without spaces
+        return 'allura/markdown/' + hashlib.md5(repr(key)).hexdigest()
+
+    def _shared_get(self, key):
+        try:
+            with self.shared.reserve() as mc:
+                return mc.get(self._shared_key(key))
+        except Exception:
+            log.warn('Could not read rendered markdown from memcached', exc_info=True)
+
+    def _shared_set(self, key, html, ttl):
+        try:
+            with self.shared.reserve() as mc:
+                mc.set(self._shared_key(key), html, time=ttl)
+        except Exception:
+            log.warn('Could not store rendered markdown in memcached', exc_info=True)
+
+    def get(self, key, render, ttl, keep=None):
+        '''
+        Return the html cached for ``key``, or call ``render()`` for it and
+        keep it for ``ttl`` seconds (unless ``keep()`` returns False)
+        '''
+        html = self._entries.get(key)
+        if html is not None:
+            with self._lock:
+                self.hits += 1
+            return html
+        if self.shared is not None:
+            html = self._shared_get(key)
+        if html is None:
+            with self._lock:
+                self.misses += 1
+            html = render()
+            if keep is not None and not keep():
+                return html
+            if self.shared is not None:
+                self._shared_set(key, html, ttl)
+        else:
+            with self._lock:
+                self.shared_hits += 1
+        self._entries.set(key, html, ttl)
+        return html
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return dict(
+                hits=self.hits,
+                shared_hits=self.shared_hits,
+                misses=self.misses,
+                hit_rate=round(float(self.hits + self.shared_hits) / lookups, 3) if lookups else None,
+                size=len(self._entries),
+            )
+
+
 class ForgeMarkdown(markdown.Markdown):
 
+    # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+    bugfix_rev = 4
+    # which converter this is, in g.markdown_render_cache keys (see Globals.forge_markdown)
+    cache_kind = 'markdown'
+
+    def over_render_limit(self, source):
+        return len(source) > asint(config.get('markdown_render_max_length', 40000))
+
     def convert(self, source, render_limit=True):
-        if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
+        if render_limit and self.over_render_limit(source):
             # if text is too big, markdown can take a long time to process it,
             # so we return it as a plain text
             log.info('Text is too big. Skipping markdown processing')
@@ -90,24 +196,76 @@ def convert(self, source, render_limit=True):
             return h.html.literal(u"""<p><strong>ERROR!</strong> The markdown supplied could not be parsed correctly.
             Did you forget to surround a code snippet with "~~~~"?</p><pre>%s</pre>""" % escaped)
 
+    def render_cache_key(self, source, md5=None):
+        """Return the ``g.markdown_render_cache`` key for rendering ``source``
+        in the current context.
+
+        Relative and short links depend on the current project and tool, and
+        macros on the current user too.
+        """
+        if md5 is None:
+            md5 = hashlib.md5(source.encode('utf-8')).hexdigest()
+        project = getattr(c, 'project', None)
+        app_config = getattr(getattr(c, 'app', None), 'config', None)
+        key = (self.cache_kind, md5,
+               getattr(project, '_id', None), getattr(app_config, '_id', None),
+               self.bugfix_rev)
+        if '[[' in source:
+            key += (getattr(getattr(c, 'user', None), '_id', None),)
+        return key
+
+    def shared_convert(self, source, render_limit=True):
+        """Convert markdown ``source`` to html like :meth:`convert`, sharing the
+        result with other requests through ``g.markdown_render_cache`` when
+        it is enabled.
+
+        Html with artifact links isn't shared, since it changes with the
+        artifacts (e.g., when they're closed, deleted or created).
+
+        Don't use this if you need anything else from the conversion, like the
+        links collected by the tree processors.
+        """
+        cache = getattr(g, 'markdown_render_cache', None)
+        if cache is None or (render_limit and self.over_render_limit(source)):
+            return self.convert(source, render_limit=render_limit)
+        ttl = cache.macro_ttl if '[[' in source else cache.ttl
+        html = cache.get(self.render_cache_key(source),
+                         lambda: self.convert(source, render_limit=False),
+                         ttl,
+                         keep=lambda: not self.has_artifact_links())
+        return h.html.literal(html)
+
+    def has_artifact_links(self):
+        '''True if the last conversion rendered links to artifacts'''
+        return any(getattr(ext, 'artifact_links', None)
+                   for ext in self.registeredExtensions)
+
     def cached_convert(self, artifact, field_name):
         """Convert ``artifact.field_name`` markdown source to html, caching
         the result if the render time is greater than the defined threshold.
 
         """
         source_text = getattr(artifact, field_name)
-        # Check if contents macro and never cache
+        # Check if contents macro and never cache on the artifact
         if "[[" in source_text:
-            return self.convert(source_text)
+            return self.shared_convert(source_text)
         cache_field_name = field_name + '_cache'
         cache = getattr(artifact, cache_field_name, None)
         if not cache:
             log.warn(
                 'Skipping Markdown caching - Missing cache field "%s" on class %s',
                 field_name, artifact.__class__.__name__)
-            return self.convert(source_text)
+            return self.shared_convert(source_text)
 
-        bugfix_rev = 4  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+        # rendered earlier in this request (see Globals.prefetch_markdown), but
+        # quickly enough not to be saved.  Plain ming Objects (e.g. old versions
+        # of artifacts) have no __dict__ to keep it in.
+        rendered_key = (field_name, self.cache_kind)
+        rendered = getattr(artifact, '__dict__', {}).get('_rendered_markdown', {})
+        if rendered_key in rendered and rendered[rendered_key][0] == source_text:
+            return rendered[rendered_key][1]
+
+        bugfix_rev = self.bugfix_rev
         md5 = None
         # If a cached version exists and it is valid, return it.
         if cache.md5 is not None:
@@ -117,17 +275,10 @@ def cached_convert(self, artifact, field_name):
 
         # Convert the markdown and time the result.
         start = time.time()
-        html = self.convert(source_text, render_limit=False)
+        html = self.shared_convert(source_text, render_limit=False)
         render_time = time.time() - start
 
-        threshold = config.get('markdown_cache_threshold')
-        try:
-            threshold = float(threshold) if threshold else None
-        except ValueError:
-            threshold = None
-            log.warn('Skipping Markdown caching - The value for config param '
-                     '"markdown_cache_threshold" must be a float.')
-
+        threshold = _markdown_cache_threshold()
         if threshold is not None and render_time > threshold:
             # Save the cache
             if md5 is None:
@@ -144,6 +295,9 @@ def cached_convert(self, artifact, field_name):
                 with utils.skip_mod_date(artifact.__class__), \
                      utils.skip_last_updated(artifact.__class__):
                     sess.flush(artifact)
+        elif hasattr(artifact, '__dict__'):
+            rendered[rendered_key] = (source_text, html)
+            artifact.__dict__['_rendered_markdown'] = rendered
         return html
 
 
@@ -177,6 +331,28 @@ def __init__(self):
         else:  # pragma no cover
             log.warning('Solr config not set; using in-memory MockSOLR')
             self.solr = self.solr_short_timeout = MockSOLR()
+        # set up by taskd when solr.batch is enabled
+        self.solr_index_buffer = None
+        # role closures and ACL checks shared across requests
+        if asbool(config.get('security.cache', False)):
+            self.security_cache = SecurityCache(
+                ttl=asint(config.get('security.cache.ttl', 60)),
+                max_entries=asint(config.get('security.cache.max_entries', 100000)))
+        else:
+            self.security_cache = None
+        # rendered markdown shared across requests
+        if asbool(config.get('markdown_render_cache', False)):
+            shared = None
+            if asbool(config.get('markdown_render_cache.memcached', False)) and config.get('memcached_host'):
+                import pylibmc
+                shared = pylibmc.ThreadMappedPool(pylibmc.Client([config['memcached_host']]))
+            self.markdown_render_cache = MarkdownRenderCache(
+                max_entries=asint(config.get('markdown_render_cache.max_entries', 10000)),
+                ttl=asint(config.get('markdown_render_cache.ttl', 3600)),
+                macro_ttl=asint(config.get('markdown_render_cache.macro_ttl', 60)),
+                shared=shared)
+        else:
+            self.markdown_render_cache = None
 
         # Load login/logout urls; only used for customized logins
         self.login_url = config.get('auth.login_url', '/auth/')
@@ -422,17 +598,119 @@ def highlight(self, text, lexer=None, filename=None):
 
     def forge_markdown(self, **kwargs):
         '''return a markdown.Markdown object on which you can call convert'''
-        return ForgeMarkdown(
+        md = ForgeMarkdown(
             # 'fenced_code'
             extensions=['fenced_code', 'codehilite',
                         ForgeExtension(
                             **kwargs), EmojiExtension(), 'tables', 'toc', 'nl2br', 'markdown_checklist.extension'],
             output_format='html4')
+        md.cache_kind = 'markdown' + ''.join(
+            ':%s=%s' % item for item in sorted(kwargs.items()))
+        return md
 
     @property
     def markdown(self):
         return self.forge_markdown()
 
+    def render_markdown(self, sources, converter='markdown', render_limit=False):
+        '''Convert each of the markdown ``sources`` to html, with a pool of up to
+        ``markdown_render_workers`` threads, and return an ``(html, render
+        time)`` pair for each.
+
+        ``converter`` names the property to convert with, e.g. ``markdown_wiki``;
+        each thread gets its own.  The threads run in the current request's
+        context.
+        '''
+        converters = threading.local()
+
+        def convert(source):
+            md = getattr(converters, 'md', None)
+            if md is None:
+                md = converters.md = getattr(self, converter)
+            md.reset()
+            start = time.time()
+            html = md.shared_convert(source, render_limit=render_limit)
+            return html, time.time() - start
+
+        workers = min(asint(config.get('markdown_render_workers', 4)), len(sources))
+        if workers < 2:
+            return map(convert, sources)
+        # the worker threads see this thread's pylons objects
+        proxies = [(g, self)]
+        for proxy in (c, request):
+            try:
+                proxies.append((proxy, proxy._current_obj()))
+            except TypeError:
+                pass  # not in a request, e.g. in a task
+
+        def convert_in_context(source):
+            # with its own role cache, which isn't thread-safe
+            pushed = proxies + [(allura.credentials, Credentials())]
+            for proxy, obj in pushed:
+                proxy._push_object(obj)
+            try:
+                return convert(source)
+            finally:
+                # forget what the links loaded, this thread's sessions are its own
+                ThreadLocalORMSession.close_all()
+                for proxy, obj in reversed(pushed):
+                    proxy._pop_object(obj)
+
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(convert_in_context, sources)
+        finally:
+            pool.close()
+            pool.join()
+
+    def prefetch_markdown(self, artifacts, field_name, converter='markdown'):
+        '''Render ``artifact.field_name`` for all the ``artifacts`` that
+        :meth:`ForgeMarkdown.cached_convert` has no valid cache for, all at once
+        with :meth:`render_markdown`, so a page of posts takes about as long
+        as its slowest one.
+
+        Like :meth:`~ForgeMarkdown.cached_convert`, content with macros is left
+        to it, and so is content longer than ``markdown_render_max_length``,
+        which would hold up a thread.  The renders slower than
+        ``markdown_cache_threshold`` are saved in their caches together
+        afterwards, without changing the artifacts' ``mod_date``; the html of
+        the others is kept on the artifacts for the rest of the request.
+        '''
+        cache_field_name = field_name + '_cache'
+        rendered_key = (field_name, getattr(self, converter).cache_kind)
+        bugfix_rev = ForgeMarkdown.bugfix_rev
+        max_length = asint(config.get('markdown_render_max_length', 40000))
+        todo = []
+        for artifact in artifacts:
+            source_text = getattr(artifact, field_name)
+            cache = getattr(artifact, cache_field_name, None)
+            if not source_text or not cache or '[[' in source_text or len(source_text) > max_length:
+                continue
+            md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == bugfix_rev:
+                continue
+            todo.append((artifact, source_text, md5))
+        if not todo:
+            return
+
+        results = self.render_markdown([source for _, source, _ in todo], converter)
+        threshold = _markdown_cache_threshold()
+        to_save = []
+        for (artifact, source_text, md5), (html, render_time) in zip(todo, results):
+            if threshold is not None and render_time > threshold:
+                cache = getattr(artifact, cache_field_name)
+                cache.md5, cache.html, cache.render_time = md5, html, render_time
+                cache.fix7528 = bugfix_rev
+                to_save.append(artifact)
+            else:
+                rendered = artifact.__dict__.setdefault('_rendered_markdown', {})
+                rendered[rendered_key] = (source_text, html)
+        for cls in set(artifact.__class__ for artifact in to_save):
+            with utils.skip_mod_date(cls), utils.skip_last_updated(cls):
+                for artifact in to_save:
+                    if artifact.__class__ is cls:
+                        session(artifact).flush(artifact)
+
     @property
     def markdown_wiki(self):
         if c.project.is_nbhd_project:
@@ -448,8 +726,10 @@ def markdown_commit(self):
 
         """
         app = getattr(c, 'app', None)
-        return ForgeMarkdown(extensions=[CommitMessageExtension(app), EmojiExtension(), 'nl2br'],
-                             output_format='html4')
+        md = ForgeMarkdown(extensions=[CommitMessageExtension(app), EmojiExtension(), 'nl2br'],
+                           output_format='html4')
+        md.cache_kind = 'commit'
+        return md
 
     @property
     def production_mode(self):
@@ -0,0 +1,424 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+'''
+A compact on-disk index of a repository's commit graph, similar in spirit to
+git's commit-graph files.
+
+The index is a chain of layer files, listed oldest first in a small chain
+file.  A refresh appends a layer with just the new commits, so its cost
+doesn't grow with the size of the repo.  Layers are merged into the layer
+below them when they get to at least half its size, which keeps the number
+of layers logarithmic in the number of commits.
+
+The commits of all the layers are numbered in order: the first layer's
+commits come first, then the second's, and so on.  Each layer is laid out as:
+
+    header          magic, version, number of commits, number of commits
+                    in the layers below it
+    oid table       20-byte binary commit ids, sorted
+    record table    one record per commit, in the same order as the oid table:
+                    first parent, second parent, generation, commit date
+    extra edges     parent positions for commits with more than two parents
+
+Parents are stored as positions in the whole chain, so they can be in the
+same layer or in a lower one.  If a commit has more than two parents, its
+second parent field has the EXTRA_EDGES bit set and holds the position in its
+layer's extra edge list of its remaining parents, the last of which has the
+LAST_EDGE bit set.
+
+The generation number of a root commit is 1, and of any other commit is one
+more than the highest generation of its parents, so a commit can never be an
+ancestor of a commit with a lower or equal generation.
+
+Commit ids must be 40 character hex strings (i.e., git or hg ids).  Layers
+are memory-mapped when loaded.  New layers are written to their own files
+and the chain file is replaced atomically, so readers always see a complete
+graph.
+'''
+
+import os
+import mmap
+import heapq
+import struct
+import hashlib
+import logging
+import calendar
+import binascii
+import tempfile
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+MAGIC = 'ACGR'
+VERSION = 2
+CHAIN_MAGIC = 'ACGC 1'
+HEADER = struct.Struct('>4sIII')
+RECORD = struct.Struct('>IIIq')  # dates can be before 1970
+EDGE = struct.Struct('>I')
+OID_SIZE = 20
+NO_PARENT = 0xffffffff
+EXTRA_EDGES = 0x80000000
+LAST_EDGE = 0x80000000
+
+
+def timestamp(date):
+    '''Convert a naive UTC datetime to seconds since the epoch'''
+    return calendar.timegm(date.utctimetuple())
+
+
+class _Layer(object):
+
+    '''One memory-mapped layer file of a commit graph'''
+
+    def __init__(self, name, data):
+        magic, version, num_commits, base = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a commit graph (version %d) file' % VERSION)
+        self.name = name
+        self.base = base
+        self._data = data
+        self._num_commits = num_commits
+        self._oids_start = HEADER.size
+        self._records_start = self._oids_start + num_commits * OID_SIZE
+        self._edges_start = self._records_start + num_commits * RECORD.size
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+    def __len__(self):
+        return self._num_commits
+
+    def find(self, binsha):
+        lo, hi = 0, self._num_commits
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_binsha = self.binsha(mid)
+            if mid_binsha < binsha:
+                lo = mid + 1
+            elif mid_binsha > binsha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def binsha(self, i):
+        start = self._oids_start + i * OID_SIZE
+        return self._data[start:start + OID_SIZE]
+
+    def record(self, i):
+        return RECORD.unpack_from(self._data, self._records_start + i * RECORD.size)
+
+    def edge(self, pos):
+        return EDGE.unpack_from(self._data, self._edges_start + pos * EDGE.size)[0]
+
+
+class CommitGraph(object):
+
+    '''
+    Read-only view of a commit graph.  Use :meth:`load` to open one
+    and :meth:`write` to create or update one.
+    '''
+
+    def __init__(self, layers):
+        self._layers = layers  # oldest first
+        self._num_commits = sum(len(layer) for layer in layers)
+
+    @classmethod
+    def load(cls, path):
+        '''Memory-map the commit graph whose chain file is at path.  Returns
+        None if there isn't one, or if it can't be read.'''
+        names = cls._read_chain(path)
+        if names is None:
+            return None
+        dirname = os.path.dirname(path)
+        layers = []
+        try:
+            for name in names:
+                with open(os.path.join(dirname, name), 'rb') as fp:
+                    data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    layer = _Layer(name, data)
+                except (ValueError, struct.error):
+                    data.close()
+                    raise
+                layers.append(layer)
+                if layer.base != sum(len(l) for l in layers[:-1]):
+                    raise ValueError('Layer %s is out of place' % name)
+        except (IOError, OSError, ValueError, struct.error):
+            log.warn('Ignoring invalid commit graph %s', path)
+            for layer in layers:
+                layer.close()
+            return None
+        return cls(layers)
+
+    @classmethod
+    def _read_chain(cls, path):
+        try:
+            with open(path, 'rb') as fp:
+                lines = fp.read().splitlines()
+        except (IOError, OSError):
+            return None
+        if not lines or lines[0] != CHAIN_MAGIC:
+            log.warn('Ignoring invalid commit graph %s', path)
+            return None
+        return lines[1:]
+
+    def close(self):
+        for layer in self._layers:
+            layer.close()
+
+    def __len__(self):
+        return self._num_commits
+
+    def __contains__(self, oid):
+        return self._find(oid) is not None
+
+    def __iter__(self):
+        '''Iterate over all commit ids, in sorted order'''
+        return heapq.merge(*[
+            (binascii.hexlify(layer.binsha(i)) for i in xrange(len(layer)))
+            for layer in self._layers])
+
+    def _find(self, oid):
+        try:
+            binsha = binascii.unhexlify(oid)
+        except (TypeError, binascii.Error):
+            return None
+        for layer in reversed(self._layers):
+            i = layer.find(binsha)
+            if i is not None:
+                return layer.base + i
+        return None
+
+    def _index(self, oid):
+        i = self._find(oid)
+        if i is None:
+            raise KeyError(oid)
+        return i
+
+    def _layer(self, i):
+        '''The layer with commit i, and its position in the layer'''
+        for layer in reversed(self._layers):
+            if i >= layer.base:
+                return layer, i - layer.base
+        raise IndexError(i)
+
+    def _oid(self, i):
+        layer, j = self._layer(i)
+        return binascii.hexlify(layer.binsha(j))
+
+    def _record(self, i):
+        layer, j = self._layer(i)
+        return layer.record(j)
+
+    def _parent_indexes(self, i):
+        layer, j = self._layer(i)
+        parent1, parent2, gen, date = layer.record(j)
+        if parent1 == NO_PARENT:
+            return []
+        if parent2 == NO_PARENT:
+            return [parent1]
+        if not parent2 & EXTRA_EDGES:
+            return [parent1, parent2]
+        parents = [parent1]
+        pos = parent2 & ~EXTRA_EDGES
+        while True:
+            edge = layer.edge(pos)
+            parents.append(edge & ~LAST_EDGE)
+            if edge & LAST_EDGE:
+                return parents
+            pos += 1
+    def parents(self, oid):
+        return [self._oid(p) for p in self._parent_indexes(self._index(oid))]
+
+    def generation(self, oid):
+        return self._record(self._index(oid))[2]
+
+    def timestamp(self, oid):
+        '''Commit date of oid, in seconds since the epoch'''
+        return self._record(self._index(oid))[3]
+
+    def date(self, oid):
+        return datetime.utcfromtimestamp(self.timestamp(oid))
+
+    def log(self, revs, limit=None):
+        '''
+        Yield the ids of the commits reachable from revs (a list of commit
+        ids), newest commit date first, the same way as ``git log``.
+        '''
+        heap = []
+        seen = set()
+        for oid in revs:
+            i = self._index(oid)
+            if i not in seen:
+                seen.add(i)
+                heapq.heappush(heap, (-self._record(i)[3], len(seen), i))
+        count = 0
+        while heap and (limit is None or count < limit):
+            _, _, i = heapq.heappop(heap)
+            yield self._oid(i)
+            count += 1
+            for p in self._parent_indexes(i):
+                if p not in seen:
+                    seen.add(p)
+                    heapq.heappush(heap, (-self._record(p)[3], len(seen), p))
+
+    def is_ancestor(self, ancestor, oid):
+        '''
+        Return True if ancestor is reachable from oid (a commit is considered
+        its own ancestor).  Uses generation numbers to avoid walking past
+        commits that are too old to lead to ancestor.
+        '''
+        target = self._index(ancestor)
+        target_gen = self._record(target)[2]
+        to_visit = [self._index(oid)]
+        seen = set(to_visit)
+        while to_visit:
+            i = to_visit.pop()
+            if i == target:
+                return True
+            for p in self._parent_indexes(i):
+                if p not in seen and self._record(p)[2] >= target_gen:
+                    seen.add(p)
+                    to_visit.append(p)
+        return False
+
+    def entries(self, first_layer=0):
+        '''Yield (oid, parent ids, generation, timestamp) for every commit of
+        the layers from first_layer up'''
+        for layer in self._layers[first_layer:]:
+            for j in xrange(len(layer)):
+                i = layer.base + j
+                yield (self._oid(i),
+                       [self._oid(p) for p in self._parent_indexes(i)],
+                       layer.record(j)[2], layer.record(j)[3])
+
+    @classmethod
+    def write(cls, path, commits, base=None):
+        '''
+        Add a layer to the commit graph at path, and return it loaded.  Any
+        commit graph there that isn't base is replaced.
+
+        commits is a dict of {oid: (parent_ids, timestamp)} for the commits
+        to add to the commits already in base (a CommitGraph, optional).
+        Generation numbers are only computed for the new commits, using the
+        generations already stored in base for their parents.  Parents which
+        are in neither are left out.
+
+        The top layers of base are merged into the new one while they have
+        less than twice as many commits as it.
+        '''
+        layers = list(base._layers) if base is not None else []
+        entries = dict((oid, (parent_ids, None, date))
+                       for oid, (parent_ids, date) in commits.iteritems()
+                       if base is None or oid not in base)
+        new_oids = list(entries)
+        keep = len(layers)
+        while keep and len(layers[keep - 1]) < 2 * len(entries):
+            keep -= 1
+            for oid, parent_ids, gen, date in base.entries(keep):
+                entries.setdefault(oid, (parent_ids, gen, date))
+        below = cls(layers[:keep])
+
+        missing = set()
+        for oid in new_oids:
+            missing.update(p for p in entries[oid][0]
+                           if p not in entries and p not in below)
+        if missing:
+            log.warn('Commit graph %s is missing %d parent commits', path, len(missing))
+
+        # compute generations of the new commits, parents first
+        generations = dict((oid, gen) for oid, (parents, gen, date)
+                           in entries.iteritems() if gen is not None)
+
+        def generation(oid):
+            if oid in generations:
+                return generations[oid]
+            return below.generation(oid)
+
+        for oid in new_oids:
+            to_visit = [oid]
+            while to_visit:
+                cur = to_visit[-1]
+                if cur in generations:
+                    to_visit.pop()
+                    continue
+                parents = [p for p in entries[cur][0] if p not in missing]
+                pending = [p for p in parents if p in entries and p not in generations]
+                if pending:
+                    to_visit.extend(pending)
+                else:
+                    generations[cur] = 1 + max(
+                        [generation(p) for p in parents] or [0])
+                    to_visit.pop()
+
+        oids = sorted(entries)
+        index = dict((oid, len(below) + i) for i, oid in enumerate(oids))
+        records = []
+        edges = []
+        for oid in oids:
+            parent_ids, gen, date = entries[oid]
+            parent_idx = [index[p] if p in index else below._index(p)
+                          for p in parent_ids if p not in missing]
+            parent1 = parent2 = NO_PARENT
+            if parent_idx:
+                parent1 = parent_idx[0]
+            if len(parent_idx) == 2:
+                parent2 = parent_idx[1]
+            elif len(parent_idx) > 2:
+                parent2 = EXTRA_EDGES | len(edges)
+                edges.extend(parent_idx[1:-1])
+                edges.append(parent_idx[-1] | LAST_EDGE)
+            records.append(RECORD.pack(
+                parent1, parent2, generations[oid], date))
+
+        dirname = os.path.dirname(path)
+        old_names = cls._read_chain(path) or []
+        names = [layer.name for layer in layers[:keep]]
+        if oids:
+            oid_table = ''.join(binascii.unhexlify(oid) for oid in oids)
+            names.append('%s-%s.layer' % (
+                os.path.basename(path), hashlib.sha1(oid_table).hexdigest()))
+            cls._write_file(os.path.join(dirname, names[-1]), [
+                HEADER.pack(MAGIC, VERSION, len(oids), len(below)),
+                oid_table,
+                ''.join(records),
+                ''.join(EDGE.pack(e) for e in edges)])
+        cls._write_file(path, ['\n'.join([CHAIN_MAGIC] + names) + '\n'])
+        for name in set(old_names) - set(names):
+            try:
+                os.remove(os.path.join(dirname, name))
+            except OSError:
+                pass
+        return cls.load(path)
+
+    @classmethod
+    def _write_file(cls, path, chunks):
+        '''Write a file atomically'''
+        fd, tmp_path = tempfile.mkstemp(prefix='.commit-graph-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    fp.write(chunk)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
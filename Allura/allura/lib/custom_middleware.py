@@ -24,6 +24,7 @@
 from paste import fileapp
 from paste.deploy.converters import aslist
 from pylons import tmpl_context as c
+from pylons import app_globals as g
 from pylons.util import call_wsgi_application
 from timermiddleware import Timer, TimerMiddleware
 from webob import exc, Request
@@ -287,6 +288,7 @@ def timers(self):
         import markdown
         import ming
         import pymongo
+        import smtplib
         import socket
         import urllib2
         import activitystream
@@ -303,6 +305,8 @@ def timers(self):
                   activitystream.managers.ActivityManager, '*'),
             Timer('jinja', jinja2.Template, 'render', 'stream', 'generate'),
             Timer('markdown', markdown.Markdown, 'convert'),
+            Timer('mailbox.{method_name}', allura.model.notification.Mailbox,
+                  'deliver', '_claim_direct', '_load_notifications', 'fire'),
             Timer('ming', ming.odm.odmsession.ODMCursor, 'next',  # FIXME: this may captures timings ok, but is misleading for counts
                   debug_each_call=False),
             Timer('ming', ming.odm.odmsession.ODMSession,
@@ -333,6 +337,7 @@ def timers(self):
             Timer('socket_write', socket._fileobject, 'write', 'writelines',
                   'flush', debug_each_call=False),
             Timer('solr', pysolr.Solr, 'add', 'delete', 'search', 'commit'),
+            Timer('smtp', smtplib.SMTP, 'connect', 'sendmail', 'noop', 'quit'),
             Timer('template', genshi.template.Template, '_prepare', '_parse',
                   'generate'),
             Timer('urlopen', urllib2, 'urlopen'),
@@ -356,6 +361,19 @@ def timers(self):
     def before_logging(self, stat_record):
         if hasattr(c, "app") and hasattr(c.app, "config"):
             stat_record.add('request_category', c.app.config.tool_name.lower())
+        model_cache = getattr(c, 'model_cache', None)
+        if isinstance(model_cache, allura.model.repository.ModelCache):
+            stat_record.add('model_cache', model_cache.stats())
+        if hasattr(g, 'solr_index_buffer') and g.solr_index_buffer is not None:
+            stat_record.add('solr_index_buffer', g.solr_index_buffer.stats())
+        if hasattr(g, 'security_cache') and g.security_cache is not None:
+            stat_record.add('security_cache', g.security_cache.stats())
+        if hasattr(g, 'markdown_render_cache') and g.markdown_render_cache is not None:
+            stat_record.add('markdown_render_cache', g.markdown_render_cache.stats())
+        from allura.tasks.mail_tasks import smtp_client
+        smtp_stats = smtp_client.stats()
+        if any(smtp_stats.values()):  # only in processes which send mail
+            stat_record.add('smtp_client', smtp_stats)
         return stat_record
 
     def entry_point_timers(self):
@@ -61,6 +61,12 @@ def myotherfunc():
             # No email notifications will be sent for c.project during this task
             pass
 
+        @task(coalesce=True)
+        def index_things(thing_ids):
+            # Posting this while another index_things task is waiting to
+            # run adds thing_ids to that task (see MonQTask.post)
+            pass
+
     """
     def task_(func):
         def post(*args, **kwargs):
@@ -70,7 +76,8 @@ def post(*args, **kwargs):
                   kw.get('notifications_disabled') else h.null_contextmanager)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay,
+                                       coalesce=kw.get('coalesce', False))
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
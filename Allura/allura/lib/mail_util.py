@@ -18,6 +18,8 @@
 import re
 import logging
 import smtplib
+import socket
+import time
 import email.feedparser
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
@@ -245,8 +247,26 @@ def isvalid(addr):
 
 class SMTPClient(object):
 
+    """Sends mail over one SMTP connection, which is kept open and reused for
+    all the messages sent by this process.
+
+    Before reusing a connection that has been idle for `smtp_keepalive`
+    seconds, it is checked with a NOOP.  A connection is replaced after it has
+    sent `smtp_max_messages` messages, and a message to more than
+    `smtp_max_recipients` recipients is sent in several transactions.
+
+    If the connection turns out to be closed while sending, the message is
+    sent again on a new one.  Other errors (e.g. refused recipients) are
+    raised, so the message isn't sent twice.
+    """
+
     def __init__(self):
         self._client = None
+        self._used = None  # the connection _messages and _last_used are for
+        self._last_used = None
+        self._messages = 0
+        self.counts = dict(sent=0, failed=0, connects=0, noops=0)
+        self.send_time = 0.0
 
     def sendmail(
             self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message,
@@ -283,17 +303,60 @@ def sendmail(
             log.warning('No valid addrs in %s, so not sending mail',
                         map(unicode, addrs))
             return
+        max_recipients = asint(tg.config.get('smtp_max_recipients', 0))
+        chunk_size = max_recipients or len(smtp_addrs)
+        for i in range(0, len(smtp_addrs), chunk_size):
+            self._send(smtp_addrs[i:i + chunk_size], content)
+
+    def _send(self, smtp_addrs, content):
+        start = time.time()
         try:
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            try:
+                self._get_client().sendmail(
+                    config.return_path,
+                    smtp_addrs,
+                    content)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                log.info('SMTP connection lost, reconnecting')
+                self._connect()
+                self._client.sendmail(
+                    config.return_path,
+                    smtp_addrs,
+                    content)
         except:
+            self.counts['failed'] += 1
+            raise
+        finally:
+            self.send_time += time.time() - start
+        self.counts['sent'] += 1
+        self._messages += 1
+        self._last_used = time.time()
+
+    def _get_client(self):
+        """The open connection, after checking that it can still be used"""
+        if self._client is None:
             self._connect()
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
+            return self._client
+        if self._used is not self._client:
+            self._used = self._client
+            self._messages = 0
+            self._last_used = None
+        max_messages = asint(tg.config.get('smtp_max_messages', 100))
+        if max_messages and self._messages >= max_messages:
+            self.close()
+            self._connect()
+            return self._client
+        keepalive = float(tg.config.get('smtp_keepalive', 30))
+        if self._last_used is not None and time.time() - self._last_used > keepalive:
+            self.counts['noops'] += 1
+            try:
+                code = self._client.noop()[0]
+            except (smtplib.SMTPException, socket.error):
+                code = None
+            if code != 250:
+                self.close()
+                self._connect()
+        return self._client
 
     def _connect(self):
         if asbool(tg.config.get('smtp_ssl', False)):
@@ -313,4 +376,22 @@ def _connect(self):
                               tg.config['smtp_password'])
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
-        self._client = smtp_client
+        self._client = self._used = smtp_client
+        self._messages = 0
+        self._last_used = None
+        self.counts['connects'] += 1
+
+    def close(self):
+        if self._client is not None:
+            try:
+                self._client.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass  # already gone
+        self._client = None
+
+    def stats(self):
+        stats = dict(self.counts)
+        stats['send_time'] = round(self.send_time, 3)
+        if self.counts['sent']:
+            stats['avg_send_time'] = round(self.send_time / self.counts['sent'], 4)
+        return stats
@@ -44,7 +44,48 @@
 MACRO_PATTERN = r'\[\[([^\]\[]+)\]\]'
 
 
-class CommitMessageExtension(markdown.Extension):
+class ShortlinkLookupMixin(object):
+
+    """Looks up artifact links for :class:`ForgeLinkPattern`, keeping the
+    ones found in :attr:`shortlinks` for the current conversion.
+
+    :attr:`artifact_links` are the links rendered from artifacts (or as
+    missing ones) in the current conversion, so its output changes when
+    they do.
+
+    """
+
+    def reset(self):
+        self.forge_link_tree_processor.reset()
+        self.shortlinks = {}
+        self.artifact_links = set()
+
+    def resolve_shortlinks(self, links):
+        '''Look up the Shortlinks for links, and their ArtifactReferences and
+        artifacts, all at once'''
+        links = [link for link in links if link not in self.shortlinks]
+        if not links:
+            return
+        shortlinks = M.Shortlink.from_links(*links)
+        ref_ids = [s.ref_id for s in shortlinks.itervalues() if s]
+        arefs = {}
+        if ref_ids:
+            arefs = dict((aref._id, aref) for aref in M.ArtifactReference.query.find(
+                dict(_id={'$in': ref_ids})))
+            M.ArtifactReference.load_artifacts(arefs.values())
+        for link, shortlink in shortlinks.iteritems():
+            aref = arefs.get(shortlink.ref_id) if shortlink else None
+            self.shortlinks[link] = (shortlink, aref)
+
+    def lookup_shortlink(self, link):
+        '''Return (Shortlink, ArtifactReference) for a link, either of which
+        may be None'''
+        if link not in self.shortlinks:
+            self.resolve_shortlinks([link])
+        return self.shortlinks.get(link, (None, None))
+
+
+class CommitMessageExtension(ShortlinkLookupMixin, markdown.Extension):
 
     """Markdown extension for processing commit messages.
 
@@ -72,12 +113,18 @@ def __init__(self, app):
         markdown.Extension.__init__(self)
         self.app = app
         self._use_wiki = False
+        # link -> (Shortlink, ArtifactReference), for the current conversion
+        self.shortlinks = {}
+        self.artifact_links = set()
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
         # remove default preprocessors and add our own
         md.preprocessors.clear()
         md.preprocessors['trac_refs'] = PatternReplacingProcessor(TracRef1(), TracRef2(), TracRef3(self.app))
+        # commit messages rarely have artifact links, so they're looked up as
+        # they're rendered instead of all at once
+        md.preprocessors['shortlinks'] = ShortlinkPreprocessor(md, ext=self, resolve=False)
         # remove all inlinepattern processors except short refs and links
         md.inlinePatterns.clear()
         md.inlinePatterns["link"] = markdown.inlinepatterns.LinkPattern(markdown.inlinepatterns.LINK_RE, md)
@@ -94,9 +141,6 @@ def extendMarkdown(self, md, md_globals):
         md.postprocessors['add_custom_class'] = AddCustomClass()
         md.postprocessors['mark_safe'] = MarkAsSafe()
 
-    def reset(self):
-        self.forge_link_tree_processor.reset()
-
 
 class Pattern(object):
 
@@ -238,13 +282,16 @@ def run(self, lines):
         return new_lines
 
 
-class ForgeExtension(markdown.Extension):
+class ForgeExtension(ShortlinkLookupMixin, markdown.Extension):
 
     def __init__(self, wiki=False, email=False, macro_context=None):
         markdown.Extension.__init__(self)
         self._use_wiki = wiki
         self._is_email = email
         self._macro_context = macro_context
+        # link -> (Shortlink, ArtifactReference), for the current conversion
+        self.shortlinks = {}
+        self.artifact_links = set()
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
@@ -253,6 +300,7 @@ def extendMarkdown(self, md, md_globals):
         md.preprocessors['html_block'].markdown_in_raw = True
         md.preprocessors.add('plain_text_block', PlainTextPreprocessor(md), "_begin")
         md.preprocessors.add('macro_include', ForgeMacroIncludePreprocessor(md), '_end')
+        md.preprocessors.add('shortlinks', ShortlinkPreprocessor(md, ext=self), '_end')
         # this has to be before the 'escape' processor, otherwise weird
         # placeholders are inserted for escaped chars within urls, and then the
         # autolink can't match the whole url
@@ -272,9 +320,6 @@ def extendMarkdown(self, md, md_globals):
         md.postprocessors['add_custom_class'] = AddCustomClass()
         md.postprocessors['mark_safe'] = MarkAsSafe()
 
-    def reset(self):
-        self.forge_link_tree_processor.reset()
-
 
 class EmojiExtension(markdown.Extension):
 
@@ -348,10 +393,12 @@ def _expand_alink(self, link, is_link_with_brackets):
         if is_link_with_brackets:
             classes = 'alink'
         href = link
-        shortlink = M.Shortlink.lookup(link)
-        if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
+        shortlink, aref = self.ext.lookup_shortlink(link)
+        if shortlink or is_link_with_brackets:
+            self.ext.artifact_links.add(link)
+        if shortlink and aref and not getattr(aref.artifact, 'deleted', False):
             href = shortlink.url
-            if getattr(shortlink.ref.artifact, 'is_closed', False):
+            if getattr(aref.artifact, 'is_closed', False):
                 classes += ' strikethrough'
             self.ext.forge_link_tree_processor.alinks.append(shortlink)
         elif is_link_with_brackets:
@@ -359,10 +406,11 @@ def _expand_alink(self, link, is_link_with_brackets):
             classes += ' notfound'
         attach_link = link.split('/attachment/')
         if len(attach_link) == 2 and self.ext._use_wiki:
-            shortlink = M.Shortlink.lookup(attach_link[0])
-            if shortlink:
+            shortlink, aref = self.ext.lookup_shortlink(attach_link[0])
+            if shortlink and aref:
+                self.ext.artifact_links.add(link)
                 attach_status = ' notfound'
-                for attach in shortlink.ref.artifact.attachments:
+                for attach in aref.artifact.attachments:
                     if attach.filename == attach_link[1]:
                         attach_status = ''
                 classes += attach_status
@@ -400,6 +448,42 @@ def _escape(self, txt):
         return txt
 
 
+class ShortlinkPreprocessor(markdown.preprocessors.Preprocessor):
+
+    '''
+    Finds everything in the text that may be an artifact link, and resolves
+    them all at once before the links are rendered (see
+    :meth:`ForgeExtension.resolve_shortlinks`).  Anything it misses is
+    looked up when it's rendered.
+
+    With resolve=False, it just starts each conversion with no links.
+    '''
+
+    # [link] or [text](link)
+    link_re = re.compile(r'\[([^\[\]\n]+)\](?:\(\s*<?([^)\s>]+))?')
+
+    def __init__(self, md, ext, resolve=True):
+        markdown.preprocessors.Preprocessor.__init__(self, md)
+        self.ext = ext
+        self.resolve = resolve
+
+    def run(self, lines):
+        self.ext.shortlinks = {}
+        self.ext.artifact_links = set()
+        if not self.resolve:
+            return lines
+        links = set()
+        for line in lines:
+            for m in self.link_re.finditer(line):
+                for link in m.groups():
+                    if link:
+                        links.add(link)
+                        if '/attachment/' in link:
+                            links.add(link.split('/attachment/')[0])
+        self.ext.resolve_shortlinks(links)
+        return lines
+
+
 class ForgeMacroPattern(markdown.inlinepatterns.Pattern):
 
     def __init__(self, *args, **kwargs):
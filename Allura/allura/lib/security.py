@@ -19,6 +19,8 @@
 This module provides the security predicates used in decorating various models.
 """
 import logging
+import threading
+import time
 from collections import defaultdict
 
 from pylons import tmpl_context as c
@@ -58,10 +60,21 @@ def get(cls):
         import allura
         return allura.credentials
 
+    @property
+    def shared(self):
+        '''
+        The :class:`SecurityCache` shared with other requests, or None if
+        ``security.cache`` isn't enabled
+        '''
+        from pylons import app_globals as g
+        if hasattr(g, 'security_cache'):
+            return g.security_cache
+
     def clear(self):
         'clear cache'
         self.users = {}
         self.projects = {}
+        self.closures = {}
 
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
@@ -69,9 +82,13 @@ def clear_user(self, user_id, project_id=None):
                          for uid, pid in self.users if uid == user_id]
         else:
             to_remove = [(user_id, project_id)]
+        shared = self.shared
         for uid, pid in to_remove:
             self.projects.pop(pid, None)
             self.users.pop((uid, pid), None)
+            self.closures.pop((uid, pid), None)
+            if shared is not None:
+                shared.invalidate_user(uid, pid)
 
     def load_user_roles(self, user_id, *project_ids):
         '''Load the credentials with all user roles for a set of projects'''
@@ -144,6 +161,25 @@ def user_roles(self, user_id, project_id=None):
             self.users[user_id, project_id] = roles
         return roles
 
+    def role_closure(self, user_id, project_id):
+        '''
+        :returns: a tuple of (the ids of the user's own roles in the project,
+            the ids of all the roles they reach), as used by :func:`has_access`
+        '''
+        closure = self.closures.get((user_id, project_id))
+        if closure is None:
+            def load():
+                roles = self.user_roles(user_id=user_id, project_id=project_id)
+                return (tuple(r['_id'] for r in roles),
+                        tuple(roles.reaching_ids))
+            shared = self.shared
+            if shared is None:
+                closure = load()
+            else:
+                closure = shared.role_closure(user_id, project_id, load)
+            self.closures[user_id, project_id] = closure
+        return closure
+
     def user_has_any_role(self, user_id, project_id, role_ids):
         user_roles = self.user_roles(user_id=user_id, project_id=project_id)
         return bool(set(role_ids) & user_roles.reaching_ids_set)
@@ -158,6 +194,104 @@ def userids_with_named_role(self, project_id, name):
         return role.userids_that_reach
 
 
+class SecurityCache(object):
+
+    '''
+    Role closures (see :meth:`Credentials.role_closure`) and ACL checks
+    shared by all the requests in a process, kept for up to ``ttl`` seconds.
+    Set up as ``g.security_cache`` when ``security.cache`` is enabled.
+
+    Role closures are dropped when a :class:`~allura.model.auth.ProjectRole`
+    in their project is flushed (see
+    :class:`~allura.model.session.SecurityCacheSessionExtension`); changes made
+    by other processes are picked up once the ttl has passed.  ACL checks are
+    keyed by the contents of the ACL (see :func:`acl_key`), so a changed ACL
+    never uses an old one.
+    '''
+
+    def __init__(self, ttl=60, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.invalidations = 0
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries = {}  # key -> (expires, value)
+            self._project_keys = defaultdict(set)  # project_id -> role keys
+
+    def _get(self, key, load, project_id=None):
+        kind = key[0]
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation
+            if entry is not None and entry[0] > now:
+                self.hits[kind] += 1
+                return entry[1]
+            self.misses[kind] += 1
+        value = load()
+        with self._lock:
+            # don't keep anything loaded before an invalidation
+            if generation != self._generation:
+                return value
+            if len(self._entries) >= self.max_entries:
+                self._entries = {}
+                self._project_keys = defaultdict(set)
+            self._entries[key] = (now + self.ttl, value)
+            if project_id is not None:
+                self._project_keys[project_id].add(key)
+        return value
+
+    def role_closure(self, user_id, project_id, load):
+        '''
+        Return the cached role closure for the user in the project, or call
+        ``load()`` for it
+        '''
+        return self._get(('roles', user_id, project_id), load, project_id)
+
+    def acl_check(self, acl, permission, role_ids, deny_role_ids):
+        '''
+        Return :func:`check_acl` for the arguments, cached by the
+        :func:`acl_key` of the ACL
+        '''
+        return self._get(
+            ('acl', acl_key(acl), permission, role_ids, deny_role_ids),
+            lambda: check_acl(acl, permission, role_ids, deny_role_ids))
+
+    def invalidate_project(self, project_id):
+        '''Drop the role closures for a project, after its roles change'''
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            for key in self._project_keys.pop(project_id, ()):
+                self._entries.pop(key, None)
+
+    def invalidate_user(self, user_id, project_id):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            key = ('roles', user_id, project_id)
+            self._entries.pop(key, None)
+            self._project_keys.get(project_id, set()).discard(key)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                role_hits=self.hits['roles'],
+                role_misses=self.misses['roles'],
+                acl_hits=self.hits['acl'],
+                acl_misses=self.misses['acl'],
+                invalidations=self.invalidations,
+                size=len(self._entries),
+            )
+
+
 class RoleCache(object):
     '''
     An iterable collection of :class:`ProjectRoles <allura.model.auth.ProjectRole>` that is cached after first use
@@ -271,6 +405,61 @@ def reaching_ids_set(self):
         return set(self.reaching_ids)
 
 
+def acl_key(acl):
+    '''
+    Return a hashable key for the contents of an ACL.
+
+    For the ACL of a loaded, unchanged ming object the key is worked out once
+    and kept in the object's state.  Changing the ACL in place makes the
+    object dirty, so the key is not used again, and it is dropped when the
+    object is flushed (see
+    :class:`~allura.model.session.SecurityCacheSessionExtension`); assigning
+    a new ACL replaces the instance the key was kept for.
+    '''
+    tracker = getattr(acl, '_tracker', None)
+    st = getattr(tracker, 'state', None)
+    if st is not None and st.status == st.clean:
+        memo = st.extra_state.get('acl_key')
+        if memo is not None and memo[0] is acl:
+            return memo[1]
+    key = tuple((ace.access, ace.role_id, ace.permission) for ace in acl)
+    if st is not None and st.status == st.clean:
+        st.extra_state['acl_key'] = (acl, key)
+    return key
+
+
+def check_acl(acl, permission, role_ids, deny_role_ids=()):
+    '''
+    Check an ACL as part of :func:`has_access`.
+
+    :param role_ids: the ids of the roles to check
+    :param deny_role_ids: the ids of the user's own roles, which deny access
+        if the permission is denied to any of them
+    :returns: True if a role is allowed the permission, False if it is denied
+        to the user, or else a tuple of the role_ids that are neither allowed
+        nor denied (to check in the parent security context)
+    '''
+    from allura import model as M
+    # TODO: move deny logic into loop below; see ticket [#6715]
+    for rid in deny_role_ids:
+        if M.ACL.contains(M.ACE.deny(rid, permission), acl):
+            return False
+    chainable_roles = []
+    for rid in role_ids:
+        for ace in acl:
+            if M.ACE.match(ace, rid, permission):
+                if ace.access == M.ACE.ALLOW:
+                    # access is allowed
+                    return True
+                else:
+                    # access is denied for this role
+                    break
+        else:
+            # access neither allowed or denied, may chain to parent context
+            chainable_roles.append(rid)
+    return tuple(chainable_roles)
+
+
 def has_access(obj, permission, user=None, project=None):
     '''Return whether the given user has the permission name on the given object.
 
@@ -331,36 +520,26 @@ def predicate(obj=obj, user=user, project=project, roles=None):
                 else:
                     project = getattr(obj, 'project', None) or c.project
                     project = project.root_project
-            roles = cred.user_roles(
-                user_id=user._id, project_id=project._id).reaching_ids
+            roles = cred.role_closure(user._id, project._id)[1]
 
-        # TODO: move deny logic into loop below; see ticket [#6715]
+        cred = Credentials.get()
         if user != M.User.anonymous():
-            user_roles = Credentials.get().user_roles(user_id=user._id,
-                                                      project_id=project.root_project._id)
-            for r in user_roles:
-                deny_user = M.ACE.deny(r['_id'], permission)
-                if M.ACL.contains(deny_user, obj.acl):
-                    return False
-
-        chainable_roles = []
-        for rid in roles:
-            for ace in obj.acl:
-                if M.ACE.match(ace, rid, permission):
-                    if ace.access == M.ACE.ALLOW:
-                        # access is allowed
-                        # log.info('%s: True', txt)
-                        return True
-                    else:
-                        # access is denied for this role
-                        break
-            else:
-                # access neither allowed or denied, may chain to parent context
-                chainable_roles.append(rid)
+            deny_roles = cred.role_closure(
+                user._id, project.root_project._id)[0]
+        else:
+            deny_roles = ()
+        shared = cred.shared
+        if shared is not None:
+            result = shared.acl_check(obj.acl, permission, roles, deny_roles)
+        else:
+            result = check_acl(obj.acl, permission, roles, deny_roles)
+        if isinstance(result, bool):
+            return result
+        chainable_roles = result
         parent = obj.parent_security_context()
         if parent and chainable_roles:
             result = has_access(parent, permission, user=user, project=project)(
-                roles=tuple(chainable_roles))
+                roles=chainable_roles)
         elif not isinstance(obj, M.Neighborhood):
             result = has_access(project.neighborhood, 'admin', user=user)()
             if not (result or isinstance(obj, M.Project)):
@@ -372,6 +551,39 @@ def predicate(obj=obj, user=user, project=project, roles=None):
     return TruthyCallable(predicate)
 
 
+def has_access_many(objects, permission, user=None, project=None):
+    '''
+    Return a list with ``bool(has_access(obj, permission, user, project))``
+    for each of the objects, for filtering listings.
+
+    Objects with the same ACL and parent security context (e.g. tickets with
+    the same private ACL in one tracker) get the same answer, so it is only
+    worked out once for each distinct ACL.
+    '''
+    from allura import model as M
+    if user is None:
+        user = c.user
+    results = {}
+    allowed = []
+    for obj in objects:
+        if obj is None:
+            allowed.append(False)
+            continue
+        if isinstance(obj, (M.Neighborhood, M.Project)):
+            # these check roles and admin access relative to themselves
+            key = ('obj', id(obj))
+        else:
+            parent = obj.parent_security_context()
+            key = (
+                acl_key(obj.acl),
+                type(parent), getattr(parent, '_id', None),
+                getattr(obj, 'project_id', None))
+        if key not in results:
+            results[key] = bool(has_access(obj, permission, user, project)())
+        allowed.append(results[key])
+    return allowed
+
+
 def all_allowed(obj, user_or_role=None, project=None):
     '''
     List all the permission names that a given user or named role
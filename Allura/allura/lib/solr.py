@@ -17,6 +17,8 @@
 
 import shlex
 import logging
+import threading
+import time
 
 from tg import config
 from paste.deploy.converters import asbool
@@ -70,6 +72,22 @@ def make_solr_from_config(push_servers, query_server=None, **kwargs):
     return Solr(push_servers, query_server, **solr_kwargs)
 
 
+def make_index_buffer_from_config(solr, **kwargs):
+    """
+    Make a :class:`SolrIndexBuffer <SolrIndexBuffer>` for `solr` from config
+    defaults.  Use `**kwargs` to override any value
+    """
+    buffer_kwargs = dict(
+        batch_size=int(config.get('solr.batch.size', 500)),
+        max_wait=float(config.get('solr.batch.max_wait', 5)),
+        max_pending=int(config.get('solr.batch.max_pending', 5000)),
+        retries=int(config.get('solr.batch.retries', 3)),
+        backoff=float(config.get('solr.batch.backoff', 1)),
+    )
+    buffer_kwargs.update(kwargs)
+    return SolrIndexBuffer(solr, **buffer_kwargs)
+
+
 class Solr(object):
 
     """Solr interface that pushes updates to multiple solr instances.
@@ -120,6 +138,157 @@ def search(self, *args, **kw):
         return self.query_server.search(*args, **kw)
 
 
+class SolrIndexBuffer(object):
+
+    """Collects documents to add to solr, and sends them in batches.
+
+    Used by taskd workers, so the documents from many small index tasks go to
+    solr together.  Documents are sent once `batch_size` of them are waiting,
+    or the oldest has waited `max_wait` seconds (checked by :meth:`add` and
+    :meth:`flush_if_due`), or on :meth:`flush`.
+
+    Each batch is sent to all of the push servers at once.  A server that
+    fails is retried `retries` times, waiting `backoff` seconds (doubling
+    each time).  If it still fails, the batch stays in the buffer and the
+    error is raised.
+
+    Once `max_pending` documents are waiting, :meth:`add` sends them before
+    accepting more, so when solr is slow or down the index tasks wait for it
+    (or fail, and can be retried) instead of piling up documents in memory.
+
+    The tasks whose documents are waiting can be passed to :meth:`hold`, and
+    are passed to `release` (a function taking a list of them) once the
+    buffer has been emptied, so they aren't finished before their documents
+    are sent.
+
+    `solr` can be a :class:`Solr <Solr>` or a :class:`MockSOLR <MockSOLR>`.
+    """
+
+    def __init__(self, solr, batch_size=500, max_wait=5, max_pending=5000,
+                 retries=3, backoff=1, release=None):
+        self.solr = solr
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_pending = max(max_pending, batch_size)
+        self.retries = retries
+        self.backoff = backoff
+        self.release = release
+        self.pending = []
+        self.held = []
+        self.oldest = None  # when the oldest pending document was added
+        self.counts = dict(added=0, sent=0, batches=0, retries=0, errors=0)
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, docs):
+        docs = list(docs)
+        if not docs:
+            return
+        if len(self.pending) + len(docs) > self.max_pending:
+            self.flush()
+        if not self.pending:
+            self.oldest = time.time()
+        self.pending.extend(docs)
+        self.counts['added'] += len(docs)
+        self.max_depth = max(self.max_depth, len(self.pending))
+        if len(self.pending) >= self.batch_size:
+            self._send_pending(full_batches_only=True)
+        self.flush_if_due()
+
+    def discard(self, ids):
+        '''Drop pending documents with the given ids, e.g. when they're deleted'''
+        ids = set(ids)
+        self.pending = [doc for doc in self.pending if doc['id'] not in ids]
+        if not self.pending:
+            self.oldest = None
+            self._release()
+
+    def hold(self, items):
+        '''Keep items until all of the pending documents have been sent'''
+        if self.pending:
+            self.held.extend(items)
+        elif self.release is not None:
+            self.release(list(items))
+
+    def _release(self):
+        held, self.held = self.held, []
+        if held and self.release is not None:
+            self.release(held)
+
+    def flush_if_due(self):
+        if self.pending and time.time() - self.oldest >= self.max_wait:
+            self.flush()
+
+    def flush(self):
+        self._send_pending()
+
+    def _send_pending(self, full_batches_only=False):
+        while self.pending:
+            if full_batches_only and len(self.pending) < self.batch_size:
+                # the rest waits for more documents, or max_wait
+                return
+            batch = self.pending[:self.batch_size]
+            self._send(batch)
+            self.pending = self.pending[len(batch):]
+            self.counts['sent'] += len(batch)
+            self.counts['batches'] += 1
+        self.oldest = None
+        self._release()
+
+    def _send(self, docs):
+        servers = list(getattr(self.solr, 'push_pool', [self.solr]))
+        kw = {}
+        if isinstance(self.solr, Solr):
+            kw['commit'] = self.solr._commit
+            if self.solr.commitWithin:
+                kw['commitWithin'] = self.solr.commitWithin
+        for attempt in range(self.retries + 1):
+            errors = self._send_to_all(servers, docs, kw)
+            if not errors:
+                return
+            servers = [server for server, e in errors]
+            if attempt < self.retries:
+                self.counts['retries'] += 1
+                delay = self.backoff * 2 ** attempt
+                log.warning('Error sending %s documents to %s solr server(s), retrying in %ss: %s',
+                            len(docs), len(servers), delay, errors[0][1])
+                time.sleep(delay)
+        self.counts['errors'] += 1
+        raise errors[0][1]
+
+    def _send_to_all(self, servers, docs, kw):
+        '''Send docs to each server in its own thread.  Returns [(server, exception)]'''
+        errors = []
+
+        def send(server):
+            try:
+                server.add(docs, **kw)
+            except Exception as e:
+                errors.append((server, e))
+
+        if len(servers) == 1:
+            send(servers[0])
+            return errors
+        threads = [threading.Thread(target=send, args=(server,))
+                   for server in servers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
+    def stats(self):
+        stats = dict(self.counts,
+                     pending=len(self.pending),
+                     held=len(self.held),
+                     max_depth=self.max_depth)
+        if self.pending:
+            stats['oldest_age'] = round(time.time() - self.oldest, 3)
+        return stats
+
+
 class MockSOLR(object):
 
     class MockHits(list):
@@ -139,7 +308,7 @@ def facets(self):
     def __init__(self):
         self.db = {}
 
-    def add(self, objects):
+    def add(self, objects, **kw):
         for o in objects:
             o['text'] = ''.join(o['text'])
             self.db[o['id']] = o
@@ -22,9 +22,11 @@
 import logging.handlers
 import codecs
 import os.path
+import shutil
 import datetime
 import random
 import mimetypes
+import threading
 import re
 import magic
 from itertools import groupby
@@ -211,6 +213,20 @@ def chunked_find(cls, query=None, pagesize=1024, sort_key='_id', sort_dir=1):
         page += 1
 
 
+def chunked_find_expunged(cls, query=None, pagesize=1024):
+    '''
+    Yield the results of :func:`chunked_find` one at a time, expunging each
+    chunk from its ORM session before the next is read, so going through a
+    lot of them (e.g. for a bulk export) doesn't keep them all in memory.
+    Changes to them that haven't been flushed are lost.
+    '''
+    for results in chunked_find(cls, query, pagesize):
+        for obj in results:
+            yield obj
+        for obj in results:
+            session(obj).expunge(obj)
+
+
 def lsub_utf8(s, n):
     '''Useful for returning n bytes of a UTF-8 string, rather than characters'''
     while len(s) > n:
@@ -469,6 +485,42 @@ def __keytransform__(self, key):
         return key.lower()
 
 
+class TTLCache(object):
+
+    '''
+    A thread safe LRU of up to ``max_entries`` values, each kept for the
+    number of seconds it was :meth:`set` with.
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value), oldest first
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                return default
+            self._entries[key] = entry  # now the most recently used
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+
 def postmortem_hook(etype, value, tb):  # pragma no cover
     import sys
     import pdb
@@ -759,6 +811,89 @@ def default(self, obj):
         return super(JSONForExport, self).default(obj)
 
 
+class JSONStreamWriter(object):
+
+    '''
+    Write a json object to ``f`` a member at a time, so that a long array
+    (e.g. the artifacts of a bulk export) can be written from an iterable as
+    it's read, instead of being built in memory first::
+
+        with JSONStreamWriter(f, cls=JSONForExport) as out:
+            out.write_array('pages', pages)
+            out.write('config', app.config)
+    '''
+
+    def __init__(self, f, cls=tg.jsonify.GenericJSON, indent=2):
+        self.f = f
+        self.cls = cls
+        self.indent = indent
+        self._members = 0
+
+    def __enter__(self):
+        self.f.write('{')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.f.write('}')
+
+    def _write_key(self, key):
+        if self._members:
+            self.f.write(',\n')
+        self._members += 1
+        self.f.write(json.dumps(key) + ':')
+
+    def _dump(self, value):
+        json.dump(value, self.f, cls=self.cls, indent=self.indent)
+
+    def write(self, key, value):
+        self._write_key(key)
+        self._dump(value)
+
+    def write_array(self, key, items):
+        self._write_key(key)
+        self.f.write('[')
+        for i, item in enumerate(items):
+            if i > 0:
+                self.f.write(',')
+            self._dump(item)
+        self.f.write(']')
+
+
+class AttachmentCopier(object):
+
+    '''
+    Copy attachments out of GridFS into files, with the threads of ``pool``
+    (a ``multiprocessing.pool.ThreadPool``, which can be shared) if given, or
+    else right away.  :meth:`wait` for the copies to be done.
+    '''
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self._results = []
+
+    def copy(self, attachment, path):
+        fp = attachment.rfile()
+        if self.pool is None:
+            self._copy(fp, path)
+        else:
+            self._results.append(self.pool.apply_async(self._copy, (fp, path)))
+
+    @staticmethod
+    def _copy(fp, path):
+        try:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(fp, f)
+        finally:
+            fp.close()
+
+    def wait(self):
+        '''Wait for the copies so far, and raise the first error among them'''
+        results, self._results = self._results, []
+        for result in results:
+            result.get()
+
+
 @contextmanager
 def umask(new_mask):
     cur_mask = os.umask(new_mask)
@@ -932,7 +932,7 @@ def post(cls, artifact, title=None, description=None, author=None,
             app_config_id=artifact.app_config_id,
             tool_name=artifact.app_config.tool_name,
             title=title,
-            description=g.markdown.convert(description),
+            description=g.markdown.shared_convert(description),
             link=link,
             pubdate=pubdate,
             author_name=author_name,
@@ -17,7 +17,6 @@
 
 import re
 import logging
-from itertools import groupby
 from cPickle import dumps, loads
 from collections import defaultdict
 from urllib import unquote
@@ -35,7 +34,7 @@
 from allura.lib import helpers as h
 
 from .session import main_doc_session, main_orm_session
-from .project import Project
+from .project import Project, AppConfig
 
 log = logging.getLogger(__name__)
 
@@ -91,6 +90,31 @@ def from_artifact(cls, artifact):
             session(obj).expunge(obj)
             return cls.query.get(_id=artifact.index_id())
 
+    @classmethod
+    def load_artifacts(cls, arefs):
+        '''Load the artifacts referenced by several ArtifactReferences, with
+        one query for each artifact class and project, so their
+        :attr:`artifact` doesn't need a query each'''
+        by_cls = defaultdict(list)
+        for aref in arefs:
+            if 'artifact' not in aref.__dict__:
+                key = (str(aref.artifact_reference.cls),
+                       aref.artifact_reference.project_id)
+                by_cls[key].append(aref)
+        for (pickled_cls, project_id), group in by_cls.iteritems():
+            try:
+                artifact_cls = loads(pickled_cls)
+                with h.push_context(project_id):
+                    artifacts = artifact_cls.query.find(dict(_id={'$in': [
+                        aref.artifact_reference.artifact_id for aref in group]}))
+                    artifacts = dict((a._id, a) for a in artifacts)
+            except:
+                # leave them to be looked up (and logged) one at a time
+                continue
+            for aref in group:
+                aref.__dict__['artifact'] = artifacts.get(
+                    aref.artifact_reference.artifact_id)
+
     @LazyProperty
     def artifact(self):
         '''Look up the artifact referenced'''
@@ -168,26 +192,51 @@ def from_links(cls, *links):
                 link={'$in': links_by_artifact.keys()},
                 project_id={'$in': list(project_ids)}
             ), validate=False)
-            matches_by_artifact = dict(
-                (link, list(matches))
-                for link, matches in groupby(q, key=lambda s: unquote(s.link)))
+            matches_by_artifact = defaultdict(list)
+            for m in q:
+                matches_by_artifact[unquote(m.link)].append(m)
+            is_installed = cls._installed_check(
+                [m for matches in matches_by_artifact.itervalues() for m in matches])
             for link, d in parsed_links.iteritems():
                 matches = matches_by_artifact.get(unquote(d['artifact']), [])
                 matches = (
                     m for m in matches
-                    if m.project.shortname == d['project'] and
-                    m.project.neighborhood_id == d['nbhd'] and
-                    m.app_config is not None and
-                    m.project.app_instance(m.app_config.options.mount_point))
-                if d['app']:
-                    matches = (
-                        m for m in matches
-                        if m.app_config.options.mount_point == d['app'])
+                    if is_installed(m, d['project'], d['nbhd'], d['app']))
                 result[link] = cls._get_correct_match(link, list(matches))
             return result
         else:
             return {}
 
+    @classmethod
+    def _installed_check(cls, shortlinks):
+        '''
+        Return a function that checks whether a shortlink is for a tool that
+        is installed in the given project (by shortname and neighborhood),
+        and mounted at the given mount point if there is one.  The projects
+        and tools of all the shortlinks are loaded up front.
+        '''
+        projects = app_configs = {}
+        if shortlinks:
+            projects = dict((p._id, p) for p in Project.query.find(dict(
+                _id={'$in': list(set(s.project_id for s in shortlinks))})))
+            app_configs = dict((ac._id, ac) for ac in AppConfig.query.find(dict(
+                _id={'$in': list(set(s.app_config_id for s in shortlinks))})))
+        installed = {}
+
+        def is_installed(s, shortname, nbhd_id, mount_point=None):
+            project = projects.get(s.project_id)
+            app_config = app_configs.get(s.app_config_id)
+            if project is None or app_config is None:
+                return False
+            if project.shortname != shortname or project.neighborhood_id != nbhd_id:
+                return False
+            if mount_point and app_config.options.mount_point != mount_point:
+                return False
+            if app_config._id not in installed:
+                installed[app_config._id] = bool(project.app_instance(app_config))
+            return installed[app_config._id]
+        return is_installed
+
     @classmethod
     def _get_correct_match(cls, link, matches):
         result = None
@@ -24,7 +24,7 @@
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
@@ -33,7 +33,7 @@
 from ming.orm.declarative import MappedClass
 
 from allura.lib.helpers import log_output, null_contextmanager
-from .session import task_orm_session
+from .session import task_orm_session, task_doc_session
 
 log = logging.getLogger(__name__)
 
@@ -58,6 +58,7 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - progress - how far a long running task has got, if it says (see :meth:`set_progress`)
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
@@ -97,16 +98,16 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    progress = FieldProperty(None, if_missing=None)
 
     def __repr__(self):
-        from allura import model as M
-        project = M.Project.query.get(_id=self.context.project_id)
+        project, app_config, user = self._context_objects()
+        return self._describe(project, app_config, user)
+
+    def _describe(self, project, app_config, user):
         app = None
-        if project:
-            app_config = M.AppConfig.query.get(_id=self.context.app_config_id)
-            if app_config:
-                app = project.app_instance(app_config)
-        user = M.User.query.get(_id=self.context.user_id)
+        if project and app_config:
+            app = project.app_instance(app_config)
         project_url = project and project.url() or None
         app_mount = app and app.config.options.mount_point or None
         username = user and user.username or None
@@ -121,6 +122,26 @@ def __repr__(self):
             app_mount,
             username)
 
+    def _context_objects(self, cache=None):
+        '''Load the project, app config and user of this task's context.  If
+        cache (a dict) is given, objects already loaded for other tasks are
+        reused, and newly loaded ones are added to it.'''
+        from allura import model as M
+        if cache is None:
+            cache = {}
+
+        def get(cls, _id):
+            key = (cls, _id)
+            if key not in cache:
+                cache[key] = cls.query.get(_id=_id) if _id else None
+            return cache[key]
+        project = get(M.Project, self.context.project_id)
+        app_config = None
+        if project:
+            app_config = get(M.AppConfig, self.context.app_config_id)
+        user = get(M.User, self.context.user_id)
+        return project, app_config, user
+
     @LazyProperty
     def function(self):
         '''The function that is called by this task'''
@@ -135,8 +156,14 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             coalesce=False):
+        '''Create a new task object based on the current context.
+
+        If coalesce is True, args must be a single list (e.g. of ids), which
+        is added to a ready task of the same function, context and priority
+        if possible, rather than creating a new task.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -144,6 +171,30 @@ def post(cls,
         task_name = '%s.%s' % (
             function.__module__,
             function.__name__)
+        context = cls._current_context()
+        if coalesce and not delay and not kwargs and len(args) == 1:
+            obj = cls._coalesce(task_name, context, list(args[0]),
+                                result_type, priority)
+            if obj is not None:
+                return obj
+        obj = cls(
+            state='ready',
+            priority=priority,
+            result_type=result_type,
+            task_name=task_name,
+            args=args,
+            kwargs=kwargs,
+            process=None,
+            result=None,
+            context=context,
+            time_queue=datetime.utcnow() + timedelta(seconds=delay))
+        session(obj).flush(obj)
+        if not delay and asbool(config.get('monq.wakeup', False)):
+            TaskWakeup.notify(obj)
+        return obj
+
+    @classmethod
+    def _current_context(cls):
         context = dict(
             project_id=None,
             app_config_id=None,
@@ -157,27 +208,84 @@ def post(cls,
             context['app_config_id'] = c.app.config._id
         if getattr(c, 'user', None):
             context['user_id'] = c.user._id
-        obj = cls(
+        return context
+
+    @classmethod
+    def _pending_query(cls, task_name, context):
+        '''Query for ready tasks posted in context.  Tasks posted with kwargs
+        match it too, so callers skip those.'''
+        query = dict(
             state='ready',
-            priority=priority,
-            result_type=result_type,
             task_name=task_name,
-            args=args,
-            kwargs=kwargs,
-            process=None,
-            result=None,
-            context=context,
-            time_queue=datetime.utcnow() + timedelta(seconds=delay))
-        session(obj).flush(obj)
-        return obj
+            time_queue={'$lte': datetime.utcnow()})
+        for key, value in context.iteritems():
+            query['context.' + key] = value
+        return query
+
+    @classmethod
+    def _coalesce(cls, task_name, context, items, result_type, priority):
+        '''Add items to the list argument of the latest ready task with the
+        same name and context, if it has room for them (it's kept to
+        monq.coalesce.max_items).  Returns the task, or None if there wasn't
+        one to add them to.'''
+        max_items = asint(config.get('monq.coalesce.max_items', 1000))
+        query = cls._pending_query(task_name, context)
+        query.update(result_type=result_type, priority=priority)
+        collection = task_doc_session.db[cls.__mongometa__.name]
+        candidates = collection.find(query, {'args': 1, 'kwargs': 1}).sort(
+            'time_queue', ming.DESCENDING)
+        # the latest one posted without kwargs
+        for doc in candidates:
+            if doc.get('kwargs'):
+                continue
+            if len(doc['args']) != 1:
+                break
+            pending = doc['args'][0]
+            seen = set(pending)
+            merged = pending + [i for i in items if i not in seen]
+            if len(merged) > max_items:
+                break
+            # only if it hasn't been claimed (or changed) since we looked
+            try:
+                return cls.query.find_and_modify(
+                    query=dict(_id=doc['_id'], state='ready', args=doc['args']),
+                    update={'$set': dict(args=[merged])},
+                    new=True)
+            except pymongo.errors.OperationFailure as exc:
+                if 'No matching object found' not in exc.args[0]:
+                    raise
+            break
+        return None
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def discard_pending(cls, function, items):
+        '''Remove items from the list argument of ready tasks of function posted
+        with coalesce=True in the current context, e.g. because a task posted
+        next supersedes them.  Tasks left with nothing to do are removed.'''
+        task_name = '%s.%s' % (function.__module__, function.__name__)
+        query = cls._pending_query(task_name, cls._current_context())
+        items = set(items)
+        collection = task_doc_session.db[cls.__mongometa__.name]
+        for doc in collection.find(query, {'args': 1, 'kwargs': 1}):
+            args = doc['args']
+            if doc.get('kwargs') or len(args) != 1 or not items.intersection(args[0]):
+                continue
+            remaining = [i for i in args[0] if i not in items]
+            spec = dict(_id=doc['_id'], state='ready', args=args)
+            if remaining:
+                collection.update(spec, {'$set': dict(args=[remaining])})
+            else:
+                collection.remove(spec)
+
+    @classmethod
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None,
+            exclude=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.  If only or exclude are given,
+        only tasks with (or without) those names are considered.
         '''
         sort = [
             ('priority', ming.DESCENDING),
@@ -186,8 +294,12 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             try:
                 query = dict(state=state)
                 query['time_queue'] = {'$lte': datetime.utcnow()}
+                if only or exclude:
+                    query['task_name'] = {}
                 if only:
-                    query['task_name'] = {'$in': only}
+                    query['task_name']['$in'] = only
+                if exclude:
+                    query['task_name']['$nin'] = exclude
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
@@ -223,6 +335,11 @@ def clear_complete(cls):
         spec = dict(state='complete')
         cls.query.remove(spec)
 
+    def set_progress(self, **progress):
+        '''Save how far the task has got while it's running, for others to see'''
+        self.progress = progress
+        session(self).flush(self)
+
     @classmethod
     def run_ready(cls, worker=None):
         '''Run all the tasks that are currently ready'''
@@ -232,33 +349,45 @@ def run_ready(cls, worker=None):
             task()
         return i
 
-    def __call__(self, restore_context=True, nocapture=False):
+    def __call__(self, restore_context=True, nocapture=False,
+                 context_cache=None, flush=True):
         '''Call the task function with its context.  If restore_context is True,
         c.project/app/user will be restored to the values they had before this
-        function was called.
+        function was called.  context_cache is passed to
+        :meth:`_context_objects`.  If flush is False, the task's start and
+        result aren't saved here (see :meth:`run_batch`).
         '''
-        from allura import model as M
         self.time_start = datetime.utcnow()
-        session(self).flush(self)
-        log.info('starting %r', self)
+        if flush:
+            session(self).flush(self)
         old_cproject = getattr(c, 'project', None)
         old_capp = getattr(c, 'app', None)
         old_cuser = getattr(c, 'user', None)
+        index_buffer = getattr(g, 'solr_index_buffer', None)
+        added = index_buffer.counts['added'] if index_buffer is not None else 0
+        held = False
         try:
             func = self.function
-            c.project = M.Project.query.get(_id=self.context.project_id)
+            project, app_config, user = self._context_objects(context_cache)
+            log.info('starting %s', self._describe(project, app_config, user))
+            c.project = project
             c.app = None
             if c.project:
                 c.project.notifications_disabled = self.context.get(
                     'notifications_disabled', False)
-                app_config = M.AppConfig.query.get(
-                    _id=self.context.app_config_id)
                 if app_config:
                     c.app = c.project.app_instance(app_config)
-            c.user = M.User.query.get(_id=self.context.user_id)
+            c.user = user
             with null_contextmanager() if nocapture else log_output(log):
                 self.result = func(*self.args, **self.kwargs)
-            self.state = 'complete'
+            if (index_buffer is not None and len(index_buffer)
+                    and index_buffer.counts['added'] > added):
+                # not finished until its documents are sent to solr (and left
+                # busy, for taskd_cleanup, if the worker dies before then)
+                self.state = 'busy'
+                held = True
+            else:
+                self.state = 'complete'
             return self.result
         except Exception, exc:
             if asbool(config.get('monq.raise_errors')):
@@ -273,12 +402,96 @@ def __call__(self, restore_context=True, nocapture=False):
                     self.result = traceback.format_exc()
         finally:
             self.time_stop = datetime.utcnow()
-            session(self).flush(self)
+            if flush:
+                session(self).flush(self)
+                if held:
+                    index_buffer.hold([self._id])
             if restore_context:
                 c.project = old_cproject
                 c.app = old_capp
                 c.user = old_cuser
 
+    @classmethod
+    def claim_batch(cls, task, process, size):
+        '''Claim up to size - 1 more ready tasks with the same name as task
+        (already claimed by process, e.g. with :meth:`get`).  Returns the
+        claimed tasks, task first.
+
+        This takes three queries however big the batch is, rather than one
+        :meth:`get` per task: a find for the ids of the next ready tasks, a
+        multi update that claims the ones of them that are still ready, and
+        a find that loads the ones this process got.'''
+        if size <= 1:
+            return [task]
+        query = dict(
+            state='ready',
+            task_name=task.task_name,
+            time_queue={'$lte': datetime.utcnow()})
+        sort = [
+            ('priority', ming.DESCENDING),
+            ('time_queue', ming.ASCENDING)]
+        collection = task_doc_session.db[cls.__mongometa__.name]
+        ids = [doc['_id'] for doc in
+               collection.find(query, {'_id': 1}).sort(sort).limit(size - 1)]
+        if not ids:
+            return [task]
+        # another process may claim some of them first, so only take the
+        # ones still ready, and then see which those were
+        cls.query.update(
+            dict(_id={'$in': ids}, state='ready'),
+            {'$set': dict(state='busy', process=process)},
+            multi=True)
+        claimed = dict((t._id, t) for t in cls.query.find(
+            dict(_id={'$in': ids}, state='busy', process=process)))
+        return [task] + [claimed[_id] for _id in ids if _id in claimed]
+
+    @classmethod
+    def run_batch(cls, tasks, nocapture=False):
+        '''Run tasks (e.g. from :meth:`claim_batch`) one after another.  The
+        project/app config/user loaded for one task's context are reused for
+        the others, and the tasks' start and completion are each saved with
+        a single update, rather than two flushes per task.'''
+        if not tasks:
+            return
+        ids = [t._id for t in tasks]
+        cls.query.update(
+            dict(_id={'$in': ids}),
+            {'$set': dict(time_start=datetime.utcnow())},
+            multi=True)
+        context_cache = {}
+        for task in tasks:
+            task(nocapture=nocapture, context_cache=context_cache,
+                 flush=False)
+        # the usual case: no result to keep, so they can all be saved at once
+        done = set(t._id for t in tasks
+                   if t.state == 'complete' and t.result is None)
+        if done:
+            cls.query.update(
+                dict(_id={'$in': list(done)}),
+                {'$set': dict(state='complete',
+                              result=None,
+                              time_stop=datetime.utcnow())},
+                multi=True)
+        for task in tasks:
+            if task._id in done:
+                session(task).expunge(task)
+            else:
+                session(task).flush(task)
+        # once saved, so completing them can't be overwritten
+        held = [t._id for t in tasks if t.state == 'busy']
+        if held:
+            g.solr_index_buffer.hold(held)
+
+    @classmethod
+    def complete_held(cls, ids):
+        '''Complete the tasks (with the given _ids) held by a
+        :class:`SolrIndexBuffer <allura.lib.solr.SolrIndexBuffer>` now that
+        their documents have been sent'''
+        cls.query.update(
+            dict(_id={'$in': ids}, state='busy'),
+            {'$set': dict(state='complete')},
+            multi=True)
+
     def join(self, poll_interval=0.1):
         '''Wait until this task is either complete or errors out, then return the result.'''
         while self.state not in ('complete', 'error'):
@@ -291,3 +504,95 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class TaskWakeup(object):
+
+    '''
+    Wakes up idle taskd workers as soon as a task is posted, instead of
+    leaving them to find it the next time they poll.
+
+    :meth:`MonQTask.post` adds a small document to a capped collection, and
+    idle workers wait on a tailable cursor over it.  If the collection can't
+    be used (e.g., it isn't capped), workers just sleep until their next
+    poll, as before.
+    '''
+
+    collection_name = 'monq_task_wakeup'
+    _collection = None
+
+    @classmethod
+    def collection(cls):
+        '''The capped wakeup collection, created if it doesn't exist yet'''
+        if cls._collection is None:
+            db = task_doc_session.db
+            if cls.collection_name not in db.collection_names():
+                try:
+                    db.create_collection(
+                        cls.collection_name, capped=True,
+                        size=asint(config.get('monq.wakeup.size', 1024 * 1024)))
+                except pymongo.errors.CollectionInvalid:
+                    pass  # created by another process meanwhile
+            cls._collection = db[cls.collection_name]
+        return cls._collection
+
+    @classmethod
+    def notify(cls, task):
+        try:
+            cls.collection().insert(
+                dict(task_name=task.task_name, priority=task.priority), w=0)
+        except Exception:
+            log.warning('Could not signal taskd for %s', task.task_name,
+                        exc_info=True)
+
+    def __init__(self, only=None):
+        self.only = only
+        self.available = True
+        self._cursor = None
+        try:
+            self._open_cursor(skip_existing=True)
+        except Exception:
+            log.warning('taskd wakeup channel unavailable, polling instead',
+                        exc_info=True)
+            self.available = False
+
+    def _open_cursor(self, skip_existing=False):
+        # one tailable cursor is kept open across waits, so wakeups are seen
+        # in the order they were inserted, whichever process posted them
+        self._cursor = self.collection().find(tailable=True, await_data=True)
+        if skip_existing:
+            # comes back empty a second or two after the last document
+            for doc in self._cursor:
+                pass
+
+    def wait(self, timeout):
+        '''
+        Block until a task (with a name in only, if given) is posted, or
+        timeout seconds have passed.  Returns True if woken up by a task.
+        '''
+        deadline = time.time() + timeout
+        while self.available and time.time() < deadline:
+            try:
+                if not self._cursor.alive:
+                    # it dies right away on an empty collection, or if this
+                    # worker falls so far behind that the capped collection
+                    # overwrites its position; reading all of it again at
+                    # worst wakes it up for nothing
+                    self._open_cursor()
+                # without new documents, each pass blocks on the server for
+                # a second or two and then comes back empty
+                while self._cursor.alive and time.time() < deadline:
+                    for doc in self._cursor:
+                        if not self.only or doc.get('task_name') in self.only:
+                            return True
+            except Exception:
+                log.warning('taskd wakeup channel failed, polling instead',
+                            exc_info=True)
+                self.available = False
+                break
+            if not self._cursor.alive:
+                time.sleep(max(0, min(1, deadline - time.time())))
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return False
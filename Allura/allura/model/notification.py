@@ -43,7 +43,7 @@
 from tg import config
 import pymongo
 import jinja2
-from paste.deploy.converters import asbool, aslist
+from paste.deploy.converters import asbool, asint, aslist
 
 from ming import schema as S
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty, session
@@ -61,6 +61,8 @@
 log = logging.getLogger(__name__)
 
 MAILBOX_QUIESCENT = None  # Re-enable with [#1384]: timedelta(minutes=10)
+# how long before a mailbox claimed by a process that never fired it is claimed again
+FIRE_TOKEN_TIMEOUT = timedelta(minutes=10)
 
 
 class Notification(MappedClass):
@@ -325,12 +327,10 @@ def send_digest(self, user_id, from_address, subject, notifications,
             return
         # Filter out notifications for which the user doesn't have read
         # permissions to the artifact.
-        artifact = self.ref.artifact
-
-        def perm_check(notification):
-            return not (user and artifact) or \
-                security.has_access(artifact, 'read', user)()
-        notifications = filter(perm_check, notifications)
+        artifacts = [n.ref.artifact if n.ref else None for n in notifications]
+        allowed = security.has_access_many(artifacts, 'read', user)
+        notifications = [n for n, artifact, ok in zip(notifications, artifacts, allowed)
+                         if ok or not artifact]
 
         log.debug('Sending digest of notifications [%s] to user %s', ', '.join(
             [n._id for n in notifications]), user_id)
@@ -397,6 +397,7 @@ class __mongometa__:
             ('is_flash', 'user_id'),
             ('type', 'next_scheduled'),  # for q_digest
             ('type', 'queue_empty'),  # for q_direct
+            'fire_token',  # for _claim_direct()
             # for deliver()
             ('project_id', 'app_config_id', 'artifact_index_id', 'topic'),
         ]
@@ -424,6 +425,8 @@ class __mongometa__:
     # a list of notification _id values
     queue = FieldProperty([str])
     queue_empty = FieldProperty(bool)
+    # set while the mailbox is claimed by fire_ready()
+    fire_token = FieldProperty(S.ObjectId, if_missing=None)
 
     project = RelationProperty('Project')
     app_config = RelationProperty('AppConfig')
@@ -533,7 +536,7 @@ def subscribed(
     def deliver(cls, nid, artifact_index_ids, topic):
         '''Called in the notification message handler to deliver notification IDs
         to the appropriate mailboxes.  Atomically appends the nids
-        to the appropriate mailboxes.
+        to the appropriate mailboxes, with one update for all of them.
         '''
 
         artifact_index_ids.append(None)  # get tool-wide ("None") and specific artifact subscriptions
@@ -543,30 +546,23 @@ def deliver(cls, nid, artifact_index_ids, topic):
             'artifact_index_id': {'$in': artifact_index_ids},
             'topic': {'$in': [None, topic]}
         }
-        mboxes = cls.query.find(d).all()
-        log.debug('Delivering notification %s to mailboxes [%s]', nid, ', '.join([str(m._id) for m in mboxes]))
-        for mbox in mboxes:
-            try:
-                mbox.query.update(
-                    # _id is automatically specified by ming's "query", so this matches the current mbox
-                    {'$push': dict(queue=nid),
-                     '$set': dict(last_modified=datetime.utcnow(),
-                                  queue_empty=False),
-                     })
-                # Make sure the mbox doesn't stick around to be flush()ed
-                session(mbox).expunge(mbox)
-            except:
-                # log error but try to keep processing, lest all the other eligible
-                # mboxes for this notification get skipped and lost forever
-                log.exception(
-                    'Error adding notification: %s for artifact %s on project %s to user %s',
-                    nid, artifact_index_ids, c.project._id, mbox.user_id)
+        log.debug('Delivering notification %s to mailboxes matching %s', nid, d)
+        cls.query.update(
+            d,
+            {'$push': dict(queue=nid),
+             '$set': dict(last_modified=datetime.utcnow(),
+                          queue_empty=False),
+             },
+            multi=True)
 
     @classmethod
     def fire_ready(cls):
         '''Fires all direct subscriptions with notifications as well as
         all summary & digest subscriptions with notifications that are ready.
         Clears the mailbox queue.
+
+        Direct subscriptions are claimed mailbox.fire_batch_size at a time,
+        and the notifications for each batch are loaded once.
         '''
         now = datetime.utcnow()
         # Queries to find all matching subscription objects
@@ -580,24 +576,18 @@ def fire_ready(cls):
             type={'$in': ['digest', 'summary']},
             next_scheduled={'$lt': now})
 
-        def find_and_modify_direct_mbox():
-            return cls.query.find_and_modify(
-                query=q_direct,
-                update={'$set': dict(
-                    queue=[],
-                    queue_empty=True,
-                )},
-                new=False)
-
-        for mbox in take_while_true(find_and_modify_direct_mbox):
-            try:
-                mbox.fire(now)
-            except:
-                log.exception(
-                    'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
-                # re-raise so we don't keep (destructively) trying to process
-                # mboxes
-                raise
+        batch_size = asint(config.get('mailbox.fire_batch_size', 100))
+        for mboxes in take_while_true(lambda: cls._claim_direct(q_direct, batch_size)):
+            notifications = cls._load_notifications(mboxes)
+            for mbox in mboxes:
+                try:
+                    mbox.fire(now, notifications)
+                except:
+                    log.exception(
+                        'Error firing mbox: %s with queue: [%s]', str(mbox._id), ', '.join(mbox.queue))
+                    # re-raise so we don't keep (destructively) trying to process
+                    # mboxes
+                    raise
 
         for mbox in cls.query.find(q_digest):
             next_scheduled = now
@@ -617,12 +607,74 @@ def find_and_modify_direct_mbox():
                 new=False)
             mbox.fire(now)
 
-    def fire(self, now):
+    @classmethod
+    def _claim_direct(cls, q_direct, batch_size):
+        '''
+        Claim up to batch_size direct mailboxes matching q_direct, and clear
+        their queues.  Returns the mailboxes, with the queues as they were.
+
+        The batch is tagged with a fire_token by one multi update, so another
+        process can't fire it as well, and read back with one find.  Then
+        just the notifications that were read are pulled from the queues
+        (with one update for each distinct queue, usually just one), so
+        notifications delivered in the meantime are left for the next time.
+        A claim that is never released (e.g. the process died) expires after
+        FIRE_TOKEN_TIMEOUT.
+        '''
+        unclaimed = {'$or': [
+            dict(fire_token=None),
+            dict(fire_token={'$lt': ObjectId.from_datetime(
+                datetime.utcnow() - FIRE_TOKEN_TIMEOUT)})]}
+        ids = [doc['_id'] for doc in cls.query.find(
+            dict(q_direct, **unclaimed), {'_id': 1}).limit(batch_size)]
+        if not ids:
+            return []
+        token = ObjectId()
+        cls.query.update(
+            dict(q_direct, _id={'$in': ids}, **unclaimed),
+            {'$set': dict(queue_empty=True, fire_token=token)},
+            multi=True)
+        mboxes = cls.query.find(dict(fire_token=token), refresh=True).all()
+        by_queue = defaultdict(list)
+        for mbox in mboxes:
+            # don't let the mbox stick around to be flush()ed
+            session(mbox).expunge(mbox)
+            by_queue[tuple(mbox.queue)].append(mbox._id)
+        for queue, mbox_ids in by_queue.iteritems():
+            cls.query.update(
+                dict(_id={'$in': mbox_ids}, fire_token=token),
+                {'$pullAll': dict(queue=list(queue)),
+                 '$set': dict(fire_token=None)},
+                multi=True)
+        if not mboxes:
+            # all claimed by other processes; there may be more
+            return cls._claim_direct(q_direct, batch_size)
+        return mboxes
+
+    @classmethod
+    def _load_notifications(cls, mboxes):
+        '''Load the notifications queued in all the mboxes, as {_id: notification}'''
+        nids = set()
+        for mbox in mboxes:
+            nids.update(mbox.queue)
+        if not nids:
+            return {}
+        notifications = Notification.query.find(dict(_id={'$in': list(nids)}))
+        return dict((n._id, n) for n in notifications)
+
+    def fire(self, now, notifications=None):
         '''
         Send all notifications that this mailbox has enqueued.
+
+        :param notifications: {_id: notification} including the ones queued
+            here, if they're already loaded (see :meth:`fire_ready`)
         '''
-        notifications = Notification.query.find(dict(_id={'$in': self.queue}))
-        notifications = notifications.all()
+        if notifications is None:
+            notifications = Notification.query.find(dict(_id={'$in': self.queue}))
+            notifications = notifications.all()
+        else:
+            notifications = [notifications[nid] for nid in self.queue
+                             if nid in notifications]
         if len(notifications) != len(self.queue):
             log.error('Mailbox queue error: Mailbox %s queued [%s], found [%s]', str(
                 self._id), ', '.join(self.queue), ', '.join([n._id for n in notifications]))
@@ -1162,17 +1162,24 @@ def bulk_export_status(self):
         '''
         Returns 'busy' if an export is queued or in-progress.  Returns None otherwise
         '''
-        q = {
-            'task_name': 'allura.tasks.export_tasks.bulk_export',
-            'state': {'$in': ['busy', 'ready']},
-            'context.project_id': self._id,
-        }
-        export_task = MonQTask.query.get(**q)
+        export_task = self.bulk_export_task()
         if not export_task:
             return
         else:
             return 'busy'
 
+    def bulk_export_task(self, states=('busy', 'ready')):
+        '''
+        Returns the queued or in-progress export task, if any.  Its ``progress``
+        tells how far a running export has got.
+        '''
+        q = {
+            'task_name': 'allura.tasks.export_tasks.bulk_export',
+            'state': {'$in': list(states)},
+            'context.project_id': self._id,
+        }
+        return MonQTask.query.get(**q)
+
     def index(self):
         provider = plugin.ProjectRegistrationProvider.get()
         try:
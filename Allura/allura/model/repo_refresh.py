@@ -15,16 +15,20 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import logging
 from itertools import chain
 from cPickle import dumps
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from time import time
+from multiprocessing.pool import ThreadPool
 
 import bson
+from pymongo.errors import DuplicateKeyError
 
 import tg
 import jinja2
-from paste.deploy.converters import asint
+from paste.deploy.converters import asint, asbool
 from pylons import tmpl_context as c, app_globals as g
 
 from ming.base import Object
@@ -32,12 +36,14 @@
 
 from allura.lib import utils
 from allura.lib import helpers as h
-from allura.model.repository import CommitDoc
+from allura.lib.commit_graph import CommitGraph, timestamp
+from allura.model.repository import CommitDoc, TreeDoc
 from allura.model.repository import CommitRunDoc
 from allura.model.repository import Commit, Tree, LastCommit, ModelCache
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
 from allura.model.auth import User
 from allura.model.timeline import TransientActor
+from allura.model.session import main_doc_session
 
 log = logging.getLogger(__name__)
 
@@ -52,7 +58,7 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     if not commit_ids:
         # the repo is empty, no need to continue
         return
-    new_commit_ids = unknown_commit_ids(commit_ids)
+    new_commit_ids = repo.unknown_commit_ids(commit_ids)
     stats_log = h.log_action(log, 'commit')
     for ci in new_commit_ids:
         stats_log.info(
@@ -65,22 +71,30 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
         commit_ids = new_commit_ids
     log.info('Refreshing %d commits on %s', len(commit_ids), repo.full_fs_path)
 
+    bulk = (asbool(tg.config.get('scm.refresh.bulk', False))
+            and repo.supports_bulk_refresh)
+
     # Refresh commits
-    seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    if bulk:
+        # child references are computed along with the commit info
+        refresh_commits_bulk(repo, commit_ids, not all_commits)
+    else:
+        seen = set()
+        for i, oid in enumerate(commit_ids):
+            repo.refresh_commit_info(oid, seen, not all_commits)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
 
     refresh_commit_repos(all_commit_ids, repo)
 
     # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
+    if not bulk:
+        for i, oid in enumerate(commit_ids):
+            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
+            refresh_children(ci)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh child info %d for parents of %s',
+                         (i + 1), ci._id)
 
     if repo._refresh_precompute:
         # Refresh commit runs
@@ -90,7 +104,8 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
         # the CommitRuns for this repo are in a bad state - rebuild them
         # entirely.
         if commit_run_ids != all_commit_ids:
-            last_commit = last_known_commit_id(all_commit_ids, new_commit_ids)
+            last_commit = last_known_commit_id(
+                all_commit_ids, new_commit_ids, repo.commit_graph)
             log.info('Last known commit id: %s', last_commit)
             if not CommitRunDoc.m.find(dict(commit_ids=last_commit)).count():
                 log.info('CommitRun incomplete, rebuilding with all commits')
@@ -101,6 +116,15 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
         rb.cleanup()
         log.info('Finished CommitRunBuilder for %s', repo.full_fs_path)
 
+    if repo.commit_graph_enabled:
+        refresh_commit_graph(repo, commit_ids, all_commit_ids,
+                             rebuild=all_commits or new_clone)
+
+    if repo._refresh_precompute and asbool(
+            tg.config.get('scm.refresh.last_commits', False)):
+        # build the LCDs now, so the first visitor doesn't have to
+        refresh_last_commits(repo, list(reversed(commit_ids)))
+
     # Clear any existing caches for branches/tags
     if repo.cached_branches:
         repo.cached_branches = []
@@ -195,6 +219,285 @@ def refresh_children(ci):
         multi=True)
 
 
+def refresh_commits_bulk(repo, commit_ids, lazy=True, batch_size=None):
+    '''
+    Store the commit and tree info for a list of commit ids (heads first, as
+    returned by all_commit_ids) using bulk writes.
+
+    Commit info is streamed from the SCM by the repo's bulk_commit_info
+    rather than looked up one commit at a time, and child_ids are computed
+    in memory from the parent graph instead of with a separate update per
+    commit.  Only parents that were stored before their children (including
+    commits from earlier refreshes) need an update afterwards.
+
+    Returns the number of commits processed.
+    '''
+    if batch_size is None:
+        batch_size = asint(tg.config.get('scm.refresh.bulk.batch_size', 1000))
+    writer = CommitBulkWriter(batch_size, lazy)
+    children = defaultdict(list)
+    seen = set()
+    num_commits = 0
+    start_time = time()
+    for ci in repo.bulk_commit_info(commit_ids):
+        ci['child_ids'] = children.pop(ci['_id'], [])
+        for parent_id in ci['parent_ids']:
+            children[parent_id].append(ci['_id'])
+        writer.add_commit(ci)
+        for tree in repo.bulk_tree_info(ci['tree_id'], seen):
+            writer.add_tree(tree)
+        num_commits += 1
+        if num_commits % batch_size == 0:
+            log.info('Refresh commit info %d: %s (%.1f commits/sec)',
+                     num_commits, ci['_id'],
+                     num_commits / (time() - start_time))
+    writer.flush()
+    for parent_id, child_ids in children.iteritems():
+        CommitDoc.m.update_partial(
+            dict(_id=parent_id),
+            {'$addToSet': dict(child_ids={'$each': child_ids})})
+    elapsed = time() - start_time
+    log.info('Refreshed %d commits and %d trees in %.1fs (%.1f commits/sec)',
+             num_commits, writer.num_trees, elapsed,
+             num_commits / elapsed if elapsed else 0)
+    return num_commits
+
+
+class CommitBulkWriter(object):
+
+    '''
+    Buffer CommitDoc and TreeDoc writes and send them to mongo as multi-document
+    inserts of up to batch_size documents.
+
+    Trees are content-addressed, so one that already exists is left alone.
+    Commits that already exist are left alone if lazy, otherwise they are
+    updated in place (keeping their repo_ids, and adding to their child_ids).
+    '''
+
+    def __init__(self, batch_size=1000, lazy=True):
+        self.batch_size = batch_size
+        self.lazy = lazy
+        self.num_commits = 0
+        self.num_trees = 0
+        self._commits = []
+        self._trees = []
+
+    def add_commit(self, doc):
+        self._commits.append(doc)
+        if len(self._commits) >= self.batch_size:
+            self.flush_commits()
+
+    def add_tree(self, doc):
+        self._trees.append(doc)
+        if len(self._trees) >= self.batch_size:
+            self.flush_trees()
+
+    def flush(self):
+        self.flush_commits()
+        self.flush_trees()
+
+    def flush_commits(self):
+        docs, self._commits = self._commits, []
+        if not docs:
+            return
+        if not self.lazy:
+            existing = set(ci['_id'] for ci in self._collection(CommitDoc).find(
+                {'_id': {'$in': [doc['_id'] for doc in docs]}}, fields=['_id']))
+            for doc in docs:
+                if doc['_id'] in existing:
+                    fields = dict(doc)
+                    del fields['_id'], fields['repo_ids'], fields['child_ids']
+                    # forks sharing the commit may have recorded other children
+                    CommitDoc.m.update_partial(
+                        dict(_id=doc['_id']),
+                        {'$set': fields,
+                         '$addToSet': dict(child_ids={'$each': doc['child_ids']})})
+            docs = [doc for doc in docs if doc['_id'] not in existing]
+        self._insert(CommitDoc, docs)
+        self.num_commits += len(docs)
+
+    def flush_trees(self):
+        docs, self._trees = self._trees, []
+        self._insert(TreeDoc, docs)
+        self.num_trees += len(docs)
+
+    def _collection(self, doc_cls):
+        # bypass Ming validation and use pymongo directly, like
+        # security.Credentials does, since the docs are built by us
+        return main_doc_session.db[doc_cls.m.collection_name]
+
+    def _insert(self, doc_cls, docs):
+        if not docs:
+            return
+        try:
+            self._collection(doc_cls).insert(docs, continue_on_error=True)
+        except DuplicateKeyError:
+            # docs stored by a concurrent or earlier refresh; the rest of
+            # the batch was still inserted
+            pass
+
+
+def refresh_commit_graph(repo, commit_ids, all_commit_ids, rebuild=False):
+    '''
+    Add commit_ids to the repo's CommitGraph index.  The whole index is built
+    from all_commit_ids instead if rebuild is True, if there isn't one yet,
+    or if it doesn't have all the parents of the new commits (e.g., because
+    it was enabled after the repo was first refreshed).
+    '''
+    graph = None if rebuild else CommitGraph.load(repo.commit_graph_path)
+    if graph is not None:
+        commits = _commit_graph_entries(commit_ids)
+        parent_ids = set(chain.from_iterable(
+            parents for parents, date in commits.itervalues()))
+        if any(p not in commits and p not in graph for p in parent_ids):
+            log.info('Commit graph for %s is incomplete, rebuilding',
+                     repo.full_fs_path)
+            graph = None
+    if graph is None:
+        commits = _commit_graph_entries(all_commit_ids)
+    repo.__dict__['commit_graph'] = CommitGraph.write(
+        repo.commit_graph_path, commits, base=graph)
+    log.info('Commit graph for %s has %d commits',
+             repo.full_fs_path, len(repo.commit_graph))
+
+
+def _commit_graph_entries(commit_ids):
+    commits = {}
+    for oids in utils.chunked_iter(commit_ids, QSIZE):
+        for ci in CommitDoc.m.find(dict(_id={'$in': list(oids)})):
+            commits[ci._id] = (ci.parent_ids, timestamp(ci.committed.date))
+    return commits
+
+
+def refresh_last_commits(repo, commit_ids, workers=None, limit=None,
+                         model_cache=None):
+    '''
+    Build the LastCommitDocs for the trees changed by each of commit_ids,
+    which must be in topological order, parents first (i.e., the reverse of
+    all_commit_ids).
+
+    Each LCD is built from the LCD of the same tree at the previous commit to
+    change it.  Which commit that was is tracked while walking the commits,
+    so the SCM only has to be asked about trees last changed before the
+    first of commit_ids.  The changes made by each commit are read from the
+    SCM ahead of time by a pool of worker threads.
+
+    A ModelCache to use can be given, e.g. to report its stats afterwards.
+
+    Returns the number of LCDs built.
+    '''
+    if workers is None:
+        workers = asint(tg.config.get('scm.refresh.last_commits.workers', 4))
+    if limit:
+        commit_ids = commit_ids[:limit]
+    walked = set(commit_ids)
+    # {commit_id: [{path: last commit to change it}, children not yet walked]}
+    last_changed = {}
+    prev_model_cache = getattr(c, 'model_cache', '')
+    prev_lcid_cache = getattr(c, 'lcid_cache', '')
+    c.model_cache = model_cache or ModelCache(
+        max_instances={LastCommit: 4000},
+        max_queries={LastCommit: 4000},
+    )
+    pool = ThreadPool(workers) if workers > 1 else None
+    num_built = 0
+    start = time()
+    try:
+        for i, oids in enumerate(utils.chunked_iter(commit_ids, QSIZE)):
+            oids = list(oids)
+            commits = dict((ci._id, ci) for ci in
+                           Commit.query.find(dict(_id={'$in': oids})))
+            commits = [commits[oid] for oid in oids if oid in commits]
+            for ci in commits:
+                ci.set_context(repo)
+            # the SCM calls for each commit are independent, so make them
+            # concurrently; the LCDs have to be built in order
+            (pool.map if pool else map)(_read_changed_paths, commits)
+            for ci in commits:
+                num_built += _build_last_commits(ci, walked, last_changed)
+            c.model_cache.flush()
+            ThreadLocalORMSession.flush_all()
+            for ci in commits:
+                session(ci).expunge(ci)
+            log.info('Refresh last commits %d: %d LCDs built (%.1f commits/sec)',
+                     i * QSIZE + len(oids), num_built,
+                     (i * QSIZE + len(oids)) / max(time() - start, 0.001))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        c.model_cache = prev_model_cache
+        c.lcid_cache = prev_lcid_cache
+    return num_built
+
+
+def _read_changed_paths(commit):
+    # evaluate the lazy properties that need the SCM, outside of _build
+    commit.changed_paths
+    commit.added_paths
+
+
+def _build_last_commits(commit, walked, last_changed):
+    '''Build the LCDs for the trees changed by commit, using and updating
+    the last commit to change each path, as tracked by last_changed.'''
+    lcids = _parent_last_changed(commit.parent_ids, last_changed)
+    # used by LastCommit._prev_commit_id; paths not in it fall back to the SCM
+    c.lcid_cache = lcids
+    num_built = 0
+    to_visit = []
+    if '' in commit.changed_paths:
+        to_visit.append(commit.tree)
+    while to_visit:
+        tree = to_visit.pop()
+        path = tree.path().strip('/')
+        lcd = c.model_cache.get(
+            LastCommit, {'path': path, 'commit_id': commit._id})
+        if lcd is None:
+            LastCommit._build(tree)
+            num_built += 1
+        for node in tree.tree_ids:
+            if os.path.join(path, node.name) in commit.changed_paths:
+                try:
+                    to_visit.append(tree[node.name])
+                except KeyError:
+                    pass
+    # changed_paths includes every parent dir of a change, so this covers
+    # all of the trees changed, including removed ones
+    lcids.update((os.path.dirname(p), commit._id) for p in commit.changed_paths)
+    children = len(walked.intersection(commit.child_ids))
+    if children:
+        last_changed[commit._id] = [lcids, children]
+    return num_built
+
+
+def _parent_last_changed(parent_ids, last_changed):
+    '''
+    Return {path: last commit to change it} as of the given parents.  For a
+    merge, only the paths for which all parents agree are known.  Parents
+    which weren't walked contribute nothing.
+    '''
+    states = []
+    for parent_id in parent_ids:
+        entry = last_changed.get(parent_id)
+        if entry is None:
+            states.append(({}, True))
+            continue
+        entry[1] -= 1
+        if entry[1]:
+            states.append((entry[0], False))
+        else:
+            # last child, so it can be updated in place
+            states.append((last_changed.pop(parent_id)[0], True))
+    if not states:
+        return {}
+    if len(states) == 1:
+        state, owned = states[0]
+        return state if owned else dict(state)
+    first = states[0][0]
+    return dict((path, cid) for path, cid in first.iteritems()
+                if all(s.get(path) == cid for s, owned in states[1:]))
+
+
 class CommitRunBuilder(object):
 
     '''Class used to build up linear runs of single-parent commits'''
@@ -353,7 +656,7 @@ def send_notifications(repo, commit_ids):
                 link=href,
                 unique_id=href)
 
-            summary = g.markdown_commit.convert(ci.message) if ci.message else ""
+            summary = g.markdown_commit.shared_convert(ci.message) if ci.message else ""
             current_branch = repo.symbolics_for_commit(ci)[0]  # only the head of a branch will have this
             commit_msgs.append(dict(
                 author=ci.authored.name,
@@ -415,7 +718,7 @@ def _summarize(message):
     return ' '.join(summary)
 
 
-def last_known_commit_id(all_commit_ids, new_commit_ids):
+def last_known_commit_id(all_commit_ids, new_commit_ids, graph=None):
     """
     Return the newest "known" (cached in mongo) commit id.
 
@@ -424,9 +727,16 @@ def last_known_commit_id(all_commit_ids, new_commit_ids):
                         newest.
         new_commit_ids: Commit ids that are not yet cached in mongo, sorted
                         oldest to newest.
+        graph: Optional CommitGraph of the commits known as of the last
+               refresh.  If given, the known commit with the highest
+               generation number is returned, regardless of ordering.
     """
     if not all_commit_ids:
         return None
+    if graph is not None:
+        known = [oid for oid in all_commit_ids if oid in graph]
+        if known:
+            return max(known, key=graph.generation)
     if not new_commit_ids:
         return all_commit_ids[-1]
     return all_commit_ids[all_commit_ids.index(new_commit_ids[0]) - 1]
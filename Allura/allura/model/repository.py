@@ -16,6 +16,7 @@
 #       under the License.
 import json
 import os
+import sys
 import stat
 import mimetypes
 import logging
@@ -30,7 +31,7 @@
 from threading import Thread
 from Queue import Queue
 from itertools import chain, islice
-from difflib import SequenceMatcher
+from difflib import SequenceMatcher, unified_diff
 
 import tg
 from paste.deploy.converters import asint, asbool
@@ -43,11 +44,12 @@
 from ming import schema as S
 from ming import Field, collection, Index
 from ming.utils import LazyProperty
-from ming.orm import FieldProperty, session, Mapper, mapper
+from ming.orm import FieldProperty, session, state, Mapper, mapper
 from ming.base import Object
 
 from allura.lib import helpers as h
 from allura.lib import utils
+from allura.lib.commit_graph import CommitGraph
 from allura.lib.security import has_access
 
 from .artifact import Artifact, VersionedArtifact
@@ -97,6 +99,7 @@
 PYPELINE_EXTENSIONS = frozenset(utils.MARKDOWN_EXTENSIONS + ['.rst'])
 
 DIFF_SIMILARITY_THRESHOLD = .5  # used for determining file renames
+BLOB_CHUNK_SIZE = 64 * 1024  # for streaming blob content
 
 
 class RepositoryImplementation(object):
@@ -131,6 +134,33 @@ def refresh_commit_info(self, oid, lazy=True):  # pragma no cover
         '''Refresh the data in the commit with id oid'''
         raise NotImplementedError('refresh_commit_info')
 
+    def unknown_commit_ids(self, all_commit_ids):
+        '''Return the commit ids in all_commit_ids that aren't stored yet, in
+        the same order.  Implementations may have a quicker way than looking
+        them all up.'''
+        from allura.model.repo_refresh import unknown_commit_ids
+        return unknown_commit_ids(all_commit_ids)
+
+    # Set to True by implementations that provide bulk_commit_info and
+    # bulk_tree_info, so refresh can use the bulk ingestion path
+    supports_bulk_refresh = False
+
+    def bulk_commit_info(self, commit_ids):  # pragma no cover
+        '''Yield a dict shaped like a CommitDoc for each of the given commit
+        ids, in the order given.  Implementations should stream the data from
+        the SCM rather than looking up each commit separately.'''
+        raise NotImplementedError('bulk_commit_info')
+
+    def bulk_tree_info(self, tree_id, seen):  # pragma no cover
+        '''Yield a dict shaped like a TreeDoc for the tree with id tree_id and
+        each of its subtrees, skipping any tree ids already in seen (and adding
+        the ones yielded to it).'''
+        raise NotImplementedError('bulk_tree_info')
+
+    # Set to True by implementations whose commit ids are 40 character hex
+    # strings, so they can be indexed by a CommitGraph
+    supports_commit_graph = False
+
     def _setup_hooks(self, source_path=None):  # pragma no cover
         '''Install a hook in the repository that will ping the refresh url for
         the repo.  Optionally provide a path from which to copy existing hooks.'''
@@ -171,6 +201,12 @@ def blob_size(self, blob):
         '''Return a blob size in bytes'''
         raise NotImplementedError('blob_size')
 
+    def unified_diff(self, a, b, a_desc, b_desc):
+        '''Yield the lines of a unified diff from blob a (None for a new file)
+        to blob b, labelled a_desc and b_desc.  Implementations should have
+        the SCM compute it, rather than reading both blobs into memory.'''
+        return unified_diff(list(a) if a else [], list(b), a_desc, b_desc)
+
     def tarball(self, revision, path=None):
         '''Create a tarball for the revision'''
         raise NotImplementedError('tarball')
@@ -454,12 +490,53 @@ def all_commit_ids(self):
     def refresh_commit_info(self, oid, seen, lazy=True):
         return self._impl.refresh_commit_info(oid, seen, lazy)
 
+    @property
+    def supports_bulk_refresh(self):
+        return self._impl.supports_bulk_refresh
+
+    def bulk_commit_info(self, commit_ids):
+        return self._impl.bulk_commit_info(commit_ids)
+
+    def bulk_tree_info(self, tree_id, seen):
+        return self._impl.bulk_tree_info(tree_id, seen)
+
+    @property
+    def commit_graph_path(self):
+        return os.path.join(self.full_fs_path, tg.config.get(
+            'scm.commit_graph.filename', '.ALLURA-COMMIT-GRAPH'))
+
+    @property
+    def commit_graph_enabled(self):
+        return (asbool(tg.config.get('scm.commit_graph.enable', False))
+                and self._impl.supports_commit_graph)
+
+    @LazyProperty
+    def commit_graph(self):
+        '''
+        The :class:`~allura.lib.commit_graph.CommitGraph` index of the commits
+        known as of the last refresh, or None if it isn't enabled or hasn't
+        been built yet.
+        '''
+        if not self.commit_graph_enabled:
+            return None
+        return CommitGraph.load(self.commit_graph_path)
+
+    def is_ancestor(self, ancestor_id, commit_id):
+        '''Return True if the commit ancestor_id is reachable from commit_id'''
+        graph = self.commit_graph
+        if graph is not None and ancestor_id in graph and commit_id in graph:
+            return graph.is_ancestor(ancestor_id, commit_id)
+        return ancestor_id in self.log(commit_id, id_only=True)
+
     def open_blob(self, blob):
         return self._impl.open_blob(blob)
 
     def blob_size(self, blob):
         return self._impl.blob_size(blob)
 
+    def unified_diff(self, a, b, a_desc, b_desc):
+        return self._impl.unified_diff(a, b, a_desc, b_desc)
+
     def shorthand_for_commit(self, oid):
         return self._impl.shorthand_for_commit(oid)
 
@@ -567,9 +644,36 @@ def log(self, revs=None, path=None, exclude=None, id_only=True, limit=None, **kw
             revs = [revs]
         if exclude is not None and not isinstance(exclude, (list, tuple)):
             exclude = [exclude]
+        if id_only and not path and not exclude and not kw:
+            commit_ids = self._commit_graph_revs(revs)
+            if commit_ids is not None:
+                return self.commit_graph.log(commit_ids, limit)
         log_iter = self._impl.log(revs, path, exclude=exclude, id_only=id_only, limit=limit, **kw)
         return islice(log_iter, limit)
 
+    def _commit_graph_revs(self, revs):
+        '''
+        Resolve revs to commit ids in the commit graph, or return None if
+        there is no commit graph or any of them isn't in it (e.g., because
+        it was pushed after the last refresh).
+        '''
+        graph = self.commit_graph
+        if graph is None:
+            return None
+        if revs is None:
+            revs = [self.head]
+        commit_ids = []
+        for rev in revs:
+            if rev not in graph:
+                try:
+                    rev = self.rev_to_commit_id(rev)
+                except Exception:
+                    return None
+                if rev not in graph:
+                    return None
+            commit_ids.append(rev)
+        return commit_ids
+
     def latest(self, branch=None):
         if self._impl is None:
             return None
@@ -704,9 +808,10 @@ def guess_type(self, name):
                 content_type, encoding = 'application/octet-stream', None
         return content_type, encoding
 
-    def unknown_commit_ids(self):
-        from allura.model.repo_refresh import unknown_commit_ids as unknown_commit_ids_repo
-        return unknown_commit_ids_repo(self.all_commit_ids())
+    def unknown_commit_ids(self, all_commit_ids=None):
+        if all_commit_ids is None:
+            all_commit_ids = self.all_commit_ids()
+        return self._impl.unknown_commit_ids(all_commit_ids)
 
     def refresh(self, all_commits=False, notify=True, new_clone=False, commits_are_new=None):
         '''Find any new commits in the repository and update'''
@@ -1567,6 +1672,28 @@ def open(self):
     def __iter__(self):
         return iter(self.open())
 
+    def iter_bytes(self, start=0, stop=None, chunk_size=BLOB_CHUNK_SIZE):
+        '''Yield the content from byte start up to byte stop, in chunks of up
+        to chunk_size bytes read from the SCM as they're needed'''
+        f = self.open()
+        try:
+            pos = 0
+            # the SCM streams can't seek
+            while pos < start:
+                data = f.read(min(chunk_size, start - pos))
+                if not data:
+                    return
+                pos += len(data)
+            while stop is None or pos < stop:
+                data = f.read(chunk_size if stop is None
+                              else min(chunk_size, stop - pos))
+                if not data:
+                    return
+                pos += len(data)
+                yield data
+        finally:
+            f.close()
+
     @LazyProperty
     def size(self):
         return self.repo.blob_size(self)
@@ -1687,9 +1814,14 @@ class ModelCache(object):
     The added complexity here may be unnecessary premature optimization, but
     should be quite helpful when building up many models in order, like lcd _build
     for a series of several new commits.
+
+    Instances evicted from the cache are flushed in batches rather than one
+    at a time, and hits, misses and evictions are counted for each model
+    type (see :meth:`stats`) to help size the cache for a given workload.
     '''
 
-    def __init__(self, max_instances=None, max_queries=None):
+    def __init__(self, max_instances=None, max_queries=None, max_size=None,
+                 flush_batch_size=100):
         '''
         By default, each model type can have 2000 instances and
         8000 queries.  You can override these for specific model
@@ -1700,31 +1832,53 @@ def __init__(self, max_instances=None, max_queries=None):
 
         If you pass in a number instead of a dict, that value will
         be used as the max for all classes.
+
+        max_size can also limit the total size of the cached instances of
+        each model type, in bytes (as measured by their BSON encoding), in
+        the same way.  By default there is no size limit.
+
+        Evicted instances are flushed once flush_batch_size of them have
+        accumulated, or when :meth:`flush` is called.
         '''
         max_instances_default = 2000
         max_queries_default = 8000
+        max_size_default = None
         if isinstance(max_instances, int):
             max_instances_default = max_instances
         if isinstance(max_queries, int):
             max_queries_default = max_queries
+        if isinstance(max_size, int):
+            max_size_default = max_size
         self._max_instances = defaultdict(lambda: max_instances_default)
         self._max_queries = defaultdict(lambda: max_queries_default)
+        self._max_size = defaultdict(lambda: max_size_default)
         if hasattr(max_instances, 'items'):
             self._max_instances.update(max_instances)
         if hasattr(max_queries, 'items'):
             self._max_queries.update(max_queries)
+        if hasattr(max_size, 'items'):
+            self._max_size.update(max_size)
 
         # keyed by query, holds _id
         self._query_cache = defaultdict(OrderedDict)
         self._instance_cache = defaultdict(OrderedDict)  # keyed by _id
         self._synthetic_ids = defaultdict(set)
         self._synthetic_id_queries = defaultdict(set)
+        self._sizes = defaultdict(dict)  # keyed by _id, if max_size is set
+        self._total_size = defaultdict(int)
+        # evicted instances waiting to be flushed, keyed by id()
+        self._flush_batch_size = flush_batch_size
+        self._evicted = OrderedDict()
+        self._stats = defaultdict(lambda: defaultdict(int))
 
     def _normalize_query(self, query):
-        _query = query
-        if not isinstance(_query, tuple):
-            _query = tuple(sorted(_query.items(), key=lambda k: k[0]))
-        return _query
+        '''Return the hashable key for query, which can then be passed
+        to the other methods instead of the query, to avoid recomputing it'''
+        if isinstance(query, tuple):
+            return query
+        if len(query) == 1:
+            return tuple(query.items())
+        return tuple(sorted(query.items(), key=lambda k: k[0]))
 
     def _model_query(self, cls):
         if hasattr(cls, 'query'):
@@ -1737,65 +1891,100 @@ def _model_query(self, cls):
 
     def get(self, cls, query):
         _query = self._normalize_query(query)
-        self._touch(cls, _query)
-        if _query not in self._query_cache[cls]:
-            val = self._model_query(cls).get(**query)
-            self.set(cls, _query, val)
-            return val
-        _id = self._query_cache[cls][_query]
-        if _id is None:
-            return None
-        if _id not in self._instance_cache[cls]:
-            val = self._model_query(cls).get(**query)
-            self.set(cls, _query, val)
-            return val
-        return self._instance_cache[cls][_id]
+        query_cache = self._query_cache[cls]
+        if _query in query_cache:
+            _id = query_cache.pop(_query)
+            query_cache[_query] = _id
+            if _id is None:
+                self._stats[cls]['hits'] += 1
+                return None
+            instance_cache = self._instance_cache[cls]
+            if _id in instance_cache:
+                val = instance_cache.pop(_id)
+                instance_cache[_id] = val
+                self._stats[cls]['hits'] += 1
+                return val
+        self._stats[cls]['misses'] += 1
+        val = self._model_query(cls).get(**query)
+        self.set(cls, _query, val)
+        return val
 
     def set(self, cls, query, val):
         _query = self._normalize_query(query)
+        query_cache = self._query_cache[cls]
         if val is not None:
             _id = getattr(val, '_model_cache_id',
                           getattr(val, '_id',
-                                  self._query_cache[cls].get(_query,
-                                                             None)))
+                                  query_cache.get(_query, None)))
             if _id is None:
                 _id = val._model_cache_id = bson.ObjectId()
                 self._synthetic_ids[cls].add(_id)
-            if _id in self._synthetic_ids:
+            if _id in self._synthetic_ids[cls]:
                 self._synthetic_id_queries[cls].add(_query)
-            self._query_cache[cls][_query] = _id
-            self._instance_cache[cls][_id] = val
+            query_cache.pop(_query, None)
+            query_cache[_query] = _id
+            instance_cache = self._instance_cache[cls]
+            instance_cache.pop(_id, None)
+            instance_cache[_id] = val
+            # it's in use again, so don't expunge it
+            self._evicted.pop(id(val), None)
+            if self._max_size[cls] is not None:
+                self._forget_size(cls, _id)
+                size = self._sizes[cls][_id] = self._instance_size(val)
+                self._total_size[cls] += size
         else:
-            self._query_cache[cls][_query] = None
-        self._touch(cls, _query)
+            query_cache.pop(_query, None)
+            query_cache[_query] = None
         self._check_sizes(cls)
 
-    def _touch(self, cls, query):
-        '''
-        Keep track of insertion order, prevent duplicates,
-        and expire from the cache in a FIFO manner.
-        '''
-        _query = self._normalize_query(query)
-        if _query not in self._query_cache[cls]:
-            return
-        _id = self._query_cache[cls].pop(_query)
-        self._query_cache[cls][_query] = _id
+    def _instance_size(self, instance):
+        try:
+            return len(bson.BSON.encode(state(instance).document))
+        except Exception:
+            return sys.getsizeof(instance)
 
-        if _id not in self._instance_cache[cls]:
-            return
-        val = self._instance_cache[cls].pop(_id)
-        self._instance_cache[cls][_id] = val
+    def _forget_size(self, cls, _id):
+        size = self._sizes[cls].pop(_id, None)
+        if size is not None:
+            self._total_size[cls] -= size
 
     def _check_sizes(self, cls):
-        if self.num_queries(cls) > self._max_queries[cls]:
-            _id = self._remove_least_recently_used(self._query_cache[cls])
-            if _id in self._instance_cache[cls]:
-                instance = self._instance_cache[cls][_id]
-                self._try_flush(instance, expunge=False)
-        if self.num_instances(cls) > self._max_instances[cls]:
-            instance = self._remove_least_recently_used(
-                self._instance_cache[cls])
-            self._try_flush(instance, expunge=True)
+        query_cache = self._query_cache[cls]
+        instance_cache = self._instance_cache[cls]
+        if len(query_cache) > self._max_queries[cls]:
+            # least recently used is first
+            _query, _id = query_cache.popitem(last=False)
+            self._synthetic_id_queries[cls].discard(_query)
+            if _id in instance_cache:
+                self._evict(instance_cache[_id], expunge=False)
+        max_size = self._max_size[cls]
+        while instance_cache and (
+                len(instance_cache) > self._max_instances[cls] or
+                (max_size is not None and self._total_size[cls] > max_size
+                 and len(instance_cache) > 1)):
+            _id, instance = instance_cache.popitem(last=False)
+            self._forget_size(cls, _id)
+            self._synthetic_ids[cls].discard(_id)
+            self._stats[cls]['evictions'] += 1
+            self._evict(instance, expunge=True)
+
+    def _evict(self, instance, expunge):
+        key = id(instance)
+        if key in self._evicted:
+            expunge = expunge or self._evicted[key][1]
+        self._evicted[key] = (instance, expunge)
+        if len(self._evicted) >= self._flush_batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Flush the instances evicted since the last flush, and expunge the
+        ones evicted from the instance cache, so their sessions don't keep
+        them around.
+        '''
+        evicted, self._evicted = self._evicted, OrderedDict()
+        for instance, expunge in evicted.itervalues():
+            self._try_flush(instance, expunge=expunge)
 
     def _try_flush(self, instance, expunge=False):
         try:
@@ -1807,11 +1996,6 @@ def _try_flush(self, instance, expunge=False):
             if expunge:
                 inst_session.expunge(instance)
 
-    def _remove_least_recently_used(self, cache):
-        # last-used (most-recently-used) is last in cache, so take first
-        key, val = cache.popitem(last=False)
-        return val
-
     def expire_new_instances(self, cls):
         '''
         Expire any instances that were "new" or had no _id value.
@@ -1824,11 +2008,13 @@ def expire_new_instances(self, cls):
         and instance cache sizes) to avoid this.
         '''
         for _query in self._synthetic_id_queries[cls]:
-            self._query_cache[cls].pop(_query)
+            self._query_cache[cls].pop(_query, None)
         self._synthetic_id_queries[cls] = set()
         for _id in self._synthetic_ids[cls]:
-            instance = self._instance_cache[cls].pop(_id)
-            self._try_flush(instance, expunge=True)
+            instance = self._instance_cache[cls].pop(_id, None)
+            if instance is not None:
+                self._forget_size(cls, _id)
+                self._try_flush(instance, expunge=True)
         self._synthetic_ids[cls] = set()
 
     def num_queries(self, cls=None):
@@ -1846,6 +2032,23 @@ def num_instances(self, cls=None):
     def instance_ids(self, cls):
         return self._instance_cache[cls].keys()
 
+    def stats(self):
+        '''
+        Return {model class name: stats} where stats is a dict of the number
+        of hits, misses and evictions so far, and the number of queries and
+        instances (and their size, if limited) currently cached.
+        '''
+        result = {}
+        for cls in set(self._stats) | set(self._query_cache):
+            stats = dict(hits=0, misses=0, evictions=0)
+            stats.update(self._stats[cls])
+            stats['queries'] = len(self._query_cache[cls])
+            stats['instances'] = len(self._instance_cache[cls])
+            if self._max_size[cls] is not None:
+                stats['size'] = self._total_size[cls]
+            result[cls.__name__] = stats
+        return result
+
     def batch_load(self, cls, query, attrs=None):
         '''
         Load multiple results given a query.
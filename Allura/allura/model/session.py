@@ -138,12 +138,38 @@ def after_flush(self, obj=None):
     def update_index(self, objects_deleted, arefs):
         # Post delete and add indexing operations
         if objects_deleted:
-            index_tasks.del_artifacts.post(
-                [obj.index_id() for obj in objects_deleted])
+            from .monq_model import MonQTask
+            index_ids = [obj.index_id() for obj in objects_deleted]
+            # no need to index them if they're about to be deleted anyway
+            MonQTask.discard_pending(index_tasks.add_artifacts, index_ids)
+            index_tasks.del_artifacts.post(index_ids)
         if arefs:
             index_tasks.add_artifacts.post([aref._id for aref in arefs])
 
 
+class SecurityCacheSessionExtension(ManagedSessionExtension):
+
+    def after_flush(self, obj=None):
+        """
+        Drop shared role closures for the projects whose roles changed, and
+        the ACL keys (see :func:`allura.lib.security.acl_key`) kept for
+        changed objects
+        """
+        from pylons import app_globals as g
+        from .auth import ProjectRole
+        for o in self.objects_modified:
+            state(o).extra_state.pop('acl_key', None)
+        cache = g.security_cache if hasattr(g, 'security_cache') else None
+        if cache is not None:
+            project_ids = set(
+                o.project_id
+                for o in self.objects_added + self.objects_modified + self.objects_deleted
+                if isinstance(o, ProjectRole))
+            for project_id in project_ids:
+                cache.invalidate_project(project_id)
+        super(SecurityCacheSessionExtension, self).after_flush(obj)
+
+
 class BatchIndexer(ArtifactSessionExtension):
 
     """
@@ -249,16 +275,16 @@ def substitute_extensions(session, extensions=None):
 task_doc_session = Session.by_name('task')
 main_orm_session = ThreadLocalORMSession(
     doc_session=main_doc_session,
-    extensions=[IndexerSessionExtension]
+    extensions=[IndexerSessionExtension, SecurityCacheSessionExtension]
     )
 project_orm_session = ThreadLocalORMSession(
     doc_session=project_doc_session,
-    extensions=[IndexerSessionExtension]
+    extensions=[IndexerSessionExtension, SecurityCacheSessionExtension]
 )
 task_orm_session = ThreadLocalORMSession(task_doc_session)
 artifact_orm_session = ThreadLocalORMSession(
     doc_session=project_doc_session,
-    extensions=[ArtifactSessionExtension])
+    extensions=[ArtifactSessionExtension, SecurityCacheSessionExtension])
 repository_orm_session = ThreadLocalORMSession(
     doc_session=main_doc_session,
     extensions=[])
@@ -17,6 +17,7 @@
 
 import bson
 import logging
+from collections import defaultdict
 
 from ming.odm import Mapper
 from pylons import tmpl_context as c
@@ -144,3 +145,73 @@ def _perm_check(activity):
         obj = get_activity_object(activity.obj)
         return obj is None or obj.has_activity_access('read', user, activity)
     return _perm_check
+
+
+def get_activity_objects(activity_object_dicts):
+    """Like :func:`get_activity_object` for a list of activity objects, but
+    loading them with one query per class.
+
+    """
+    ids_by_class = defaultdict(list)
+    keys = []
+    for activity_object_dict in activity_object_dicts:
+        extras_dict = activity_object_dict.activity_extras
+        allura_id = extras_dict.get('allura_id') if extras_dict else None
+        if not allura_id:
+            keys.append(None)
+            continue
+        classname, _id = allura_id.split(':', 1)
+        try:
+            _id = bson.ObjectId(_id)
+        except bson.errors.InvalidId:
+            pass
+        ids_by_class[classname].append(_id)
+        keys.append((classname, _id))
+    objects = {}
+    for classname, ids in ids_by_class.iteritems():
+        cls = Mapper.by_classname(classname).mapped_class
+        for obj in cls.query.find(dict(_id={'$in': ids})):
+            objects[classname, obj._id] = obj
+    return [objects.get(key) if key else None for key in keys]
+
+
+def perm_check_many(user, activities, limit=None):
+    """
+    Return the activities that ``user`` has 'read' access to, like
+    ``filter(perm_check(user), activities)``, stopping once ``limit`` are
+    found.
+
+    The activity objects are loaded together, and the ones that use the
+    default :meth:`has_activity_access` are checked with
+    :func:`~allura.lib.security.has_access_many`.
+    """
+    readable = []
+    chunk_size = limit or len(activities) or 1
+    for start in range(0, len(activities), chunk_size):
+        readable += _perm_check_chunk(user, activities[start:start + chunk_size])
+        if limit and len(readable) >= limit:
+            return readable[:limit]
+    return readable
+
+
+def _perm_check_chunk(user, activities):
+    objs = get_activity_objects([a.obj for a in activities])
+    default_check = ActivityObject.has_activity_access.__func__
+    allowed = [True] * len(activities)
+    by_project = defaultdict(list)
+    for i, (activity, obj) in enumerate(zip(activities, objs)):
+        if obj is None:
+            continue
+        if getattr(type(obj).has_activity_access, '__func__', None) is not default_check:
+            allowed[i] = bool(obj.has_activity_access('read', user, activity))
+        elif obj.project is None or getattr(obj, 'deleted', False):
+            allowed[i] = False
+        else:
+            by_project[obj.project._id].append(i)
+    for indexes in by_project.itervalues():
+        project = objs[indexes[0]].project
+        checked = security.has_access_many(
+            [objs[i] for i in indexes], 'read', user, project)
+        for i, ok in zip(indexes, checked):
+            allowed[i] = ok
+    return [a for a, ok in zip(activities, allowed) if ok]
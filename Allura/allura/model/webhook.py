@@ -35,6 +35,9 @@ class __mongometa__:
     hook_url = FieldProperty(str)
     secret = FieldProperty(str)
     last_sent = FieldProperty(dt.datetime, if_missing=None)
+    # consecutive failed sends
+    failures = FieldProperty(int, if_missing=0)
+    last_failure = FieldProperty(dt.datetime, if_missing=None)
 
     def url(self):
         app = self.app_config.load()
@@ -56,6 +59,34 @@ def update_limit(self):
         self.last_sent = dt.datetime.utcnow()
         session(self).flush(self)
 
+    def is_failing(self):
+        '''
+        True if the last webhook.max_failures sends failed, and the last one
+        was less than webhook.failure_timeout seconds ago.  Such webhooks are
+        not sent; after the timeout, one more attempt is made.
+        '''
+        max_failures = asint(config.get('webhook.max_failures', 10))
+        if not max_failures or self.failures < max_failures:
+            return False
+        timeout = asint(config.get('webhook.failure_timeout', 3600))
+        now = dt.datetime.utcnow()
+        return (now - self.last_failure) < dt.timedelta(seconds=timeout)
+
+    def record_failure(self):
+        # atomically, since several tasks may be sending to this webhook
+        Webhook.query.find_and_modify(
+            query=dict(_id=self._id),
+            update={'$inc': dict(failures=1),
+                    '$set': dict(last_failure=dt.datetime.utcnow())},
+            new=True)
+
+    def record_success(self):
+        if self.failures:
+            Webhook.query.find_and_modify(
+                query=dict(_id=self._id),
+                update={'$set': dict(failures=0)},
+                new=True)
+
     @classmethod
     def max_hooks(self, type, tool_name):
         type = type.replace('-', '_')
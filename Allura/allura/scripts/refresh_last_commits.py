@@ -17,8 +17,6 @@
 
 import argparse
 import logging
-from datetime import datetime
-from contextlib import contextmanager
 
 import faulthandler
 from pylons import tmpl_context as c
@@ -26,6 +24,7 @@
 
 from allura import model as M
 from allura.lib.utils import chunked_find
+from allura.model.repo_refresh import refresh_last_commits
 from allura.tasks.repo_tasks import refresh
 from allura.scripts import ScriptTask
 
@@ -72,6 +71,12 @@ def _repo_type_list(s):
                             default=False, help='Log names of projects that would have their ')
         parser.add_argument('--limit', action='store', type=int, dest='limit',
                             default=False, help='Limit of how many commits to process')
+        parser.add_argument('--workers', action='store', type=int, dest='workers',
+                            default=4, help='Number of threads reading commit changes '
+                            'from the SCM (default: 4)')
+        parser.add_argument('--cache-size', action='store', type=int, dest='cache_size',
+                            default=4000, help='Number of last commit docs to keep '
+                            'cached (default: 4000)')
         return parser
 
     @classmethod
@@ -135,42 +140,26 @@ def execute(cls, options):
     @classmethod
     def refresh_repo_lcds(cls, commit_ids, options):
         model_cache = M.repository.ModelCache(
-            max_instances={M.repository.LastCommit: 4000},
-            max_queries={M.repository.LastCommit: 4000},
+            max_instances={M.repository.LastCommit: options.cache_size},
+            max_queries={M.repository.LastCommit: options.cache_size},
         )
-        c.model_cache = model_cache
-        timings = []
-        print 'Processing last commits'
-        for i, commit_id in enumerate(commit_ids):
-            commit = M.repository.Commit.query.get(_id=commit_id)
-            if commit is None:
-                print "Commit missing, skipping: %s" % commit_id
-                continue
-            commit.set_context(c.app.repo)
-            with time(timings):
-                tree = commit.tree
-                cls._get_lcds(tree, model_cache)
-                ThreadLocalORMSession.flush_all()
-            if i % 100 == 0:
-                cls._print_stats(i, timings, 100)
-            if options.limit and i >= options.limit:
-                break
+        log.info('Processing last commits')
+        num_built = refresh_last_commits(c.app.repo, commit_ids,
+                                         workers=options.workers,
+                                         limit=options.limit,
+                                         model_cache=model_cache)
+        log.info('Built %d last commit docs', num_built)
+        cls._print_cache_stats(model_cache)
         ThreadLocalORMSession.flush_all()
 
     @classmethod
-    def _get_lcds(cls, tree, cache):
-        M.repository.LastCommit.get(tree)
-        """
-        FIXME: if its needed to recurse into subdirectories, and compute their LCDs as well, something along these
-        lines should be enabled.  This is not working as-is, and is not really necessary as this script doesn't
-        get used any more anyway.
-
-        for subtree in tree.tree_ids:
-            if subtree.name in tree.commit.changed_paths:
-                subtree_doc = cache.get(M.repository.Tree, dict(_id=subtree.id))
-                subtree_doc.set_context(tree)
-                cls._get_lcds(subtree_doc, cache)
-        """
+    def _print_cache_stats(cls, model_cache):
+        for name, stats in sorted(model_cache.stats().iteritems()):
+            lookups = stats['hits'] + stats['misses']
+            print '  %s cache: %d hits, %d misses (%.1f%% hit rate), %d evictions, %d instances' % (
+                name, stats['hits'], stats['misses'],
+                100.0 * stats['hits'] / lookups if lookups else 0,
+                stats['evictions'], stats['instances'])
 
     @classmethod
     def _clean(cls, commit_ids):
@@ -181,22 +170,6 @@ def _clean(cls, commit_ids):
                  i, len(commit_ids))
         M.repository.LastCommitDoc.m.remove(dict(commit_id={'$in': commit_ids}))
 
-    @classmethod
-    def _print_stats(cls, processed, timings, debug_step):
-        mt = max(timings)
-        tt = sum(timings)
-        at = tt / len(timings)
-        mat = sum(timings[-debug_step:]) / debug_step
-        print '  Processed %d commits (max: %f, avg: %f, mavg: %f, tot: %f)' % (
-            processed, mt, at, mat, tt)
-
-
-@contextmanager
-def time(timings):
-    s = datetime.utcnow()
-    yield
-    timings.append((datetime.utcnow() - s).total_seconds())
-
 
 if __name__ == '__main__':
     faulthandler.enable()
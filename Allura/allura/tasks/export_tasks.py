@@ -19,14 +19,21 @@
 import os.path
 import logging
 import shutil
+import zipfile
+from itertools import imap
+from multiprocessing.pool import ThreadPool
 
 import tg
-from pylons import app_globals as g, tmpl_context as c
+from pylons import app_globals as g, tmpl_context as c, request
+from paste.deploy.converters import asint
+from ming.orm import ThreadLocalORMSession
 
+import allura
 from allura.tasks import mail_tasks
 from allura.lib.decorators import task
 from allura.lib import helpers as h
-from allura.model.repository import zipdir
+from allura.lib.security import Credentials
+from allura.lib.utils import AttachmentCopier
 
 
 log = logging.getLogger(__name__)
@@ -61,10 +68,7 @@ def process(self, project, tools, user, filename=None, send_email=True, with_att
             os.makedirs(export_path)
         apps = [project.app_instance(tool) for tool in tools]
         exportable = self.filter_exportable(apps)
-        results = [self.export(tmp_path, app, with_attachments) for app in exportable]
-        exported = self.filter_successful(results)
-        if exported:
-            zipdir(tmp_path, export_fullpath)
+        exported = self.export_all(project, tmp_path, export_fullpath, exportable, with_attachments)
         shutil.rmtree(tmp_path.encode('utf8'))  # must encode into bytes or it'll fail on non-ascii filenames
 
         if not user:
@@ -95,12 +99,80 @@ def process(self, project, tools, user, filename=None, send_email=True, with_att
     def filter_exportable(self, apps):
         return [app for app in apps if app and app.exportable]
 
-    def export(self, export_path, app, with_attachments=False):
+    def export_all(self, project, tmp_path, export_fullpath, apps, with_attachments=False):
+        '''
+        Export ``apps`` up to ``bulk_export_workers`` at a time, and move the
+        files of each into the zip file at ``export_fullpath`` as soon as it's
+        done.  Attachments are copied by up to ``bulk_export_attachment_workers``
+        more threads, shared by all the apps.  How many apps are done is saved
+        on the export's task as they finish.
+
+        Returns the apps that were exported.
+        '''
+        export_task = project.bulk_export_task(states=('busy',))
+        progress = dict(tools=len(apps), finished=0, exported=[])
+        if export_task:
+            export_task.set_progress(**progress)
+        workers = min(asint(tg.config.get('bulk_export_workers', 2)), len(apps))
+        attachment_workers = asint(tg.config.get('bulk_export_attachment_workers', 4))
+        pool = ThreadPool(workers) if workers > 1 else None
+        attachment_pool = None
+        if with_attachments and attachment_workers > 1:
+            attachment_pool = ThreadPool(attachment_workers)
+        # the worker threads see this thread's pylons objects
+        proxies = [(proxy, proxy._current_obj()) for proxy in (c, g, request)]
+
+        def export(app):
+            return self.export(tmp_path, app, with_attachments, attachment_pool)
+
+        def export_in_context(app):
+            # with its own role cache, which isn't thread-safe
+            pushed = proxies + [(allura.credentials, Credentials())]
+            for proxy, obj in pushed:
+                proxy._push_object(obj)
+            try:
+                return export(app)
+            finally:
+                # forget what the export loaded, this thread's sessions are its own
+                ThreadLocalORMSession.close_all()
+                for proxy, obj in reversed(pushed):
+                    proxy._pop_object(obj)
+
+        # written next to the export, and only renamed to it when complete
+        partial_fullpath = export_fullpath + '.part'
+        zf = None
+        results = []
+        try:
+            for result in (pool.imap_unordered(export_in_context, apps) if pool else imap(export, apps)):
+                results.append(result)
+                if result is not None:
+                    if zf is None:
+                        zf = zipfile.ZipFile(partial_fullpath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+                    self.add_to_zip(zf, tmp_path, result)
+                    progress['exported'].append(result.config.options.mount_point)
+                progress['finished'] += 1
+                if export_task:
+                    export_task.set_progress(**progress)
+        finally:
+            for p in (pool, attachment_pool):
+                if p:
+                    p.close()
+                    p.join()
+            if zf is not None:
+                zf.close()
+        if zf is not None:
+            os.rename(partial_fullpath, export_fullpath)
+        exported = self.filter_successful(results)
+        return [app for app in apps if app in exported]
+
+    def export(self, export_path, app, with_attachments=False, attachment_pool=None):
         tool = app.config.options.mount_point
         json_file = os.path.join(export_path, '%s.json' % tool)
+        app.attachment_copier = AttachmentCopier(attachment_pool)
         try:
             with open(json_file, 'w') as f:
                 app.bulk_export(f, export_path, with_attachments)
+            app.attachment_copier.wait()
         except Exception:
             log.error('Error exporting: %s on %s', tool,
                       app.project.shortname, exc_info=True)
@@ -111,6 +183,22 @@ def export(self, export_path, app, with_attachments=False):
             return None
         else:
             return app
+        finally:
+            app.attachment_copier = None
+
+    def add_to_zip(self, zf, export_path, app):
+        '''Move the json file and attachments exported for ``app`` into ``zf``.
+        Their names in it start with the name of the ``export_path`` directory.'''
+        tool = app.config.options.mount_point
+        # bytes, for attachments with non-ascii filenames
+        root = os.path.dirname(export_path.rstrip('/')).encode('utf8')
+        paths = [os.path.join(export_path, '%s.json' % tool).encode('utf8')]
+        attachment_path = app.get_attachment_export_path(export_path).encode('utf8')
+        for dirpath, dirnames, filenames in os.walk(attachment_path):
+            paths.extend(os.path.join(dirpath, fn) for fn in filenames)
+        for path in paths:
+            zf.write(path, h.really_unicode(os.path.relpath(path, root)))
+            os.remove(path)
 
     def filter_successful(self, results):
         return [result for result in results if result is not None]
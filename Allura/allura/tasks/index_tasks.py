@@ -35,12 +35,31 @@ def __get_solr(solr_hosts=None):
     return make_solr_from_config(solr_hosts) if solr_hosts else g.solr
 
 
+def __add_docs(docs, solr_hosts=None):
+    # taskd may collect documents from many tasks and send them together
+    index_buffer = getattr(g, 'solr_index_buffer', None)
+    if index_buffer is not None and not solr_hosts:
+        index_buffer.add(docs)
+    else:
+        __get_solr(solr_hosts).add(docs)
+
+
+def __flush_docs():
+    '''Send any collected documents, before deleting or committing by query'''
+    index_buffer = getattr(g, 'solr_index_buffer', None)
+    if index_buffer is not None:
+        index_buffer.flush()
+
+
 def __add_objects(objects, solr_hosts=None):
-    solr_instance = __get_solr(solr_hosts)
-    solr_instance.add([obj.solarize() for obj in objects])
+    __add_docs([obj.solarize() for obj in objects], solr_hosts)
 
 
 def __del_objects(object_solr_ids):
+    index_buffer = getattr(g, 'solr_index_buffer', None)
+    if index_buffer is not None:
+        # don't let a later flush add them back
+        index_buffer.discard(object_solr_ids)
     solr_instance = __get_solr()
     solr_query = 'id:({0})'.format(' || '.join(object_solr_ids))
     solr_instance.delete(q=solr_query)
@@ -70,7 +89,7 @@ def del_users(user_solr_ids):
     __del_objects(user_solr_ids)
 
 
-@task
+@task(coalesce=True)
 def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
     '''
     Add the referenced artifacts to SOLR and shortlinks.
@@ -107,7 +126,7 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
             except Exception:
                 log.error('Error indexing artifact %s', ref._id)
                 exceptions.append(sys.exc_info())
-        __get_solr(solr_hosts).add(solr_updates)
+        __add_docs(solr_updates, solr_hosts)
 
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
@@ -115,7 +134,7 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
         raise CompoundError(*exceptions)
 
 
-@task
+@task(coalesce=True)
 def del_artifacts(ref_ids):
     from allura import model as M
     if ref_ids:
@@ -126,16 +145,19 @@ def del_artifacts(ref_ids):
 
 @task
 def solr_del_project_artifacts(project_id):
+    __flush_docs()
     g.solr.delete(q='project_id_s:%s' % project_id)
 
 
 @task
 def commit():
+    __flush_docs()
     g.solr.commit()
 
 
 @task
 def solr_del_tool(project_id, mount_point_s):
+    __flush_docs()
     g.solr.delete(q='project_id_s:"%s" AND mount_point_s:"%s"' % (project_id, mount_point_s))
 
 @contextmanager
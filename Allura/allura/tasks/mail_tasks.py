@@ -160,18 +160,26 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
             fromaddr = g.noreply
         else:
             fromaddr = user.email_address_header()
-    # Divide addresses based on preferred email formats
+    # Look up all the destination users with one query
+    user_ids = {}
     for addr in destinations:
-        if mail_util.isvalid(addr):
-            addrs_plain.append(addr)
-        else:
+        if not mail_util.isvalid(addr):
             try:
-                user = M.User.query.get(_id=ObjectId(addr), disabled=False, pending=False)
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
+                user_ids[addr] = ObjectId(addr)
             except:
                 log.exception('Error looking up user with ID: %r' % addr)
+    users = {}
+    if user_ids:
+        users = dict((u._id, u) for u in M.User.query.find(dict(
+            _id={'$in': user_ids.values()}, disabled=False, pending=False)))
+    # Divide addresses based on preferred email formats
+    for addr in destinations:
+        if mail_util.isvalid(addr):
+            addrs_plain.append(addr)
+        elif addr in user_ids:
+            user = users.get(user_ids[addr])
+            if not user:
+                log.warning('Cannot find user with ID: %s', addr)
                 continue
             addr = user.email_address_header()
             if not addr and user.email_addresses:
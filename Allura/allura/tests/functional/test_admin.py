@@ -1105,10 +1105,15 @@ def test_export_status(self, MonQTask):
         r = self.api_get('/rest/p/test/admin/export_status')
         assert_equals(r.json, {'status': 'ready'})
 
-        MonQTask.query.get.return_value = 'something'
+        MonQTask.query.get.return_value = mock.Mock(progress=None)
         r = self.api_get('/rest/p/test/admin/export_status')
         assert_equals(r.json, {'status': 'busy'})
 
+        progress = {'tools': 2, 'finished': 1, 'exported': ['wiki']}
+        MonQTask.query.get.return_value = mock.Mock(progress=progress)
+        r = self.api_get('/rest/p/test/admin/export_status')
+        assert_equals(r.json, {'status': 'busy', 'progress': progress})
+
     @mock.patch('allura.model.project.MonQTask')
     @mock.patch('allura.ext.admin.admin_main.AdminApp.exportable_tools_for')
     @mock.patch('allura.ext.admin.admin_main.export_tasks.bulk_export')
@@ -135,6 +135,13 @@ def test_artifactlink():
     assert not M.Shortlink.lookup('[Wiki:TestPage2]')
     assert not M.Shortlink.lookup('[TestPage2_no_such_page]')
 
+    links = M.Shortlink.from_links('[TestPage2]', '[wiki:TestPage2]', '[Wiki:TestPage2]')
+    assert_equal(links['[TestPage2]']._id, links['[wiki:TestPage2]']._id)
+    assert_equal(links['[Wiki:TestPage2]'], None)
+    aref = M.ArtifactReference.query.get(_id=links['[TestPage2]'].ref_id)
+    M.ArtifactReference.load_artifacts([aref])
+    assert_equal(aref.__dict__['artifact']._id, pg._id)
+
     pg.delete()
     c.project.uninstall_app('wiki')
     assert not M.Shortlink.lookup('[wiki:TestPage2]')
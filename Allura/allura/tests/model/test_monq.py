@@ -16,12 +16,20 @@
 #       under the License.
 
 import pprint
-from nose.tools import with_setup
+import time
+from nose.tools import with_setup, assert_equal
+
+import mock
+import tg
+from pylons import app_globals as g
 
 from ming.orm import ThreadLocalORMSession
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
+from allura.lib import helpers as h
+from allura.lib.solr import SolrIndexBuffer, MockSOLR
+from allura.model.monq_model import TaskWakeup
 
 
 def setUp():
@@ -40,3 +48,158 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+def test_post_coalesce():
+    first = M.MonQTask.post(pprint.pformat, (['a', 'b'],), coalesce=True)
+    task = M.MonQTask.post(pprint.pformat, (['b', 'c'],), coalesce=True)
+    assert_equal(task._id, first._id)
+    assert_equal(task.args, [['a', 'b', 'c']])
+    # not with other args or kwargs, or once it's been claimed
+    M.MonQTask.post(pprint.pformat, (['d'], 1), coalesce=True)
+    M.MonQTask.post(pprint.pformat, (['d'],), dict(width=1), coalesce=True)
+    M.MonQTask.get()
+    M.MonQTask.post(pprint.pformat, (['d'],), coalesce=True)
+    assert_equal(M.MonQTask.query.find().count(), 4)
+    with h.push_config(tg.config, **{'monq.coalesce.max_items': '2'}):
+        task = M.MonQTask.post(pprint.pformat, (['e', 'f'],), coalesce=True)
+    assert_equal(task.args, [['e', 'f']])
+    assert_equal(M.MonQTask.query.find().count(), 5)
+
+
+@with_setup(setUp)
+def test_discard_pending():
+    M.MonQTask.post(pprint.pformat, (['a', 'b'],))
+    M.MonQTask.post(pprint.pformat, (['c'],))
+    M.MonQTask.post(pprint.pformat, (['d'],), dict(width=1))
+    M.MonQTask.discard_pending(pprint.pformat, ['b', 'c', 'd'])
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.query.find().all()
+    assert_equal(sorted(t.args for t in tasks), [[['a']], [['d']]])
+
+
+@with_setup(setUp)
+def test_claim_batch():
+    for i in range(4):
+        M.MonQTask.post(time.sleep, (0,))
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.get(process='test')
+    tasks = M.MonQTask.claim_batch(task, 'test', 3)
+    assert_equal(len(tasks), 3)
+    assert tasks[0] is task
+    assert_equal(set(t.task_name for t in tasks), set(['time.sleep']))
+    assert_equal(set(t.state for t in tasks), set(['busy']))
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 2)
+    # only the remaining one of the same name is left to claim
+    more = M.MonQTask.claim_batch(M.MonQTask.get(only=['time.sleep']), 'test', 3)
+    assert_equal(len(more), 1)
+
+
+@with_setup(setUp)
+def test_run_batch():
+    ids = [M.MonQTask.post(time.sleep, (0,))._id,
+           M.MonQTask.post(time.sleep, ('not a number',))._id,
+           M.MonQTask.post(pprint.pformat, ([5, 6],))._id]
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = [M.MonQTask.query.get(_id=_id) for _id in ids]
+    with mock.patch.object(M.MonQTask, '_context_objects', autospec=True,
+                           side_effect=M.MonQTask._context_objects) as context_objects, \
+            h.push_config(tg.config, **{'monq.raise_errors': False}):
+        M.MonQTask.run_batch(tasks)
+    # __repr__ (used in log messages) loads the context without a cache
+    cached = [args for args, kw in context_objects.call_args_list if len(args) > 1]
+    assert_equal([args[0]._id for args in cached], ids)
+    assert all(args[1] is cached[0][1] for args in cached)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    ok, bad, result = [M.MonQTask.query.get(_id=_id) for _id in ids]
+    assert_equal(ok.state, 'complete')
+    assert ok.time_start and ok.time_stop
+    assert_equal(bad.state, 'error')
+    assert 'TypeError' in bad.result, bad.result
+    assert_equal(result.state, 'complete')
+    assert_equal(result.result, 'I[5, 6]')
+
+
+def buffer_doc(doc_id):
+    g.solr_index_buffer.add([dict(id=doc_id, text='')])
+
+
+@with_setup(setUp)
+def test_held_by_index_buffer():
+    solr = MockSOLR()
+    index_buffer = SolrIndexBuffer(solr, batch_size=10, max_wait=60,
+                                   release=M.MonQTask.complete_held)
+    ids = [M.MonQTask.post(buffer_doc, (doc_id,))._id
+           for doc_id in ('a', 'b', 'c')]
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = [M.MonQTask.query.get(_id=_id) for _id in ids]
+    with mock.patch.object(g, 'solr_index_buffer', index_buffer):
+        tasks[0]()
+        M.MonQTask.run_batch(tasks[1:])
+        other = M.MonQTask.get()
+        other()
+        ThreadLocalORMSession.close_all()
+        # not complete until their documents are sent
+        states = [M.MonQTask.query.get(_id=_id).state for _id in ids]
+        assert_equal(states, ['busy'] * 3)
+        assert_equal(M.MonQTask.query.get(_id=other._id).state, 'complete')
+        index_buffer.flush()
+    assert_equal(sorted(solr.db), ['a', 'b', 'c'])
+    ThreadLocalORMSession.close_all()
+    states = [M.MonQTask.query.get(_id=_id).state for _id in ids]
+    assert_equal(states, ['complete'] * 3)
+
+
+@with_setup(setUp)
+@mock.patch.object(TaskWakeup, 'notify')
+def test_post_wakeup(notify):
+    task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+    assert not notify.called
+    with h.push_config(tg.config, **{'monq.wakeup': 'true'}):
+        task = M.MonQTask.post(pprint.pformat, ([5, 6],))
+        notify.assert_called_once_with(task)
+        # delayed tasks can't be run right away anyway
+        M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+        assert_equal(notify.call_count, 1)
+
+
+@mock.patch.object(TaskWakeup, 'collection')
+@mock.patch('allura.model.monq_model.time')
+def test_wakeup_wait(time, collection):
+    time.time.return_value = 0
+    cursor = collection.return_value.find.return_value
+    cursor.alive = True
+    batches = iter([
+        # already there when the worker started
+        [{'_id': 1, 'task_name': 'allura.tasks.mail_tasks.sendmail'}],
+        [{'_id': 3, 'task_name': 'other'},
+         {'_id': 4, 'task_name': 'allura.tasks.mail_tasks.sendmail'}],
+        # ids from other processes don't have to be in order
+        [{'_id': 2, 'task_name': 'allura.tasks.mail_tasks.sendmail'}],
+    ])
+    cursor.__iter__ = lambda self: iter(next(batches))
+    wakeup = TaskWakeup(only=['allura.tasks.mail_tasks.sendmail'])
+    assert wakeup.wait(10)
+    assert wakeup.wait(10)
+    # the same cursor all along
+    collection.return_value.find.assert_called_once_with(
+        tailable=True, await_data=True)
+    assert not time.sleep.called
+
+
+@mock.patch.object(TaskWakeup, 'collection')
+@mock.patch('allura.model.monq_model.time')
+def test_wakeup_unavailable(time, collection):
+    time.time.return_value = 0
+    collection.side_effect = Exception('not capped')
+    wakeup = TaskWakeup()
+    assert not wakeup.available
+    assert not wakeup.wait(10)
+    time.sleep.assert_called_once_with(10)
@@ -16,10 +16,11 @@
 #       under the License.
 
 import unittest
-from datetime import timedelta
+from datetime import datetime, timedelta
 import collections
 
 from pylons import tmpl_context as c, app_globals as g
+from tg import config
 from nose.tools import assert_equal, assert_in
 from ming.orm import ThreadLocalORMSession
 import mock
@@ -210,8 +211,12 @@ def test_delivery(self):
         ThreadLocalORMSession.flush_all()
         assert M.Mailbox.query.find().count() == 1
         mbox = M.Mailbox.query.get()
-        assert len(mbox.queue) == 1
-        assert not mbox.queue_empty
+        # delivered, and fired straight away by the notify task
+        assert_equal(mbox.queue, [])
+        assert mbox.queue_empty
+        assert_equal(M.MonQTask.query.find(dict(
+            task_name='allura.tasks.mail_tasks.sendmail',
+            state='ready')).count(), 1)
 
     def test_email(self):
         self._subscribe()  # as current user: test-admin
@@ -229,10 +234,11 @@ def test_email(self):
         M.MonQTask.run_ready()
         mboxes = M.Mailbox.query.find().all()
         assert_equal(len(mboxes), 2)
-        assert_equal(len(mboxes[0].queue), 1)
-        assert not mboxes[0].queue_empty
-        assert_equal(len(mboxes[1].queue), 1)
-        assert not mboxes[1].queue_empty
+        # fired straight away by the notify task
+        assert_equal(mboxes[0].queue, [])
+        assert mboxes[0].queue_empty
+        assert_equal(mboxes[1].queue, [])
+        assert mboxes[1].queue_empty
 
         email_tasks = M.MonQTask.query.find({'state': 'ready'}).all()
         # make sure both subscribers will get an email
@@ -327,6 +333,74 @@ def test_direct_sub(self):
         ThreadLocalORMSession.close_all()
         M.Mailbox.fire_ready()
 
+    def _subscribe_users(self, usernames):
+        for username in usernames:
+            self.pg.subscribe(type='direct', user=M.User.by_username(username))
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+
+    def test_deliver(self):
+        self._subscribe_users(['test-admin', 'test-user'])
+        M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        M.Mailbox.deliver('nid2', [self.pg.index_id()], 'metadata')
+        mboxes = M.Mailbox.query.find(dict(type='direct')).all()
+        assert_equal(len(mboxes), 2)
+        for mbox in mboxes:
+            assert_equal(mbox.queue, ['nid1', 'nid2'])
+            assert_equal(mbox.queue_empty, False)
+
+    def test_fire_ready_batches(self):
+        self._subscribe_users(['test-admin', 'test-user', 'test-user-2'])
+        n = self._post_notification(text='A')
+        M.Mailbox.deliver(n._id, [self.pg.index_id()], 'metadata')
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        with h.push_config(config, **{'mailbox.fire_batch_size': '2'}):
+            with mock.patch.object(M.Mailbox, '_load_notifications',
+                                   wraps=M.Mailbox._load_notifications) as load:
+                M.Mailbox.fire_ready()
+        # one load for each batch of mboxes
+        assert_equal([len(call[0][0]) for call in load.call_args_list], [2, 1])
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        for mbox in M.Mailbox.query.find(dict(type='direct')):
+            assert_equal(mbox.queue, [])
+            assert_equal(mbox.queue_empty, True)
+        count = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.mail_tasks.sendmail',
+            state='ready')).count()
+        assert_equal(count, 3)
+
+    def test_claim_direct_keeps_new_notifications(self):
+        self._subscribe_users(['test-admin'])
+        M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        q_direct = dict(type='direct', queue_empty=False)
+        mboxes = M.Mailbox._claim_direct(q_direct, 10)
+        assert_equal(len(mboxes), 1)
+        assert_equal(mboxes[0].queue, ['nid1'])
+        # claimed, so not ready to fire until something else is delivered
+        assert_equal(M.Mailbox._claim_direct(q_direct, 10), [])
+        M.Mailbox.deliver('nid2', [self.pg.index_id()], 'metadata')
+        mbox = M.Mailbox.query.get(_id=mboxes[0]._id)
+        assert_equal(mbox.queue, ['nid2'])
+        assert_equal(mbox.queue_empty, False)
+
+    def test_claim_direct_skips_claimed(self):
+        self._subscribe_users(['test-admin'])
+        M.Mailbox.deliver('nid1', [self.pg.index_id()], 'metadata')
+        q_direct = dict(type='direct', queue_empty=False)
+        # being fired by another process
+        M.Mailbox.query.update(dict(type='direct'), {'$set': dict(fire_token=bson.ObjectId())})
+        assert_equal(M.Mailbox._claim_direct(q_direct, 10), [])
+        # by one that went away
+        M.Mailbox.query.update(dict(type='direct'), {'$set': dict(
+            fire_token=bson.ObjectId.from_datetime(datetime.utcnow() - timedelta(hours=1)))})
+        mboxes = M.Mailbox._claim_direct(q_direct, 10)
+        assert_equal([mbox.queue for mbox in mboxes], [['nid1']])
+        mbox = M.Mailbox.query.get(_id=mboxes[0]._id)
+        assert_equal(mbox.fire_token, None)
+        assert_equal(mbox.queue, [])
+
     def test_digest_sub(self):
         self._subscribe(type='digest')
         self._post_notification(text='x' * 1024)
@@ -646,6 +646,9 @@ def test_pruning_query_flush(self, tr_get, session):
             'tree1': tree1,
             'tree2': tree2,
         })
+        # evicted instances are flushed in batches
+        assert not session.called
+        cache.flush()
         self.assertEqual(session.call_args_list,
                          [mock.call(tree1), mock.call(tree2)])
         self.assertEqual(session.return_value.flush.call_args_list,
@@ -671,11 +674,63 @@ def test_pruning_instance_flush(self, session):
             'tree2': tree2,
             'tree3': tree3,
         })
+        assert not session.called
+        cache.flush()
         session.assert_called_once_with(tree1)
         session.return_value.flush.assert_called_once_with(tree1)
         session.return_value.expunge.assert_called_once_with(tree1)
 
 
+    @mock.patch('allura.model.repository.session')
+    def test_pruning_flush_batch(self, session):
+        cache = M.repository.ModelCache(max_instances=1, flush_batch_size=2)
+        trees = [mock.Mock(spec=['_id'], _id='tree%d' % i) for i in range(4)]
+        for tree in trees[:2]:
+            cache.set(M.repository.Tree, {'_id': tree._id}, tree)
+        assert not session.called
+        cache.set(M.repository.Tree, {'_id': trees[2]._id}, trees[2])
+        self.assertEqual(session.return_value.flush.call_args_list,
+                         [mock.call(trees[0]), mock.call(trees[1])])
+
+    @mock.patch('allura.model.repository.session')
+    def test_pruning_reused_not_expunged(self, session):
+        cache = M.repository.ModelCache(max_instances=1)
+        tree1 = mock.Mock(spec=['_id'], _id='tree1')
+        tree2 = mock.Mock(spec=['_id'], _id='tree2')
+        cache.set(M.repository.Tree, {'_id': 'tree1'}, tree1)
+        cache.set(M.repository.Tree, {'_id': 'tree2'}, tree2)
+        # tree1 was evicted, but is cached again before it was flushed
+        cache.set(M.repository.Tree, {'_id': 'tree1'}, tree1)
+        cache.flush()
+        session.return_value.expunge.assert_called_once_with(tree2)
+
+    @mock.patch.object(M.repository.ModelCache, '_instance_size')
+    def test_pruning_size(self, instance_size):
+        instance_size.return_value = 10
+        cache = M.repository.ModelCache(max_size={M.repository.Tree: 25})
+        for i in range(3):
+            cache.set(M.repository.Tree, {'_id': i}, mock.Mock(spec=['_id'], _id=i))
+        self.assertEqual(cache.instance_ids(M.repository.Tree), [1, 2])
+        self.assertEqual(cache.stats()['Tree']['size'], 20)
+        # other classes aren't limited
+        for i in range(3):
+            cache.set(M.repository.LastCommit, {'_id': i}, mock.Mock(spec=['_id'], _id=i))
+        self.assertEqual(cache.num_instances(M.repository.LastCommit), 3)
+
+    @mock.patch.object(M.repository.Tree.query, 'get')
+    def test_stats(self, tr_get):
+        cache = M.repository.ModelCache(max_instances=1)
+        tr_get.side_effect = lambda _id: mock.Mock(spec=['_id'], _id=_id)
+        cache.get(M.repository.Tree, {'_id': 'tree1'})
+        cache.get(M.repository.Tree, {'_id': 'tree1'})
+        cache.get(M.repository.Tree, {'_id': 'tree2'})
+        cache.get(M.repository.Tree, {'_id': 'tree1'})
+        self.assertEqual(cache.stats(), {'Tree': {
+            'hits': 1, 'misses': 3, 'evictions': 2,
+            'queries': 2, 'instances': 1,
+        }})
+
+
 class TestMergeRequest(object):
 
     def setUp(self):
@@ -16,10 +16,15 @@
 #       under the License.
 
 from nose.tools import assert_equal
+from ming.orm import ThreadLocalORMSession
+import mock
 
 from allura import model as M
+from allura.lib.security import Credentials
+from allura.model.timeline import perm_check_many
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test, setup_global_objects
+from forgewiki import model as WM
 
 
 class TestActivityObject_Functional(object):
@@ -39,4 +44,21 @@ def test_has_activity_access_app_config(self):
         app_config = wiki_app.config
 
         assert_equal(bool(app_config.has_activity_access('read', user=M.User.anonymous(), activity=None)),
-                     True)
\ No newline at end of file
+                     True)
+    @td.with_wiki
+    def test_perm_check_many(self):
+        p = M.Project.query.get(shortname='test')
+        app_config = p.app_instance('wiki').config
+        page = WM.Page.query.get(app_config_id=app_config._id)
+        activities = [mock.Mock(obj=mock.Mock(activity_extras=page.activity_extras)),
+                      mock.Mock(obj=mock.Mock(activity_extras=app_config.activity_extras)),
+                      mock.Mock(obj=mock.Mock(activity_extras={}))]
+        anon = M.User.anonymous()
+        assert_equal(perm_check_many(anon, activities), activities)
+        assert_equal(perm_check_many(anon, activities, limit=2), activities[:2])
+
+        page.acl = [M.ACE.deny(M.ProjectRole.anonymous(p)._id, 'read')]
+        ThreadLocalORMSession.flush_all()
+        Credentials.get().clear()
+        assert_equal(perm_check_many(anon, activities), activities[1:])
+        assert_equal(perm_check_many(anon, activities, limit=1), activities[1:2])
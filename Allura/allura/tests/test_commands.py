@@ -26,7 +26,7 @@
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd, taskd_cleanup
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -376,6 +376,46 @@ def test_status_log_retries():
     assert cmd._taskd_status.mock_calls == expected_calls
 
 
+class TestTaskdCommand(object):
+
+    def setUp(self):
+        setup_basic_test()
+        setup_global_objects()
+        M.MonQTask.query.remove({})
+        self.cmd = taskd.TaskdCommand('taskd')
+        self.cmd.options, args = self.cmd.parser.parse_args(
+            ['--limit', 'pprint.pformat=1, pprint.pprint = 2', '--max-tasks', '3'])
+
+    def test_parse_limits(self):
+        assert_equal(self.cmd._parse_limits(self.cmd.options.limits),
+                     {'pprint.pformat': 1, 'pprint.pprint': 2})
+        assert_equal(self.cmd._parse_limits(None), {})
+
+    def test_limits(self):
+        import pprint
+        limits = {'pprint.pformat': 1}
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+        M.MonQTask.post(pprint.pformat, ([5, 6],))
+        ThreadLocalORMSession.flush_all()
+        assert_equal(self.cmd._tasks_at_limit(limits), [])
+        task = M.MonQTask.get(exclude=self.cmd._tasks_at_limit(limits))
+        assert not self.cmd._over_limit(task, limits)
+        assert_equal(self.cmd._tasks_at_limit(limits), ['pprint.pformat'])
+        assert_equal(M.MonQTask.get(exclude=['pprint.pformat']), None)
+        # claimed by another process regardless, so it's put back
+        task = M.MonQTask.get()
+        assert self.cmd._over_limit(task, limits)
+        ThreadLocalORMSession.close_all()
+        assert_equal(M.MonQTask.query.get(_id=task._id).state, 'ready')
+
+    def test_should_restart(self):
+        assert not self.cmd._should_restart(2)
+        assert self.cmd._should_restart(3)
+        self.cmd.options.max_tasks = 0
+        self.cmd.options.max_memory = 1
+        assert self.cmd._should_restart(3)
+
+
 class TestBackgroundCommand(object):
 
     cmd = 'allura.command.show_models.ReindexCommand'
@@ -24,14 +24,15 @@
 import unittest
 import hashlib
 import datetime as dt
-from mock import patch, Mock
+from multiprocessing.pool import ThreadPool
+from mock import patch, Mock, MagicMock
 
 from bson import ObjectId
 from nose.tools import with_setup, assert_equal, assert_in, assert_not_in
 from pylons import tmpl_context as c, app_globals as g
 import tg
 
-from ming.orm import ThreadLocalORMSession
+from ming.orm import ThreadLocalORMSession, state
 from alluratest.controller import (
     setup_basic_test,
     setup_global_objects,
@@ -42,7 +43,7 @@
 
 from allura import model as M
 from allura.lib import helpers as h
-from allura.lib.app_globals import ForgeMarkdown
+from allura.lib.app_globals import ForgeMarkdown, MarkdownRenderCache
 from allura.tests import decorators as td
 
 from forgewiki import model as WM
@@ -377,6 +378,19 @@ def test_wiki_artifact_links():
         assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
 
 
+def test_wiki_artifact_links_resolved_together():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        with patch.object(M.Shortlink, 'from_links', wraps=M.Shortlink.from_links) as from_links:
+            text = g.markdown.convert('See [Home], [test:wiki:Home] and [here](Home)')
+    # all the links are looked up in one go, before the conversion
+    assert_equal(from_links.call_count, 1)
+    assert_equal(set(from_links.call_args[0]),
+                 set(['Home', 'test:wiki:Home', 'here']))
+    assert_in('<a class="alink" href="/p/test/wiki/Home/">[Home]</a>', text)
+    assert_in('<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>', text)
+    assert_in('<a class="" href="/p/test/wiki/Home/">here</a>', text)
+
+
 def test_markdown_links():
     with patch.dict(tg.config, {'nofollow_exempt_domains': 'foobar.net'}):
         text = g.markdown.convert('Read [here](http://foobar.net/) about our project')
@@ -750,6 +764,152 @@ def test_all_expected_keys_exist_in_cache(self):
         self.assertEqual(required_keys, keys)
 
 
+class TestSharedMarkdown(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MarkdownRenderCache(max_entries=2, ttl=600, macro_ttl=5)
+        # on the Globals instance itself, since the g proxy can't restore it
+        self.patcher = patch.object(g._current_obj(), 'markdown_render_cache', self.cache)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_cache_disabled(self):
+        with patch.object(g._current_obj(), 'markdown_render_cache', None):
+            html = g.markdown.shared_convert('**bold**')
+        assert_equal(html, u'<div class="markdown_content"><p><strong>bold</strong></p></div>')
+        assert_equal(self.cache.stats()['size'], 0)
+
+    def test_hits(self):
+        from jinja2 import Markup
+        html = g.markdown.shared_convert('**bold**')
+        assert_equal(html, u'<div class="markdown_content"><p><strong>bold</strong></p></div>')
+        with patch.object(ForgeMarkdown, 'convert') as convert:
+            again = g.markdown.shared_convert('**bold**')
+        assert not convert.called
+        assert_equal(again, html)
+        assert isinstance(again, Markup)
+        stats = self.cache.stats()
+        assert_equal((stats['hits'], stats['misses'], stats['hit_rate']), (1, 1, 0.5))
+
+    def test_keys(self):
+        md = g.markdown
+        key = md.render_cache_key('[Home]')
+        assert_equal(key[0], 'markdown')
+        assert_equal(key[2], c.project._id)
+        assert_equal(md.render_cache_key('[Home]', md5='x')[1], 'x')
+        # converters, and macros for each user, are rendered separately
+        assert_equal(g.markdown_wiki.cache_kind, 'markdown:wiki=True')
+        assert_equal(g.markdown_commit.cache_kind, 'commit')
+        assert_equal(md.render_cache_key('[[members]]')[-1], c.user._id)
+        g.markdown.shared_convert('**bold**')
+        g.markdown_commit.shared_convert('**bold**')
+        assert_equal(self.cache.stats()['misses'], 2)
+
+    def test_macro_ttl(self):
+        with patch('allura.lib.utils.time') as time:
+            time.time.return_value = 100
+            g.markdown.shared_convert('[[members]]')
+            g.markdown.shared_convert('**bold**')
+            expires = sorted(e[0] for e in self.cache._entries._entries.values())
+            assert_equal(expires, [105, 700])
+            time.time.return_value = 110
+            g.markdown.shared_convert('[[members]]')
+        assert_equal(self.cache.stats()['misses'], 3)
+
+    def test_artifact_links(self):
+        # they change with the artifacts, so they're not shared
+        for source in ['[Home]', '[no-such-page]', '[link](Home)']:
+            g.markdown.shared_convert(source)
+        g.markdown_commit.shared_convert('Fix [#1]')
+        assert_equal(self.cache.stats()['size'], 0)
+        g.markdown.shared_convert('[link](http://example.com/)')
+        assert_equal(self.cache.stats()['size'], 1)
+
+    def test_render_limit(self):
+        with patch.dict('allura.lib.app_globals.config', markdown_render_max_length='5'):
+            html = g.markdown.shared_convert('**bold**')
+        assert_equal(html, u'<pre>**bold**</pre>')
+        assert_equal(self.cache.stats()['size'], 0)
+
+
+def test_markdown_render_cache_lru():
+    cache = MarkdownRenderCache(max_entries=2)
+    cache.get('a', lambda: 'A', 60)
+    cache.get('b', lambda: 'B', 60)
+    assert_equal(cache.get('a', lambda: 'X', 60), 'A')
+    cache.get('c', lambda: 'C', 60)  # drops b, the least recently used
+    assert_equal(cache._entries._entries.keys(), ['a', 'c'])
+    assert_equal(cache.get('b', lambda: 'B2', 60), 'B2')
+    shared = MagicMock()
+    shared.reserve.return_value.__enter__.return_value = shared
+    shared.get.return_value = 'from memcached'
+    cache = MarkdownRenderCache(shared=shared)
+    assert_equal(cache.get('d', lambda: 'D', 60), 'from memcached')
+    shared.get.return_value = None
+    assert_equal(cache.get('e', lambda: 'E', 60), 'E')
+    shared.set.assert_called_once_with(cache._shared_key('e'), 'E', time=60)
+    assert_equal(cache.stats()['shared_hits'], 1)
+
+
+@with_setup(setUp)
+@patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='-0.01',
+            markdown_render_workers='2', markdown_render_max_length='20')
+def test_prefetch_markdown():
+    posts = [M.Post(text=u'**bold**'), M.Post(text=u'*em*'), M.Post(text=u'[[members]]'),
+             M.Post(text=u'*long*' * 5)]
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    posts = [M.Post.query.get(_id=p._id) for p in posts]
+    mod_date = posts[0].mod_date
+    g.prefetch_markdown(posts, 'text')
+    assert_in(u'<strong>bold</strong>', posts[0].text_cache.html)
+    assert_in(u'<em>em</em>', posts[1].text_cache.html)
+    assert_equal(posts[2].text_cache.md5, None)  # macros aren't cached
+    assert_equal(posts[3].text_cache.md5, None)  # left to cached_convert
+    assert_equal(state(posts[0]).status, 'clean')
+    ThreadLocalORMSession.close_all()
+    post = M.Post.query.get(_id=posts[0]._id)
+    assert_in(u'<strong>bold</strong>', post.text_cache.html)
+    assert_equal(post.mod_date, mod_date)
+    with patch.object(ForgeMarkdown, 'convert') as convert:
+        html = g.markdown.cached_convert(post, 'text')
+    assert not convert.called
+    assert_equal(html, post.text_cache.html)
+
+
+@with_setup(setUp)
+@patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='99999')
+def test_prefetch_markdown_not_saved():
+    post = M.Post(text=u'**bold**')
+    ThreadLocalORMSession.flush_all()
+    g.prefetch_markdown([post], 'text')
+    assert_equal(post.text_cache.md5, None)
+    assert_equal(state(post).status, 'clean')
+    # but not rendered again in this request
+    with patch.object(ForgeMarkdown, 'convert') as convert:
+        html = g.markdown.cached_convert(post, 'text')
+    assert not convert.called
+    assert_in(u'<strong>bold</strong>', html)
+    post.text = u'*em*'
+    assert_in(u'<em>em</em>', g.markdown.cached_convert(post, 'text'))
+
+
+@with_setup(setUp)
+@patch.dict('allura.lib.app_globals.config', markdown_render_workers='2')
+def test_render_markdown():
+    sources = [u'**bold**', u'*em*', u'plain']
+    with patch('allura.lib.app_globals.ThreadPool', wraps=ThreadPool) as pool:
+        results = g.render_markdown(sources)
+    pool.assert_called_once_with(2)
+    assert_equal([html for html, render_time in results],
+                 [g.markdown.convert(source) for source in sources])
+    with patch.dict('allura.lib.app_globals.config', markdown_render_max_length='5'):
+        html, render_time = g.render_markdown([u'**bold**'], render_limit=True)[0]
+    assert_equal(html, u'<pre>**bold**</pre>')
+
+
 class TestEmojis(unittest.TestCase):
 
     def test_markdown_emoji_atomic(self):
@@ -18,6 +18,7 @@
 #       under the License.
 
 import unittest
+import smtplib
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 
@@ -29,7 +30,9 @@
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib.utils import ConfigProxy
 from allura.app import Application
+from allura.lib import helpers as h
 from allura.lib.mail_util import (
+    SMTPClient,
     parse_address,
     parse_message,
     Header,
@@ -239,3 +242,83 @@ def test_parse_message_id():
         'de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net',
         'de31888f6be2d87dc377d9e713876bb514548625.patches@libjpeg-turbo.p.domain.net',
     ])
+
+
+class TestSMTPClient(unittest.TestCase):
+
+    def setUp(self):
+        setup_basic_test()
+        self.client = SMTPClient()
+
+    def send(self, addrs=None):
+        self.client.sendmail(
+            addrs or ['a@example.com'], u'from@example.com', u'reply@example.com',
+            u'Subject', u'msgid', None, MIMEText('text'))
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_reuses_connection(self, SMTP):
+        self.send()
+        self.send()
+        assert_equal(SMTP.call_count, 1)
+        assert_equal(SMTP.return_value.sendmail.call_count, 2)
+        stats = self.client.stats()
+        assert_equal(stats['sent'], 2)
+        assert_equal(stats['connects'], 1)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_reconnects_when_disconnected(self, SMTP):
+        conn1, conn2 = mock.Mock(), mock.Mock()
+        SMTP.side_effect = [conn1, conn2]
+        self.send()
+        conn1.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        self.send()
+        assert_equal(conn1.sendmail.call_count, 2)
+        assert_equal(conn2.sendmail.call_count, 1)
+        assert_equal(self.client.stats()['sent'], 2)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_other_errors_not_resent(self, SMTP):
+        SMTP.return_value.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.send()
+        assert_equal(SMTP.call_count, 1)
+        assert_equal(SMTP.return_value.sendmail.call_count, 1)
+        assert_equal(self.client.stats()['failed'], 1)
+
+    @mock.patch('allura.lib.mail_util.time')
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_noop_when_idle(self, SMTP, time):
+        conn1, conn2 = mock.Mock(), mock.Mock()
+        SMTP.side_effect = [conn1, conn2]
+        time.time.return_value = 100
+        self.send()
+        time.time.return_value = 110
+        self.send()
+        assert_equal(conn1.noop.call_count, 0)
+        conn1.noop.return_value = (250, 'OK')
+        time.time.return_value = 150
+        self.send()
+        assert_equal(conn1.noop.call_count, 1)
+        assert_equal(conn1.sendmail.call_count, 3)
+        conn1.noop.side_effect = smtplib.SMTPServerDisconnected()
+        time.time.return_value = 200
+        self.send()
+        assert_equal(conn1.sendmail.call_count, 3)
+        assert_equal(conn2.sendmail.call_count, 1)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_max_messages(self, SMTP):
+        with h.push_config(tg_config, smtp_max_messages='2'):
+            for i in range(5):
+                self.send()
+        assert_equal(SMTP.call_count, 3)
+        assert_equal(SMTP.return_value.quit.call_count, 2)
+
+    @mock.patch('allura.lib.mail_util.smtplib.SMTP')
+    def test_max_recipients(self, SMTP):
+        addrs = ['%s@example.com' % i for i in range(5)]
+        with h.push_config(tg_config, smtp_max_recipients='2'):
+            self.send(addrs)
+        sendmail = SMTP.return_value.sendmail
+        assert_equal([args[0][1] for args in sendmail.call_args_list],
+                     [addrs[:2], addrs[2:4], addrs[4:]])
@@ -146,3 +146,17 @@ def test_convert(self, lookup, get_comment_slug):
             extensions=[mde.CommitMessageExtension(app), 'nl2br'],
             output_format='html4')
         self.assertEqual(md.convert(text), expected_html)
+
+    @mock.patch('allura.lib.markdown_extensions.M.Shortlink.from_links')
+    def test_convert_artifact_link(self, from_links):
+        from allura.lib.app_globals import ForgeMarkdown
+
+        from_links.return_value = {'not-a-link': None}
+        app = mock.Mock(url='/p/project/tool/')
+        md = ForgeMarkdown(
+            extensions=[mde.CommitMessageExtension(app), 'nl2br'],
+            output_format='html4')
+        self.assertEqual(
+            md.convert('Fix [not-a-link]'),
+            '<div class="markdown_content"><p>Fix <span>[not-a-link]</span></div>')
+        from_links.assert_called_once_with('not-a-link')
@@ -15,14 +15,15 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
 from nose.tools import assert_equal
+import mock
 
 from ming.odm import ThreadLocalODMSession
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib.security import Credentials, SecurityCache, acl_key, all_allowed, has_access, has_access_many
 from allura import model as M
 from forgewiki import model as WM
 
@@ -190,3 +191,90 @@ def test_deny_access_for_single_user(self):
             M.ACE.deny(M.ProjectRole.by_user(user, upsert=True)._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+    @td.with_wiki
+    def test_has_access_many(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        auth_role = M.ProjectRole.by_name('*authenticated')
+        test_user = M.User.by_username('test-user')
+        objs = [page, None, wiki.config, c.project]
+        assert_equal(has_access_many(objs, 'read', test_user), [True, False, True, True])
+        assert_equal(has_access_many(objs, 'admin', test_user), [False, False, False, False])
+
+        _deny(page, auth_role, 'read')
+        assert_equal(has_access_many(objs, 'read', test_user), [False, False, True, True])
+
+        # objects with the same ACL and parent context are only checked once
+        with mock.patch('allura.lib.security.has_access', wraps=has_access) as ha:
+            has_access_many([page], 'read', test_user)
+            calls = ha.call_count
+            has_access_many([page, page, page], 'read', test_user)
+            assert_equal(ha.call_count, calls * 2)
+
+    @td.with_wiki
+    def test_shared_cache(self):
+        cache = SecurityCache()
+        with mock.patch.object(g, 'security_cache', cache):
+            wiki = c.project.app_instance('wiki')
+            member_role = M.ProjectRole.by_name('Member')
+            test_user = M.User.by_username('test-user')
+            Credentials.get().clear()
+            assert not has_access(wiki, 'create', test_user)()
+            misses = cache.stats()['role_misses']
+            # a new request uses the roles loaded for the last one
+            Credentials.get().clear()
+            assert not has_access(wiki, 'create', test_user)()
+            assert_equal(cache.stats()['role_misses'], misses)
+            assert cache.stats()['role_hits'] > 0
+            assert cache.stats()['acl_hits'] > 0
+
+            # flushing the user's new role drops their cached roles
+            _add_to_group(test_user, member_role)
+            assert has_access(wiki, 'create', test_user)()
+            assert cache.stats()['invalidations'] > 0
+
+            # a changed ACL isn't checked with the old one's result
+            _deny(wiki, member_role, 'create')
+            assert not has_access(wiki, 'create', test_user)()
+
+    @td.with_wiki
+    def test_acl_key(self):
+        wiki = c.project.app_instance('wiki')
+        ThreadLocalODMSession.flush_all()
+        member_role = M.ProjectRole.by_name('Member')
+        key = acl_key(wiki.config.acl)
+        # worked out once for an unchanged object
+        assert acl_key(wiki.config.acl) is key
+        # changes in place aren't given the old key, before or after a flush
+        wiki.config.acl.insert(0, M.ACE.deny(member_role._id, 'create'))
+        changed = acl_key(wiki.config.acl)
+        assert_equal(len(changed), len(key) + 1)
+        ThreadLocalODMSession.flush_all()
+        assert_equal(acl_key(wiki.config.acl), changed)
+        assert acl_key(wiki.config.acl) is acl_key(wiki.config.acl)
+
+
+def test_security_cache():
+    cache = SecurityCache(ttl=60, max_entries=2)
+    load = mock.Mock(return_value=((1,), (1, 2)))
+    assert_equal(cache.role_closure('u', 'p', load), ((1,), (1, 2)))
+    assert_equal(cache.role_closure('u', 'p', load), ((1,), (1, 2)))
+    assert_equal(load.call_count, 1)
+    cache.invalidate_project('p')
+    cache.role_closure('u', 'p', load)
+    assert_equal(load.call_count, 2)
+    cache.invalidate_user('u', 'p')
+    cache.role_closure('u', 'p', load)
+    assert_equal(load.call_count, 3)
+    # full, so starts over
+    cache.role_closure('u2', 'p', load)
+    cache.role_closure('u3', 'p', load)
+    assert_equal(cache.stats()['size'], 1)
+    assert_equal(cache.stats()['role_hits'], 1)
+    assert_equal(cache.stats()['role_misses'], 5)
+
+    cache = SecurityCache(ttl=0)
+    cache.role_closure('u', 'p', load)
+    cache.role_closure('u', 'p', load)
+    assert_equal(load.call_count, 7)
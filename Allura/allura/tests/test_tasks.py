@@ -17,10 +17,13 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import json
 import operator
+import os
 import shutil
 import sys
 import unittest
+import zipfile
 from base64 import b64encode
 import logging
 
@@ -39,6 +42,7 @@
 from allura.lib import helpers as h
 from allura.lib import search
 from allura.lib.exceptions import CompoundError
+from allura.lib.solr import SolrIndexBuffer, MockSOLR
 from allura.tasks import event_tasks
 from allura.tasks import index_tasks
 from allura.tasks import mail_tasks
@@ -200,6 +204,28 @@ def test_del_artifacts(self, solr):
         solr_query = 'id:({0})'.format(' || '.join(ref_ids))
         solr.delete.assert_called_once_with(q=solr_query)
 
+    @td.with_wiki
+    def test_add_artifacts_index_buffer(self):
+        artifacts = [_TestArtifact(_shorthand_id='tb_%s' % x)
+                     for x in range(3)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        solr = MockSOLR()
+        index_buffer = SolrIndexBuffer(solr, batch_size=10, max_wait=60)
+        with mock.patch.object(g, 'solr', solr), \
+                mock.patch.object(g, 'solr_index_buffer', index_buffer):
+            index_tasks.add_artifacts(ref_ids[:2])
+            index_tasks.add_artifacts(ref_ids[2:])
+            assert_equal(solr.db, {})
+            assert_equal(len(index_buffer), 3)
+            # deleted before they were sent
+            index_tasks.del_artifacts(ref_ids[:1])
+            assert_equal(len(index_buffer), 2)
+            index_tasks.commit()
+            assert_equal(sorted(solr.db), sorted(ref_ids[1:]))
+
 
 class TestMailTasks(unittest.TestCase):
 
@@ -565,18 +591,20 @@ def test_bulk_export_filter_successful(self):
         self.assertEqual(
             BE.filter_successful(['foo', None, '0']), ['foo', '0'])
 
-    @mock.patch('allura.tasks.export_tasks.shutil')
-    @mock.patch('allura.tasks.export_tasks.zipdir')
     @mock.patch('forgewiki.wiki_main.ForgeWikiApp.bulk_export')
     @td.with_wiki
-    def test_bulk_export(self, wiki_bulk_export, zipdir, shutil):
+    def test_bulk_export(self, wiki_bulk_export):
         M.MonQTask.query.remove()
+        wiki_bulk_export.side_effect = lambda f, export_path, with_attachments: f.write('{"pages": []}')
         export_tasks.bulk_export([u'wiki'])
         assert_equal(wiki_bulk_export.call_count, 1)
         temp = '/tmp/bulk_export/p/test/test'
         zipfn = '/tmp/bulk_export/p/test/test.zip'
-        zipdir.assert_called_with(temp, zipfn)
-        shutil.rmtree.assert_called_once_with(temp)
+        with zipfile.ZipFile(zipfn) as zf:
+            assert_equal(zf.namelist(), ['test/wiki.json'])
+            assert_equal(zf.read('test/wiki.json'), '{"pages": []}')
+        assert not os.path.exists(temp)
+        assert not os.path.exists(zipfn + '.part')
         # check notification
         tasks = M.MonQTask.query.find(
             dict(task_name='allura.tasks.mail_tasks.sendsimplemail')).all()
@@ -590,6 +618,21 @@ def test_bulk_export(self, wiki_bulk_export, zipdir, shutil):
         assert_in('The following tools were exported:\n- wiki', text)
         assert_in('Sample instructions for test', text)
 
+    @mock.patch('forgewiki.wiki_main.ForgeWikiApp.bulk_export')
+    @td.with_wiki
+    def test_bulk_export_progress(self, wiki_bulk_export):
+        wiki_bulk_export.side_effect = Exception('export failed')
+        project = M.Project.query.get(shortname='test')
+        task = export_tasks.bulk_export.post(['wiki', 'admin'])
+        task.state = 'busy'
+        ThreadLocalORMSession.flush_all()
+        export_tasks.BulkExport().process(project, ['wiki', 'admin'], None, with_attachments=True)
+        task = M.MonQTask.query.get(_id=task._id)
+        assert_equal(task.progress, {'tools': 2, 'finished': 2, 'exported': ['admin']})
+        with zipfile.ZipFile('/tmp/bulk_export/p/test/test.zip') as zf:
+            assert_equal(zf.namelist(), ['test/admin.json'])
+            assert_equal(json.loads(zf.read('test/admin.json'))['shortname'], 'test')
+
     def test_bulk_export_status(self):
         assert_equal(c.project.bulk_export_status(), None)
         export_tasks.bulk_export.post(['wiki'])
@@ -19,10 +19,14 @@
 
 import json
 import time
+import shutil
+import tempfile
 import unittest
 import datetime as dt
 from ming.odm import session
 from os import path
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 from bson import ObjectId
 from webob import Request
@@ -93,6 +97,17 @@ def test_filter_on_sort_key(self):
         assert_equal(chunks[0][1].username, 'sample-user-2')
         assert_equal(chunks[1][0].username, 'sample-user-3')
 
+    def test_chunked_find_expunged(self):
+        query = {'username': {'$in': ['sample-user-%d' % i for i in range(10)]}}
+        users = utils.chunked_find_expunged(M.User, query, 2)
+        first = next(users)
+        assert_equal(first.username, 'sample-user-0')
+        next(users)
+        assert M.User.query.get(_id=first._id) is first
+        next(users)  # the next chunk
+        assert M.User.query.get(_id=first._id) is not first
+        assert_equal(len(list(users)), 7)
+
 
 class TestChunkedList(unittest.TestCase):
 
@@ -199,6 +214,33 @@ def test_everything(self):
         assert d == utils.CaseInsensitiveDict(Foo=1, bar=2)
 
 
+class TestTTLCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = utils.TTLCache(max_entries=2)
+        cache.set('a', 'A', 60)
+        cache.set('b', 'B', 60)
+        assert cache.get('a') == 'A'
+        cache.set('c', 'C', 60)  # drops b, the least recently used
+        assert cache.get('b') is None
+        assert cache.get('b', 'default') == 'default'
+        assert cache.get('a') == 'A'
+        assert len(cache) == 2
+        cache.clear()
+        assert len(cache) == 0
+
+    @patch('allura.lib.utils.time')
+    def test_ttl(self, time):
+        cache = utils.TTLCache(max_entries=10)
+        time.time.return_value = 100
+        cache.set('a', 'A', 5)
+        cache.set('b', 'B', 60)
+        time.time.return_value = 105
+        assert cache.get('a') is None
+        assert cache.get('b') == 'B'
+        assert len(cache) == 1
+
+
 class TestLineAnchorCodeHtmlFormatter(unittest.TestCase):
 
     def test_render(self):
@@ -382,3 +424,53 @@ def unique_attachments():
     attachments = [pic1, file1, pic2, file2, pic2, other]
     expected = [file2, other, pic2]
     assert_equal(expected, ua(attachments))
+
+
+def test_json_stream_writer():
+    f = StringIO()
+    with utils.JSONStreamWriter(f) as out:
+        out.write_array('items', (dict(n=i) for i in range(3)))
+        out.write_array('empty', [])
+        out.write('name', u'f\xf6\xf6')
+    assert_equal(json.loads(f.getvalue()), {
+        'items': [{'n': 0}, {'n': 1}, {'n': 2}],
+        'empty': [],
+        'name': u'f\xf6\xf6',
+    })
+
+
+class TestAttachmentCopier(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def attachment(self, content):
+        attachment = Mock()
+        attachment.rfile.return_value = StringIO(content)
+        return attachment
+
+    def test_copy(self):
+        copier = utils.AttachmentCopier()
+        copier.copy(self.attachment('foo'), path.join(self.dir, 'foo'))
+        copier.wait()
+        assert_equal(open(path.join(self.dir, 'foo')).read(), 'foo')
+
+    def test_copy_with_pool(self):
+        pool = ThreadPool(2)
+        try:
+            copier = utils.AttachmentCopier(pool)
+            for i in range(5):
+                copier.copy(self.attachment('file %d' % i), path.join(self.dir, str(i)))
+            copier.wait()
+            for i in range(5):
+                assert_equal(open(path.join(self.dir, str(i))).read(), 'file %d' % i)
+
+            copier.copy(self.attachment('bar'), path.join(self.dir, 'missing', 'bar'))
+            with self.assertRaises(IOError):
+                copier.wait()
+        finally:
+            pool.close()
+            pool.join()
@@ -19,6 +19,9 @@
 import hmac
 import hashlib
 import datetime as dt
+import threading
+import BaseHTTPServer
+import SocketServer
 
 from mock import Mock, MagicMock, patch, call
 from nose.tools import (
@@ -39,6 +42,8 @@
     WebhookValidator,
     WebhookController,
     send_webhook,
+    send_webhooks,
+    deliver_webhooks,
     RepoPushWebhookSender,
     SendWebhookHelper,
 )
@@ -447,18 +452,28 @@ def test_log_msg(self):
     @patch('allura.webhooks.SendWebhookHelper', autospec=True)
     def test_send_webhook_task(self, swh):
         send_webhook(self.wh._id, self.payload)
-        swh.assert_called_once_with(self.wh, self.payload)
-
-    @patch('allura.webhooks.requests', autospec=True)
+        swh.assert_called_once_with(self.wh, self.payload, 0)
+        swh.reset_mock()
+        send_webhook(self.wh._id, self.payload, attempt=2)
+        swh.assert_called_once_with(self.wh, self.payload, 2)
+
+    @patch('allura.webhooks.deliver_webhooks', autospec=True)
+    def test_send_webhooks_task(self, deliver_webhooks):
+        send_webhooks([(self.wh._id, 1), (self.wh._id, 2)])
+        helpers = deliver_webhooks.call_args[0][0]
+        assert_equal([(hlp.webhook, hlp.payload) for hlp in helpers],
+                     [(self.wh, 1), (self.wh, 2)])
+
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send(self, log, requests):
-        requests.post.return_value = Mock(status_code=200)
+    def test_send(self, log, http_session):
+        http_session.return_value.post.return_value = Mock(status_code=200)
         self.h.sign = Mock(return_value='sha1=abc')
         self.h.send()
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': 'sha1=abc'}
-        requests.post.assert_called_once_with(
+        http_session.return_value.post.assert_called_once_with(
             self.wh.hook_url,
             data=json.dumps(self.payload),
             headers=headers,
@@ -467,92 +482,161 @@ def test_send(self, log, requests):
             'Webhook successfully sent: %s %s %s' % (
                 self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_response_status(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_response_status(self, log, http_session, send_webhook):
+        post = http_session.return_value.post
+        post.return_value = Mock(status_code=500)
         self.h.send()
-        assert_equal(requests.post.call_count, 4)  # initial call + 3 retries
-        assert_equal(time.sleep.call_args_list,
-                     [call(60), call(120), call(240)])
-        assert_equal(log.info.call_args_list, [
-            call('Retrying webhook in: %s', [60, 120, 240]),
-            call('Retrying webhook in %s seconds', 60),
-            call('Retrying webhook in %s seconds', 120),
-            call('Retrying webhook in %s seconds', 240)])
-        assert_equal(log.error.call_count, 4)
-        log.error.assert_called_with(
+        assert_equal(post.call_count, 1)
+        # retried later by another task, instead of waiting here
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, attempt=1, delay=60)
+        log.info.assert_called_once_with('Retrying webhook in %s seconds', 60)
+        log.error.assert_called_once_with(
             'Webhook send error: %s %s %s %s %s %s' % (
                 self.wh.type, self.wh.hook_url,
                 self.wh.app_config.url(),
-                requests.post.return_value.status_code,
-                requests.post.return_value.text,
-                requests.post.return_value.headers))
+                post.return_value.status_code,
+                post.return_value.text,
+                post.return_value.headers))
+        assert_equal(self.wh.failures, 1)
+
+        send_webhook.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=2).send()
+        send_webhook.post.assert_called_once_with(
+            self.wh._id, self.payload, attempt=3, delay=240)
+
+        send_webhook.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, attempt=3).send()
+        assert_equal(send_webhook.post.call_count, 0)
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_no_retries(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_no_retries(self, log, http_session, send_webhook):
+        post = http_session.return_value.post
+        post.return_value = Mock(status_code=500)
         with h.push_config(config, **{'webhook.retry': ''}):
             self.h.send()
-            assert_equal(requests.post.call_count, 1)
-            assert_equal(time.call_count, 0)
-            log.info.assert_called_once_with('Retrying webhook in: %s', [])
+            assert_equal(post.call_count, 1)
+            assert_equal(send_webhook.post.call_count, 0)
             assert_equal(log.error.call_count, 1)
-            log.error.assert_called_with(
-                'Webhook send error: %s %s %s %s %s %s' % (
-                    self.wh.type, self.wh.hook_url,
-                    self.wh.app_config.url(),
-                    requests.post.return_value.status_code,
-                    requests.post.return_value.text,
-                    requests.post.return_value.headers))
+
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
+    @patch('allura.webhooks.log', autospec=True)
+    def test_send_failing_webhook(self, log, http_session, send_webhook):
+        post = http_session.return_value.post
+        post.return_value = Mock(status_code=500)
+        with h.push_config(config, **{'webhook.max_failures': '2'}):
+            self.h.send()
+            assert_equal(send_webhook.post.call_count, 1)
+            self.h.send()
+            # failed too many times, so no more retries
+            assert_equal(send_webhook.post.call_count, 1)
+            self.h.send()
+            assert_equal(post.call_count, 2)
+            assert_equal(self.wh.failures, 2)
+            log.warn.assert_called_with(self.h.log_msg(
+                'Webhook keeps failing, not sending'))
+
+            self.wh.last_failure = dt.datetime.utcnow() - dt.timedelta(hours=2)
+            post.return_value = Mock(status_code=200)
+            self.h.send()
+            assert_equal(post.call_count, 3)
+            assert_equal(self.wh.failures, 0)
+
+    def test_deliver_webhooks(self):
+        received = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['content-length']))
+                received.append((self.path, json.loads(body)))
+                self.send_response(200 if self.path == '/ok' else 500)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%s' % server.server_address[1]
+            self.wh.hook_url = url + '/ok'
+            bad_wh = M.Webhook(
+                type='repo-push',
+                app_config_id=self.git.config._id,
+                hook_url=url + '/bad',
+                secret='secret')
+            session(bad_wh).flush(bad_wh)
+            helpers = [SendWebhookHelper(self.wh, {'n': 1}),
+                       SendWebhookHelper(bad_wh, {'n': 2}),
+                       SendWebhookHelper(self.wh, {'n': 3}),
+                       SendWebhookHelper(bad_wh, {'n': 4})]
+            with patch('allura.webhooks.send_webhook', autospec=True) as send_webhook:
+                assert_equal(deliver_webhooks(helpers), [True, False, True, False])
+            assert_equal(send_webhook.post.call_args_list, [
+                call(bad_wh._id, {'n': 2}, attempt=1, delay=60),
+                call(bad_wh._id, {'n': 4}, attempt=1, delay=60)])
+            assert_equal(sorted(received),
+                         [('/bad', {'n': 2}), ('/bad', {'n': 4}),
+                          ('/ok', {'n': 1}), ('/ok', {'n': 3})])
+            # one failed delivery, however many payloads it had
+            assert_equal(bad_wh.failures, 1)
+            session(bad_wh).expunge(bad_wh)
+            assert_equal(M.Webhook.query.get(_id=bad_wh._id).failures, 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
 
 
 class TestRepoPushWebhookSender(TestWebhookBase):
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send(self, send_webhooks):
         sender = RepoPushWebhookSender()
         sender.get_payload = Mock()
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        send_webhook.post.assert_called_once_with(
-            self.wh._id,
-            sender.get_payload.return_value)
+        send_webhooks.post.assert_called_once_with(
+            [(self.wh._id, sender.get_payload.return_value)])
 
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_with_list(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_with_list(self, send_webhooks):
         sender = RepoPushWebhookSender()
         sender.get_payload = Mock(side_effect=[1, 2])
         self.wh.enforce_limit = Mock(return_value=True)
         with h.push_config(c, app=self.git):
             sender.send([dict(arg1=1, arg2=2), dict(arg1=3, arg2=4)])
-        assert_equal(send_webhook.post.call_count, 2)
-        assert_equal(send_webhook.post.call_args_list,
-                     [call(self.wh._id, 1), call(self.wh._id, 2)])
+        send_webhooks.post.assert_called_once_with(
+            [(self.wh._id, 1), (self.wh._id, 2)])
         assert_equal(self.wh.enforce_limit.call_count, 1)
 
     @patch('allura.webhooks.log', autospec=True)
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_limit_reached(self, send_webhook, log):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_limit_reached(self, send_webhooks, log):
         sender = RepoPushWebhookSender()
         sender.get_payload = Mock()
         self.wh.enforce_limit = Mock(return_value=False)
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        assert_equal(send_webhook.post.call_count, 0)
+        assert_equal(send_webhooks.post.call_count, 0)
         log.warn.assert_called_once_with(
             'Webhook fires too often: %s. Skipping', self.wh)
 
-    @patch('allura.webhooks.send_webhook', autospec=True)
-    def test_send_no_configured_webhooks(self, send_webhook):
+    @patch('allura.webhooks.send_webhooks', autospec=True)
+    def test_send_no_configured_webhooks(self, send_webhooks):
         self.wh.delete()
         session(self.wh).flush(self.wh)
         sender = RepoPushWebhookSender()
         with h.push_config(c, app=self.git):
             sender.send(dict(arg1=1, arg2=2))
-        assert_equal(send_webhook.post.call_count, 0)
+        assert_equal(send_webhooks.post.call_count, 0)
 
     def test_get_payload(self):
         sender = RepoPushWebhookSender()
@@ -645,6 +729,22 @@ def test_update_limit(self, dt_mock):
         session(self.wh).expunge(self.wh)
         assert_equal(M.Webhook.query.get(_id=self.wh._id).last_sent, _now)
 
+    def test_is_failing(self):
+        assert_equal(self.wh.is_failing(), False)
+        for i in range(10):
+            self.wh.record_failure()
+        assert_equal(self.wh.is_failing(), True)
+        self.wh.last_failure = dt.datetime.utcnow() - dt.timedelta(seconds=3601)
+        assert_equal(self.wh.is_failing(), False)
+        with h.push_config(config, **{'webhook.failure_timeout': '7200'}):
+            assert_equal(self.wh.is_failing(), True)
+        with h.push_config(config, **{'webhook.max_failures': '0'}):
+            self.wh.last_failure = dt.datetime.utcnow()
+            assert_equal(self.wh.is_failing(), False)
+        self.wh.record_success()
+        session(self.wh).expunge(self.wh)
+        assert_equal(M.Webhook.query.get(_id=self.wh._id).failures, 0)
+
     def test_json(self):
         expected = {
             '_id': unicode(self.wh._id),
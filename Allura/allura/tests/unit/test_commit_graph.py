@@ -0,0 +1,156 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from nose.tools import assert_equal, assert_in, assert_not_in
+
+from allura.lib.commit_graph import CommitGraph, timestamp
+from allura.model.repo_refresh import last_known_commit_id
+
+
+def oid(n):
+    return '%040x' % n
+
+
+class TestCommitGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'commit-graph')
+        # 1 <- 2 <- 3 <- 5
+        #  \           /
+        #   `-- 4 <---'
+        self.graph = CommitGraph.write(self.path, {
+            oid(1): ([], 100),
+            oid(2): ([oid(1)], 200),
+            oid(3): ([oid(2)], 300),
+            oid(4): ([oid(1)], 250),
+            oid(5): ([oid(3), oid(4)], 400),
+        })
+
+    def tearDown(self):
+        self.graph.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        assert_equal(len(self.graph), 5)
+        assert_in(oid(3), self.graph)
+        assert_not_in(oid(6), self.graph)
+        assert_not_in('master', self.graph)
+        assert_equal(self.graph.parents(oid(5)), [oid(3), oid(4)])
+        assert_equal(self.graph.parents(oid(1)), [])
+        assert_equal(self.graph.timestamp(oid(4)), 250)
+        assert_equal(self.graph.date(oid(4)), datetime(1970, 1, 1, 0, 4, 10))
+        assert_equal(list(self.graph), [oid(i) for i in range(1, 6)])
+        with self.assertRaises(KeyError):
+            self.graph.parents(oid(6))
+
+    def test_generation(self):
+        assert_equal([self.graph.generation(oid(i)) for i in range(1, 6)],
+                     [1, 2, 3, 2, 4])
+
+    def test_log(self):
+        assert_equal(list(self.graph.log([oid(5)])),
+                     [oid(5), oid(3), oid(4), oid(2), oid(1)])
+        assert_equal(list(self.graph.log([oid(4), oid(3)], limit=3)),
+                     [oid(3), oid(4), oid(2)])
+
+    def test_is_ancestor(self):
+        assert self.graph.is_ancestor(oid(4), oid(5))
+        assert self.graph.is_ancestor(oid(1), oid(3))
+        assert self.graph.is_ancestor(oid(3), oid(3))
+        assert not self.graph.is_ancestor(oid(4), oid(3))
+        assert not self.graph.is_ancestor(oid(5), oid(1))
+
+    def test_incremental_write(self):
+        graph = CommitGraph.write(self.path, {
+            oid(6): ([oid(5), oid(2), oid(4)], 500),
+            oid(7): ([oid(6)], 600),
+        }, base=self.graph)
+        assert_equal(len(graph), 7)
+        assert_equal(graph.parents(oid(6)), [oid(5), oid(2), oid(4)])
+        assert_equal(graph.generation(oid(7)), 6)
+        assert_equal(graph.parents(oid(5)), [oid(3), oid(4)])
+        assert graph.is_ancestor(oid(4), oid(7))
+        graph.close()
+
+    def test_layers(self):
+        graph = self.graph
+        sizes = []
+        for n in range(6, 9):
+            graph = CommitGraph.write(self.path, {
+                oid(n): ([oid(n - 1)], n * 100),
+            }, base=graph)
+            sizes.append([len(l) for l in graph._layers])
+        # a layer is merged into the next one down when it's less than
+        # twice as big
+        assert_equal(sizes, [[5, 1], [5, 2], [5, 2, 1]])
+        graph = CommitGraph.write(self.path, {
+            oid(9): ([oid(8)], 900),
+            oid(10): ([oid(9), oid(4), oid(6)], 1000),
+        }, base=graph)
+        assert_equal([len(l) for l in graph._layers], [10])
+        assert_equal(sorted(f for f in os.listdir(self.tmpdir) if f.endswith('.layer')),
+                     sorted(l.name for l in graph._layers))
+        assert_equal(list(graph), [oid(i) for i in range(1, 11)])
+        assert_equal(graph.parents(oid(10)), [oid(9), oid(4), oid(6)])
+        assert_equal(graph.generation(oid(10)), 9)
+        assert graph.is_ancestor(oid(2), oid(10))
+        assert_equal(list(graph.log([oid(10)], limit=4)),
+                     [oid(10), oid(9), oid(8), oid(7)])
+        graph.close()
+
+    def test_before_epoch(self):
+        graph = CommitGraph.write(self.path, {
+            oid(8): ([], timestamp(datetime(1969, 7, 20, 20, 17))),
+        }, base=self.graph)
+        assert_equal(graph.date(oid(8)), datetime(1969, 7, 20, 20, 17))
+        assert_equal(list(graph.log([oid(8)])), [oid(8)])
+        graph.close()
+
+    def test_missing_parents(self):
+        graph = CommitGraph.write(self.path, {oid(8): ([oid(99)], 50)},
+                                  base=self.graph)
+        assert_equal(graph.parents(oid(8)), [])
+        assert_equal(graph.generation(oid(8)), 1)
+        graph.close()
+
+    def test_load(self):
+        graph = CommitGraph.load(self.path)
+        assert_equal(list(graph), list(self.graph))
+        graph.close()
+        assert_equal(CommitGraph.load(os.path.join(self.tmpdir, 'missing')), None)
+        bad = os.path.join(self.tmpdir, 'bad')
+        with open(bad, 'w') as fp:
+            fp.write('not a commit graph')
+        assert_equal(CommitGraph.load(bad), None)
+        with open(self.path + '.bad', 'w') as fp:
+            fp.write('ACGC 1\nmissing.layer\n')
+        assert_equal(CommitGraph.load(self.path + '.bad'), None)
+
+    def test_timestamp(self):
+        assert_equal(timestamp(datetime(1970, 1, 1, 0, 4, 10)), 250)
+
+    def test_last_known_commit_id(self):
+        all_ids = [oid(7), oid(5), oid(4), oid(3), oid(2), oid(1)]
+        assert_equal(last_known_commit_id(all_ids, [oid(7)], self.graph), oid(5))
+        assert_equal(last_known_commit_id(all_ids, [], self.graph), oid(5))
@@ -149,6 +149,17 @@ def test_flush_skips_task_if_all_objects_filtered_out(self, index_tasks):
         self.extension.after_flush()
         assert index_tasks.add_artifacts.post.call_count == 0
 
+    @mock.patch('allura.model.monq_model.MonQTask.discard_pending')
+    @mock.patch('allura.model.session.index_tasks')
+    def test_delete_discards_pending_adds(self, index_tasks, discard_pending):
+        deleted = [self._mock_indexable(_id=i) for i in range(2)]
+        self.extension.objects_deleted = deleted
+        self.extension.after_flush()
+        index_ids = [id(d) for d in deleted]
+        discard_pending.assert_called_once_with(
+            index_tasks.add_artifacts, index_ids)
+        index_tasks.del_artifacts.post.assert_called_once_with(index_ids)
+
 
 class TestBatchIndexer(TestCase):
 
@@ -24,7 +24,7 @@
 from allura.lib import helpers as h
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test
-from allura.lib.solr import Solr, escape_solr_arg
+from allura.lib.solr import Solr, SolrIndexBuffer, MockSOLR, escape_solr_arg
 from allura.lib.search import search_app, SearchIndexable
 
 
@@ -117,6 +117,111 @@ def test_site_admin_search(self, search):
             'username_s:admin1 || username_s:root', fq=fq, ignore_errors=False)
 
 
+class TestSolrIndexBuffer(unittest.TestCase):
+
+    def docs(self, *ids):
+        return [dict(id=i, text='') for i in ids]
+
+    def test_flush_by_size(self):
+        solr = MockSOLR()
+        buf = SolrIndexBuffer(solr, batch_size=3, max_wait=60)
+        buf.add(self.docs('a', 'b'))
+        assert_equal(solr.db, {})
+        assert_equal(len(buf), 2)
+        buf.add(self.docs('c', 'd'))
+        assert_equal(sorted(solr.db), ['a', 'b', 'c'])
+        assert_equal(len(buf), 1)
+        buf.flush()
+        assert_equal(sorted(solr.db), ['a', 'b', 'c', 'd'])
+        stats = buf.stats()
+        assert_equal(stats['sent'], 4)
+        assert_equal(stats['batches'], 2)
+        assert_equal(stats['pending'], 0)
+        assert_equal(stats['max_depth'], 4)
+
+    @mock.patch('allura.lib.solr.time')
+    def test_flush_by_time(self, time):
+        solr = MockSOLR()
+        buf = SolrIndexBuffer(solr, batch_size=100, max_wait=5)
+        time.time.return_value = 100
+        buf.add(self.docs('a'))
+        time.time.return_value = 104
+        buf.flush_if_due()
+        assert_equal(solr.db, {})
+        time.time.return_value = 105
+        buf.flush_if_due()
+        assert_equal(sorted(solr.db), ['a'])
+
+    def test_discard(self):
+        solr = MockSOLR()
+        buf = SolrIndexBuffer(solr, batch_size=100)
+        buf.add(self.docs('a', 'b'))
+        buf.discard(['a'])
+        buf.flush()
+        assert_equal(sorted(solr.db), ['b'])
+
+    @mock.patch('allura.lib.solr.time.sleep')
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_retry(self, pysolr, sleep):
+        servers = [mock.Mock(), mock.Mock()]
+        servers[1].add.side_effect = [Exception('down'), None]
+        pysolr.Solr.side_effect = servers
+        solr = Solr(['server1', 'server2'], commit=False, commitWithin='10000')
+        buf = SolrIndexBuffer(solr, batch_size=2, retries=2, backoff=1)
+        buf.add(self.docs('a', 'b'))
+        call = mock.call(self.docs('a', 'b'), commit=False, commitWithin='10000')
+        assert_equal(servers[0].add.call_args_list, [call])
+        assert_equal(servers[1].add.call_args_list, [call, call])
+        sleep.assert_called_once_with(1)
+        assert_equal(len(buf), 0)
+        assert_equal(buf.stats()['retries'], 1)
+
+    @mock.patch('allura.lib.solr.time.sleep')
+    def test_error_keeps_docs(self, sleep):
+        solr = mock.Mock(spec=['add'])
+        solr.add.side_effect = Exception('down')
+        buf = SolrIndexBuffer(solr, batch_size=10, retries=2, backoff=1)
+        buf.add(self.docs('a'))
+        with self.assertRaises(Exception):
+            buf.flush()
+        assert_equal(sleep.call_args_list, [mock.call(1), mock.call(2)])
+        assert_equal(len(buf), 1)
+        assert_equal(buf.stats()['errors'], 1)
+
+    def test_hold(self):
+        solr = MockSOLR()
+        release = mock.Mock()
+        buf = SolrIndexBuffer(solr, batch_size=2, max_wait=60, release=release)
+        buf.add(self.docs('a'))
+        buf.hold(['task1'])
+        buf.add(self.docs('b', 'c'))
+        buf.hold(['task2'])
+        # task1's document was sent, but not task2's
+        assert_equal(release.call_count, 0)
+        buf.flush()
+        release.assert_called_once_with(['task1', 'task2'])
+        # nothing pending, so released straight away
+        buf.hold(['task3'])
+        release.assert_called_with(['task3'])
+        buf.add(self.docs('d'))
+        buf.hold(['task4'])
+        buf.discard(['d'])
+        release.assert_called_with(['task4'])
+
+    def test_max_pending(self):
+        solr = mock.Mock(spec=['add'])
+        buf = SolrIndexBuffer(solr, batch_size=2, max_pending=3, max_wait=60)
+        solr.add.side_effect = Exception('down')
+        buf.retries = 0
+        buf.add(self.docs('a'))
+        with self.assertRaises(Exception):
+            buf.add(self.docs('b'))
+        with self.assertRaises(Exception):
+            buf.add(self.docs('c', 'd'))
+        # documents from the failed add aren't kept
+        assert_equal([d['id'] for d in buf.pending], ['a', 'b'])
+
+
 class TestSearchIndexable(unittest.TestCase):
 
     def setUp(self):
@@ -19,9 +19,12 @@
 import json
 import hmac
 import hashlib
-import time
 import socket
 import ssl
+import threading
+import Queue
+from collections import OrderedDict
+from urlparse import urlparse
 
 import requests
 from bson import ObjectId
@@ -31,6 +34,7 @@
 from pylons import response, request
 from formencode import validators as fev, schema, Invalid
 from ming.odm import session
+from ming.utils import LazyProperty
 from webob import exc
 from pymongo.errors import DuplicateKeyError
 from paste.deploy.converters import asint, aslist
@@ -314,9 +318,10 @@ def _delete(self, webhook):
 
 
 class SendWebhookHelper(object):
-    def __init__(self, webhook, payload):
+    def __init__(self, webhook, payload, attempt=0):
         self.webhook = webhook
         self.payload = payload
+        self.attempt = attempt  # number of earlier failed attempts
 
     @property
     def timeout(self):
@@ -334,12 +339,16 @@ def sign(self, json_payload):
             hashlib.sha1)
         return 'sha1=' + signature.hexdigest()
 
+    @LazyProperty
+    def app_url(self):
+        return self.webhook.app_config.url()
+
     def log_msg(self, msg, response=None):
         message = '{}: {} {} {}'.format(
             msg,
             self.webhook.type,
             self.webhook.hook_url,
-            self.webhook.app_config.url())
+            self.app_url)
         if response is not None:
             message = '{} {} {} {}'.format(
                 message,
@@ -349,24 +358,56 @@ def log_msg(self, msg, response=None):
         return message
 
     def send(self):
+        """Make one attempt to send the payload, then :meth:`finish`"""
+        self.finish(self.post())
+
+    def post(self):
+        """Make one attempt to send the payload.  Returns True if it was sent,
+        False if it failed, or None if the webhook has been failing and wasn't
+        tried.
+
+        Doesn't touch the database (once :attr:`app_url` is loaded), so it's
+        safe to call from other threads.
+        """
+        if self.webhook.is_failing():
+            log.warn(self.log_msg('Webhook keeps failing, not sending'))
+            return None
         json_payload = json.dumps(self.payload, cls=DateJSONEncoder)
         signature = self.sign(json_payload)
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': signature}
-        ok = self._send(self.webhook.hook_url, json_payload, headers)
-        if not ok:
-            log.info('Retrying webhook in: %s', self.retries)
-            for t in self.retries:
-                log.info('Retrying webhook in %s seconds', t)
-                time.sleep(t)
-                ok = self._send(self.webhook.hook_url, json_payload, headers)
-                if ok:
-                    return
+        return self._send(self.webhook.hook_url, json_payload, headers)
+
+    def finish(self, ok):
+        """Record the result of :meth:`post`, and :meth:`retry` if it failed"""
+        if ok is None:
+            return
+        if ok:
+            self.webhook.record_success()
+        else:
+            self.webhook.record_failure()
+            self.retry()
+
+    def retry(self):
+        """Schedule another attempt after a failed :meth:`post`, unless the
+        webhook keeps failing
+
+        Retries are posted as delayed tasks, so no worker waits for them.
+        """
+        if self.webhook.is_failing():
+            log.warn(self.log_msg('Webhook keeps failing, not retrying'))
+            return
+        retries = self.retries
+        if self.attempt < len(retries):
+            delay = retries[self.attempt]
+            log.info('Retrying webhook in %s seconds', delay)
+            send_webhook.post(self.webhook._id, self.payload,
+                              attempt=self.attempt + 1, delay=delay)
 
     def _send(self, url, data, headers):
         try:
-            r = requests.post(
+            r = http_session().post(
                 url,
                 data=data,
                 headers=headers,
@@ -384,10 +425,100 @@ def _send(self, url, data, headers):
             return False
 
 
+_http_session = None
+
+
+def http_session():
+    """A :class:`requests.Session` shared by all webhook deliveries in this
+    process, so connections to the hook urls are reused.
+    """
+    global _http_session
+    if _http_session is None:
+        pool_size = asint(config.get('webhook.pool_size', 10))
+        _http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+    return _http_session
+
+
+def deliver_webhooks(helpers):
+    """Send several webhook payloads at once, then record the result for each
+    webhook and :meth:`retry <SendWebhookHelper.retry>` the failed ones.
+
+    Up to ``webhook.max_concurrent`` payloads are sent at the same time, but
+    no more than ``webhook.max_per_host`` to the same host.  Payloads for the
+    same webhook are sent one after another, in order.  A webhook which fails
+    counts as one failure however many of its payloads failed.
+    """
+    max_concurrent = asint(config.get('webhook.max_concurrent', 10))
+    max_per_host = asint(config.get('webhook.max_per_host', 2))
+    host_limits = {}
+    by_webhook = OrderedDict()
+    for i, helper in enumerate(helpers):
+        host = urlparse(helper.webhook.hook_url).netloc
+        if host not in host_limits:
+            host_limits[host] = threading.Semaphore(max_per_host)
+        helper.app_url  # load it here, for logging from the other threads
+        by_webhook.setdefault(helper.webhook._id, []).append((i, helper))
+    queue = Queue.Queue()
+    for group in by_webhook.values():
+        queue.put(group)
+    results = [False] * len(helpers)  # see SendWebhookHelper.post
+
+    def worker():
+        while True:
+            try:
+                group = queue.get_nowait()
+            except Queue.Empty:
+                return
+            for i, helper in group:
+                with host_limits[urlparse(helper.webhook.hook_url).netloc]:
+                    try:
+                        results[i] = helper.post()
+                    except Exception:
+                        log.exception(helper.log_msg('Webhook send error'))
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_concurrent, len(by_webhook)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for group in by_webhook.values():
+        webhook = group[0][1].webhook
+        oks = [results[i] for i, helper in group]
+        if False in oks:
+            webhook.record_failure()
+        elif True in oks:
+            webhook.record_success()
+    for helper, ok in zip(helpers, results):
+        if ok is False:
+            helper.retry()
+    return results
+
+
 @task()
-def send_webhook(webhook_id, payload):
+def send_webhook(webhook_id, payload, attempt=0):
     webhook = M.Webhook.query.get(_id=webhook_id)
-    SendWebhookHelper(webhook, payload).send()
+    if webhook is None:
+        return  # deleted while waiting for a retry
+    SendWebhookHelper(webhook, payload, attempt).send()
+
+
+@task()
+def send_webhooks(deliveries):
+    """Send several payloads at once.
+
+    :param deliveries: list of (webhook id, payload) pairs
+    """
+    webhooks = M.Webhook.query.find(dict(
+        _id={'$in': list(set(wh_id for wh_id, payload in deliveries))})).all()
+    webhooks = dict((wh._id, wh) for wh in webhooks)
+    deliver_webhooks([SendWebhookHelper(webhooks[wh_id], payload)
+                      for wh_id, payload in deliveries
+                      if wh_id in webhooks])
 
 
 class WebhookSender(object):
@@ -407,12 +538,14 @@ def get_payload(self, **kw):
         raise NotImplementedError('get_payload')
 
     def send(self, params_or_list):
-        """Post a task that will send webhook payload
+        """Post a task that will send webhook payloads
 
         :param params_or_list: dict with keyword parameters to be passed to
             :meth:`get_payload` or a list of such dicts. If it's a list for each
             element appropriate payload will be submitted, but limit will be
             enforced only once for each webhook.
+
+        All the payloads for all the webhooks are sent by one task.
         """
         if not isinstance(params_or_list, list):
             params_or_list = [params_or_list]
@@ -423,13 +556,16 @@ def send(self, params_or_list):
         if webhooks:
             payloads = [self.get_payload(**params)
                         for params in params_or_list]
+            deliveries = []
             for webhook in webhooks:
                 if webhook.enforce_limit():
                     webhook.update_limit()
-                    for payload in payloads:
-                        send_webhook.post(webhook._id, payload)
+                    deliveries.extend((webhook._id, payload)
+                                      for payload in payloads)
                 else:
                     log.warn('Webhook fires too often: %s. Skipping', webhook)
+            if deliveries:
+                send_webhooks.post(deliveries)
 
     def enforce_limit(self, app):
         '''